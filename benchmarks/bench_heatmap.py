@@ -0,0 +1,67 @@
+"""
+measure how long the cells of a heatmap take for many rides the first time (every track is binned),
+after adding one more ride (only that ride is binned) and without changes, and how long rendering takes
+
+    python benchmarks/bench_heatmap.py [n_rides]
+"""
+from array import array
+from datetime import datetime, timedelta
+from pathlib import Path
+import math
+import random
+import sys
+import tempfile
+import time
+
+from kmtracker import db
+
+
+def create_points(rng: random.Random, n: int=7200) -> dict:
+    """a two hour ride around the same town, one point per second"""
+    lat, lon = 48.5 + rng.gauss(0, .01), 9.0 + rng.gauss(0, .01)
+    heading = rng.uniform(0, 2 * math.pi)
+    points = {name: array("d") for name in ("lat", "lon", "ele", "time")}
+    for i in range(n):
+        heading += rng.gauss(0, .05)
+        lat += 7 * math.cos(heading) / 111_000
+        lon += 7 * math.sin(heading) / (111_000 * math.cos(math.radians(lat)))
+        points["lat"].append(lat)
+        points["lon"].append(lon)
+        points["ele"].append(400.)
+        points["time"].append(float(i))
+    return points | {"n_points": n}
+
+
+def add_ride(database: db.Database, rng: random.Random, day: int):
+    ride = db.Ride(database, timestamp=datetime(2020, 1, 1) + timedelta(days=day), distance=50, segments=1)
+    ride.save()
+    db.TrackPoints.store(database, ride.pk, create_points(rng))
+
+
+def measure(name: str, compute):
+    start = time.perf_counter()
+    result = compute()
+    print(f"{name:<28}: {(time.perf_counter() - start) * 1000:8.1f} ms")
+    return result
+
+
+def main(n: int, cell_size: float=50):
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as directory:
+        database = db.Database(Path(directory) / "bench.sqlite3")
+        database.migrate()
+        for day in range(n):
+            add_ride(database, rng, day)
+        print(f"heatmap of {n} rides with 7200 points each, cells of {cell_size} m")
+        measure("all rides binned", lambda: db.TrackGrid.get_heatmap(database, cell_size))
+        add_ride(database, rng, n)
+        measure("one new ride binned", lambda: db.TrackGrid.get_heatmap(database, cell_size))
+        cells = measure("no new rides", lambda: db.TrackGrid.get_heatmap(database, cell_size))
+        print(f"{len(cells[0])} cells, at most {cells[2].max()} rides in a cell")
+        from kmtracker import plot
+        measure("rendered to png", lambda: plot.save_heatmap(database, Path(directory) / "heatmap.png", cell_size))
+        database.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,79 @@
+"""
+compare the time and memory needed to create Ride objects from rows with `Model.from_row`
+against the previous implementation (parse and setattr per column, instances with a __dict__)
+
+    python benchmarks/bench_hydration.py [n_rides]
+"""
+from contextlib import closing
+from datetime import datetime, timedelta
+import sys
+import time
+import tracemalloc
+
+from kmtracker import db
+
+
+class DictRide:
+    """
+    stand-in for the previous Ride objects, which stored their attributes in a __dict__.
+    like the previous `Model.__init__`, it sets nothing but the database and the columns
+    """
+    def __init__(self, db, **kwargs):
+        self._db = db
+        for column in db_columns:
+            setattr(self, column.name, kwargs.pop(column.name, None))
+        if kwargs:
+            raise TypeError(f"{kwargs.keys()} are invalid keyword arguments for {self.__class__.__name__}")
+
+
+db_columns = list(db.Ride.columns)
+
+
+def legacy_from_row(database, row):
+    attrs = {column.name: column.field.parse(row[column.column_name]) for column in db_columns}
+    return DictRide(database, **attrs)
+
+
+def create_rides(database: db.Database, n: int):
+    start = datetime(2015, 1, 1)
+    db.Ride.add_rows(database, [
+        {
+            "distance": 10 + i % 50,
+            "timestamp": start + timedelta(hours=7 * i),
+            "duration": timedelta(minutes=20 + i % 90),
+            "comment": "to work" if i % 3 else None,
+            "segments": 1,
+        }
+        for i in range(n)
+    ])
+
+
+def measure(name: str, rows: list, hydrate) -> float:
+    start = time.perf_counter()
+    objects = [hydrate(row) for row in rows]
+    elapsed = time.perf_counter() - start
+    del objects
+    # memory is measured separately because tracing slows down the allocations
+    tracemalloc.start()
+    objects = [hydrate(row) for row in rows]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<16}: {elapsed * 1000:8.1f} ms, {memory / len(objects):6.0f} bytes per ride")
+    return elapsed
+
+
+def main(n: int):
+    database = db.Database(":memory:")
+    with closing(database):
+        database.migrate()
+        create_rides(database, n)
+        with closing(database.cursor()) as cursor:
+            rows = cursor.execute(db.Ride.select_all_query()).fetchall()
+        print(f"hydrating {len(rows)} rides")
+        legacy = measure("previous", rows, lambda row: legacy_from_row(database, row))
+        current = measure("Model.from_row", rows, lambda row: db.Ride.from_row(database, row))
+        print(f"speedup         : {legacy / current:.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
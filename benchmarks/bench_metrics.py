@@ -0,0 +1,74 @@
+"""
+compare the time needed to compute the metrics of a long gpx track with gpxpy's loops
+against the numpy engine (`kmtracker.vectorized`), and how much the results differ
+
+    python benchmarks/bench_metrics.py [n_points]
+"""
+from datetime import datetime, timedelta, timezone
+import math
+import random
+import sys
+import time
+
+import gpxpy.gpx
+
+from kmtracker import db
+
+
+def create_track(n: int, n_segments: int=4) -> gpxpy.gpx.GPXTrack:
+    """a ride of n points recorded every second, with pauses, noisy elevations and a few gaps"""
+    rng = random.Random(42)
+    track = gpxpy.gpx.GPXTrack(name="synthetic")
+    t = datetime(2024, 5, 1, 8, tzinfo=timezone.utc)
+    lat, lon, ele = 48.5, 9.0, 400.
+    heading = 0.
+    for s in range(n_segments):
+        segment = gpxpy.gpx.GPXTrackSegment()
+        track.segments.append(segment)
+        for i in range(n // n_segments):
+            # ride at ~25 km/h, stop now and then
+            speed = 0 if (i // 600) % 10 == 9 else rng.gauss(7, 1.5)
+            heading += rng.gauss(0, .1)
+            lat += speed * math.cos(heading) / 111_000
+            lon += speed * math.sin(heading) / (111_000 * math.cos(math.radians(lat)))
+            ele += rng.gauss(0, .5)
+            t += timedelta(seconds=1)
+            segment.points.append(gpxpy.gpx.GPXTrackPoint(
+                lat, lon,
+                elevation=None if rng.random() < .01 else round(ele, 1),
+                time=None if rng.random() < .001 else t,
+            ))
+        # the next segment starts after a break
+        t += timedelta(minutes=20)
+    return track
+
+
+def measure(name: str, compute, repeat: int=3) -> tuple[float, dict]:
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = compute()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<24}: {best * 1000:8.1f} ms")
+    return best, result
+
+
+def main(n: int):
+    track = create_track(n)
+    print(f"computing the metrics of {track.get_points_no()} points in {len(track.segments)} segments")
+    legacy, expected = measure("gpxpy", lambda: db.RideMetrics.compute(track, engine="gpxpy"))
+    vectorized, result = measure("numpy", lambda: db.RideMetrics.compute(track, engine="numpy"))
+    points = db.TrackPoints.compute(track)
+    from_points, _ = measure("numpy (points extracted)", lambda: db.RideMetrics.compute(track, points, engine="numpy"))
+    print(f"speedup                 : {legacy / vectorized:.1f}x ({legacy / from_points:.1f}x from extracted points)")
+    for name, value in expected.items():
+        if isinstance(value, timedelta):
+            value, other = value.total_seconds(), result[name].total_seconds()
+        else:
+            other = result[name]
+        difference = abs(other - value) / abs(value) if value else abs(other)
+        print(f"  {name:<22}: {value!s:>22} relative difference {difference:.1e}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
@@ -7,6 +7,7 @@ from kmtracker import db
 
 DEFAULT_CONFIG_PATH = Path(os.environ.get("XDG_CONFIG_HOME", Path.home() / ".config")) / "kmtracker.cfg"
 DEFAULT_DB_PATH = "~/.kmtracker.sqlite3"
+DEFAULT_CACHE_PATH = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "kmtracker"
 
 
 def get_config(path: Path=DEFAULT_CONFIG_PATH) -> ConfigParser:
@@ -28,5 +29,30 @@ def get_db_path(config: ConfigParser) -> Path:
     return Path(config["db"]["path"]).expanduser().resolve()
 
 
+def get_pragmas(config: ConfigParser) -> dict:
+    """
+    get the connection settings of the database: the settings of the profile selected
+    in the config, overridden by settings that are given explicitly
+    """
+    section = config["db"]
+    profile = section.get("profile", db.DEFAULT_PROFILE)
+    if profile not in db.PROFILES:
+        raise ValueError(f"unknown database profile {profile!r}, choose one of {', '.join(db.PROFILES)}")
+    return db.PROFILES[profile] | {name: section[name] for name in db.PRAGMAS if name in section}
+
+
+def get_simplification(config: ConfigParser) -> db.Simplification:
+    """how the points of gpx tracks are simplified before they are stored (section [gpx])"""
+    return db.Simplification(
+        tolerance=config.getfloat("gpx", "simplify_tolerance", fallback=0),
+        interval=config.getfloat("gpx", "simplify_interval", fallback=0),
+    )
+
+
+def get_cache_path(config: ConfigParser) -> Path:
+    """the directory for files that kmtracker can recreate, like rendered plots"""
+    return Path(config.get("cache", "path", fallback=str(DEFAULT_CACHE_PATH))).expanduser().resolve()
+
+
 def get_database(config: ConfigParser) -> db.Database:
-    return db.Database(get_db_path(config))
+    return db.Database(get_db_path(config), get_pragmas(config))
@@ -0,0 +1,3 @@
+# number of migrations in this package. it is stored in `PRAGMA user_version` of databases
+# that are up to date, so it has to be increased together with every new migration
+SCHEMA_VERSION = 15
@@ -0,0 +1,33 @@
+from sqlite3 import Cursor
+import hashlib
+import zlib
+
+
+def run(cursor: Cursor):
+    """
+    move the raw gpx data from rides.gpx into a table of zlib-compressed blobs
+    that are keyed by the sha256 hash of their content
+    """
+    cursor.execute(f"""
+        CREATE TABLE gpx_blobs (
+            id INTEGER PRIMARY KEY,
+            hash TEXT NOT NULL UNIQUE,
+            data BLOB NOT NULL
+        )
+    """)
+    cursor.execute("ALTER TABLE rides ADD COLUMN gpx_id INTEGER REFERENCES gpx_blobs(id)")
+    ride_ids = [id for id, in cursor.execute("SELECT id FROM rides WHERE gpx IS NOT NULL").fetchall()]
+    for ride_id in ride_ids:
+        raw, = cursor.execute("SELECT gpx FROM rides WHERE id = ?", (ride_id,)).fetchone()
+        raw = raw.encode("utf-8")
+        digest = hashlib.sha256(raw).hexdigest()
+        # identical files (e.g. one per track of a multi-track file) are only stored once
+        cursor.execute(
+            "INSERT OR IGNORE INTO gpx_blobs (hash, data) VALUES (?, ?)",
+            (digest, zlib.compress(raw, 9))
+        )
+        cursor.execute(
+            "UPDATE rides SET gpx_id = (SELECT id FROM gpx_blobs WHERE hash = ?) WHERE id = ?",
+            (digest, ride_id)
+        )
+    cursor.execute("ALTER TABLE rides DROP gpx")
@@ -0,0 +1,24 @@
+from sqlite3 import Cursor
+
+
+def run(cursor: Cursor):
+    """
+    metrics of rides with gpx data. existing rides are filled in by `kmtracker backfill`
+    """
+    cursor.execute(f"""
+        CREATE TABLE ride_metrics (
+            id INTEGER PRIMARY KEY,
+            ride_id INTEGER NOT NULL UNIQUE REFERENCES rides(id) ON DELETE CASCADE,
+            moving_time_s INTEGER,
+            stopped_time_s INTEGER,
+            moving_distance_km REAL,
+            max_speed_kmh REAL,
+            uphill_m REAL,
+            downhill_m REAL,
+            min_lat REAL,
+            max_lat REAL,
+            min_lon REAL,
+            max_lon REAL,
+            n_points INTEGER
+        )
+    """)
@@ -0,0 +1,18 @@
+from sqlite3 import Cursor
+
+
+def run(cursor: Cursor):
+    """
+    points of the gpx tracks of rides as packed arrays. existing rides are filled in by `kmtracker backfill`
+    """
+    cursor.execute(f"""
+        CREATE TABLE track_points (
+            id INTEGER PRIMARY KEY,
+            ride_id INTEGER NOT NULL UNIQUE REFERENCES rides(id) ON DELETE CASCADE,
+            n_points INTEGER NOT NULL,
+            lat BLOB NOT NULL,
+            lon BLOB NOT NULL,
+            ele BLOB NOT NULL,
+            time BLOB NOT NULL
+        )
+    """)
@@ -0,0 +1,65 @@
+from sqlite3 import Cursor
+
+
+def aggregate(where: str) -> str:
+    """query that aggregates the rides matching where by day"""
+    return f"""
+        SELECT
+            DATE(timestamp),
+            SUM(distance_km),
+            TOTAL(CASE WHEN duration_s IS NOT NULL THEN distance_km END),
+            TOTAL(duration_s),
+            COALESCE(SUM(segments), 0),
+            MAX(distance_km / segments),
+            MAX(distance_km / duration_s * 3600)
+        FROM rides
+        WHERE {where}
+        GROUP BY DATE(timestamp)
+    """
+
+
+def recompute_day(day: str) -> str:
+    return f"""
+        DELETE FROM daily_totals WHERE day = DATE({day});
+        INSERT INTO daily_totals {aggregate(f"DATE(timestamp) = DATE({day})")};
+    """
+
+
+def run(cursor: Cursor):
+    """
+    daily aggregates of rides, kept up to date by triggers on the rides table
+    """
+    cursor.execute(f"""
+        CREATE TABLE daily_totals (
+            day TEXT PRIMARY KEY,
+            distance_km REAL NOT NULL,
+            timed_distance_km REAL NOT NULL,
+            duration_s INTEGER NOT NULL,
+            n_rides INTEGER NOT NULL,
+            max_distance_km REAL,
+            max_speed_kmh REAL
+        )
+    """)
+    # the triggers look up all rides of a day
+    cursor.execute("CREATE INDEX rides_day ON rides(DATE(timestamp))")
+    cursor.execute(f"""
+        CREATE TRIGGER rides_daily_totals_insert AFTER INSERT ON rides
+        BEGIN
+            {recompute_day("NEW.timestamp")}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER rides_daily_totals_delete AFTER DELETE ON rides
+        BEGIN
+            {recompute_day("OLD.timestamp")}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER rides_daily_totals_update
+        AFTER UPDATE OF timestamp, distance_km, duration_s, segments ON rides
+        BEGIN
+            {recompute_day("OLD.timestamp")}
+            {recompute_day("NEW.timestamp")}
+        END
+    """)
+    cursor.execute(f"INSERT INTO daily_totals {aggregate('1')}")
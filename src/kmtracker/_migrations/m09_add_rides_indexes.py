@@ -0,0 +1,10 @@
+from sqlite3 import Cursor
+
+
+def run(cursor: Cursor):
+    """
+    indexes for listing rides by date and finding rides with gpx data.
+    the index on the day of rides is added together with the daily totals in m08
+    """
+    cursor.execute("CREATE INDEX rides_timestamp ON rides(timestamp)")
+    cursor.execute("CREATE INDEX rides_gpx_id ON rides(gpx_id)")
@@ -0,0 +1,39 @@
+from sqlite3 import Cursor
+
+
+def run(cursor: Cursor):
+    """
+    full-text index of the comments of rides (the track names of rides from gpx files),
+    kept up to date by triggers on the rides table
+    """
+    # an external content table: the index refers to the comments in the rides table
+    # instead of storing a second copy of them
+    cursor.execute("""
+        CREATE VIRTUAL TABLE rides_fts USING fts5(
+            comment,
+            content='rides',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER rides_fts_insert AFTER INSERT ON rides
+        BEGIN
+            INSERT INTO rides_fts (rowid, comment) VALUES (NEW.id, NEW.comment);
+        END
+    """)
+    # deleting from an external content table needs the old values to find the index entries
+    cursor.execute("""
+        CREATE TRIGGER rides_fts_delete AFTER DELETE ON rides
+        BEGIN
+            INSERT INTO rides_fts (rides_fts, rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER rides_fts_update AFTER UPDATE OF comment ON rides
+        BEGIN
+            INSERT INTO rides_fts (rides_fts, rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+            INSERT INTO rides_fts (rowid, comment) VALUES (NEW.id, NEW.comment);
+        END
+    """)
+    cursor.execute("INSERT INTO rides_fts (rides_fts) VALUES ('rebuild')")
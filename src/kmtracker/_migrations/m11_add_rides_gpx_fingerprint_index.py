@@ -0,0 +1,30 @@
+from sqlite3 import Cursor
+
+
+def run(cursor: Cursor):
+    """
+    a unique index on the start time and distance (rounded to 10 m) of rides from gpx files,
+    so that a track can't be imported twice. rides that were already imported more than once
+    are kept: the copies after the first one are left out of the index
+    """
+    duplicates = [id for id, in cursor.execute("""
+        SELECT id FROM rides AS ride
+        WHERE gpx_id IS NOT NULL AND EXISTS (
+            SELECT 1 FROM rides AS other
+            WHERE other.gpx_id IS NOT NULL
+                AND other.timestamp = ride.timestamp
+                AND ROUND(other.distance_km, 2) = ROUND(ride.distance_km, 2)
+                AND other.id < ride.id
+        )
+    """).fetchall()]
+    # the condition of a partial index can't look at other rows, but it can list the IDs
+    excluded = f" AND id NOT IN ({', '.join(map(str, duplicates))})" if duplicates else ""
+    cursor.execute(f"""
+        CREATE UNIQUE INDEX rides_gpx_fingerprint ON rides(timestamp, ROUND(distance_km, 2))
+        WHERE gpx_id IS NOT NULL{excluded}
+    """)
+    if duplicates:
+        print(
+            f"found {len(duplicates)} rides that were imported more than once (IDs {', '.join(map(str, duplicates))}). "
+            "they are kept, but you may want to remove them"
+        )
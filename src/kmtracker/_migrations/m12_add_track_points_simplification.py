@@ -0,0 +1,10 @@
+from sqlite3 import Cursor
+
+
+def run(cursor: Cursor):
+    """
+    how much simplified tracks differ from the recorded ones. NULL for tracks that are not simplified
+    """
+    cursor.execute("ALTER TABLE track_points ADD COLUMN n_recorded INTEGER")
+    cursor.execute("ALTER TABLE track_points ADD COLUMN distance_error REAL")
+    cursor.execute("ALTER TABLE track_points ADD COLUMN uphill_error REAL")
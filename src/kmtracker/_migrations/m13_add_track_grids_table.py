@@ -0,0 +1,30 @@
+from sqlite3 import Cursor
+
+
+def run(cursor: Cursor):
+    """
+    the grid cells that the tracks of rides pass through, for heatmaps. they are computed from the
+    track points when a heatmap needs them, and deleted by triggers when the track points change
+    """
+    cursor.execute("""
+        CREATE TABLE track_grids (
+            id INTEGER PRIMARY KEY,
+            ride_id INTEGER NOT NULL REFERENCES rides(id) ON DELETE CASCADE,
+            cell_size REAL NOT NULL,
+            lat_cells BLOB NOT NULL,
+            lon_cells BLOB NOT NULL,
+            UNIQUE (ride_id, cell_size)
+        )
+    """)
+    cursor.execute("""
+        CREATE TRIGGER track_grids_points_update AFTER UPDATE OF lat, lon ON track_points
+        BEGIN
+            DELETE FROM track_grids WHERE ride_id = OLD.ride_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER track_grids_points_delete AFTER DELETE ON track_points
+        BEGIN
+            DELETE FROM track_grids WHERE ride_id = OLD.ride_id;
+        END
+    """)
@@ -0,0 +1,17 @@
+from sqlite3 import Cursor
+
+
+def run(cursor: Cursor):
+    """
+    the number of points of every segment of a track, so that heatmaps don't connect the end of a segment
+    with the start of the next one. NULL for points that were stored before, backfill extracts them again
+    for rides with more than one segment. grids are also deleted when the segments change
+    """
+    cursor.execute("ALTER TABLE track_points ADD COLUMN segment_sizes BLOB")
+    cursor.execute("DROP TRIGGER track_grids_points_update")
+    cursor.execute("""
+        CREATE TRIGGER track_grids_points_update AFTER UPDATE OF lat, lon, segment_sizes ON track_points
+        BEGIN
+            DELETE FROM track_grids WHERE ride_id = OLD.ride_id;
+        END
+    """)
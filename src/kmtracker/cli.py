@@ -1,21 +1,29 @@
+from __future__ import annotations
 import argparse
-import dateutil
+import glob
 import sys
 from configparser import ConfigParser
-from contextlib import closing
-from datetime import datetime, timedelta
-import dateutil.parser
+from contextlib import ExitStack, closing
+from datetime import date, datetime, timedelta
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from kmtracker.db import Database, Ride, Alias
-from kmtracker import pretty
-from kmtracker import plot
+from kmtracker.db import (
+    Database, Ride, Alias, DailyTotal, RideFilter, RideMetrics, TrackPoints, PARSERS, METRICS_ENGINES, DEFAULT_METRICS_ENGINE,
+    read_gpx,
+)
+from kmtracker import export, pretty
 from kmtracker import (
     get_config,
     get_db_path,
+    get_cache_path,
     get_database,
+    get_simplification,
 )
 
+if TYPE_CHECKING:
+    import zipfile
+
 
 def cli_add(database: Database, args: argparse.Namespace):
     # see if the first argument could be an alias
@@ -34,13 +42,11 @@ def cli_add(database: Database, args: argparse.Namespace):
         }
     parsed_args = default_values | convert_common_flags(args)
     new = Ride(database, **parsed_args)
-    new.save()
+    new.save(args.simplify)
     pretty.console.print("Success!✨ ", style="green bold", end="")
     pretty.console.print("Added a new ride:")
     pretty.print_rides([new])
-    streaks = Ride.get_streaks(database)
-    if (today := datetime.today().date()) in streaks:
-        pretty.console.print(f"🚴[bold green]You're on a streak![/bold green] {streaks[today]} days in a row")
+    pretty.print_streak(Ride.get_current_streak(database))
 
 
 def cli_amend(database: Database, args: argparse.Namespace):
@@ -50,10 +56,10 @@ def cli_amend(database: Database, args: argparse.Namespace):
         ride = Ride.get_last_row(database)
     else:
         pretty.console.print(f"Changed entry with ID {args.id}:")
-        ride = Ride.get_row(args.id)
+        ride = Ride.get_row(database, args.id)
     for field, value in parsed_args.items():
         setattr(ride, field, value)
-    ride.save()
+    ride.save(args.simplify)
     pretty.print_rides([ride])
 
 
@@ -71,33 +77,160 @@ def cli_alias_ls(db: Database, args: argparse.Namespace):
 
 
 def cli_loadgpx(db: Database, args: argparse.Namespace):
-    gpx_path = Path(args.path)
-    if not gpx_path.exists():
-        print(f"file not found: {args.path}")
-    new = Ride.from_gpx(db, gpx_path)
-    pretty.print_rides(new)
-    streaks = Ride.get_streaks(db)
-    if (today := datetime.today().date()) in streaks:
-        pretty.console.print(f"🚴[bold green]You're on a streak![/bold green] {streaks[today]} days in a row")
+    new, failed = [], 0
+    # zip archives stay open until their files are read
+    with ExitStack() as archives:
+        paths = find_gpx_files(args.paths, archives)
+        with pretty.progress(len(paths), "reading gpx files") as advance:
+            on_duplicate = "update" if args.update else "skip"
+            results = Ride.import_gpx_files(
+                db, paths, args.jobs, on_duplicate=on_duplicate, parser=args.parser, simplify=args.simplify,
+                engine=args.metrics_engine,
+            )
+            for path, result in results:
+                if isinstance(result, Exception):
+                    failed += 1
+                    pretty.print_file_error(path, result)
+                else:
+                    new.extend(result)
+                advance()
+    if len(paths) == 1 and new:
+        pretty.print_rides(new)
+    else:
+        saved = "added or updated" if args.update else "added"
+        pretty.console.print(f"{saved} {len(new)} rides from {len(paths) - failed} files", end="")
+        pretty.console.print(f", [bold red]{failed} failed[/bold red]" if failed else "")
+    if new and args.simplify:
+        pretty.print_simplification(TrackPoints.summarize_simplification(db, [ride.pk for ride in new]))
+    if new:
+        pretty.print_streak(Ride.get_current_streak(db))
+
+
+def is_gpx_file(name: str) -> bool:
+    return name.lower().endswith((".gpx", ".gpx.gz"))
+
+
+def find_gpx_files(patterns: list[str], archives: ExitStack) -> list[Path | zipfile.Path]:
+    """
+    expand the arguments of loadgpx into the list of files to read. arguments can be files,
+    zip archives (their .gpx and .gpx.gz files are read without extracting them), directories
+    (searched recursively for .gpx and .gpx.gz files) or glob patterns. zip archives are opened
+    in archives, their files can be read until it is closed
+    """
+    def expand(path: Path) -> list[Path | zipfile.Path]:
+        if path.suffix.lower() != ".zip":
+            return [path]
+        import zipfile
+        # the members share the archive, which is opened once
+        archive = archives.enter_context(zipfile.ZipFile(path))
+        return [zipfile.Path(archive, name) for name in sorted(archive.namelist()) if is_gpx_file(name)]
+
+    found = []
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            found += sorted(p for p in path.rglob("*") if is_gpx_file(p.name) and p.is_file())
+        elif path.exists():
+            found += expand(path)
+        elif matches := glob.glob(pattern, recursive=True):
+            for match in sorted(Path(match) for match in matches if Path(match).is_file()):
+                found += expand(match)
+        else:
+            raise FileNotFoundError(f"file not found: {pattern}")
+    # files matched by more than one argument are read once
+    return list({str(path): path for path in found}.values())
 
 
 def cli_ls(db: Database, args: argparse.Namespace):
-    latest = Ride.get_latest_entries(db, args.n)
-    pretty.print_rides(latest)
+    filter = get_filter(args)
+    after = None
+    if args.after is not None:
+        after = Ride.get_row(db, args.after).sort_key
+    elif args.page > 1:
+        if args.n < 1:
+            raise ValueError("--page requires the number of entries per page (-n)")
+        after = Ride.get_sort_key_at(db, (args.page - 1) * args.n - 1, filter)
+        if after is None:
+            pretty.console.print("Nothing to show.")
+            return
+    latest = Ride.iter_latest_entries(db, args.n, after=after, filter=filter)
+    if args.pager:
+        with pretty.pager():
+            pretty.print_rides_streaming(latest)
+    else:
+        pretty.print_rides_streaming(latest)
+
+
+def cli_search(db: Database, args: argparse.Namespace):
+    found = Ride.iter_search(db, " ".join(args.text), args.n, get_filter(args))
+    pretty.print_rides_streaming(found)
 
 
 def cli_show(db: Database, args: argparse.Namespace):
     ride = Ride.get_row(db, args.id)
-    pretty.print_entry(ride)
+    # only what is stored is shown, missing metrics are computed by backfill
+    try:
+        metrics = RideMetrics.get_by_ride(db, ride.pk)
+    except KeyError:
+        metrics = None
+    pretty.print_entry(ride, metrics, TrackPoints.get_simplification(db, ride.pk))
+
+
+def cli_backfill(db: Database, args: argparse.Namespace):
+    total = Ride.count_missing_track_data(db)
+    if not total:
+        pretty.console.print("Nothing to do.")
+        return
+    done = 0
+    for n in Ride.backfill_track_data(db, simplify=args.simplify):
+        done += n
+        pretty.console.print(f"processed {done}/{total} rides")
 
 
 def cli_stats(db: Database, args: argparse.Namespace):
-    summary = Ride.get_summary(db)
+    summary = Ride.get_summary(db, get_filter(args))
     pretty.print_summary(summary)
 
 
+def cli_report(db: Database, args: argparse.Namespace):
+    report = Ride.get_report(db, args.by, get_filter(args), compare=args.compare)
+    pretty.print_report(report, args.by, compare=args.compare)
+
+
+def cli_rebuild(db: Database, args: argparse.Namespace):
+    if n := DailyTotal.check(db):
+        pretty.console.print(f"daily totals of {n} days were out of sync, rebuilding")
+    else:
+        pretty.console.print("daily totals are consistent, rebuilding")
+    DailyTotal.rebuild(db)
+
+
 def cli_plot(db: Database, args: argparse.Namespace):
-    plot.show_plot(db)
+    # matplotlib is slow to import, so only import it when plotting
+    from kmtracker import plot
+    if args.output:
+        plot.save_plot(db, args.output, get_filter(args), None if args.no_cache else args.cache_path / "plots")
+    else:
+        plot.show_plot(db, get_filter(args))
+
+
+def cli_heatmap(db: Database, args: argparse.Namespace):
+    from kmtracker import plot
+    if args.output:
+        plot.save_heatmap(db, args.output, args.cell_size, get_filter(args))
+    else:
+        plot.show_heatmap(db, args.cell_size, get_filter(args))
+
+
+def cli_export(db: Database, args: argparse.Namespace):
+    format = args.format or export.guess_format(args.output)
+    options = {"filter": get_filter(args), "metrics": args.metrics, "gpx_directory": args.with_gpx}
+    if args.output is None:
+        export.export_rides(db, sys.stdout, format, **options)
+        return
+    # the csv module writes its own line endings
+    with open(args.output, "w", newline="") as out:
+        export.export_rides(db, out, format, **options)
 
 
 def get_args() -> argparse.Namespace:
@@ -136,28 +269,138 @@ def get_args() -> argparse.Namespace:
     alias_ls = alias_subparsers.add_parser("ls", help="list all aliases")
     alias_ls.set_defaults(func=cli_alias_ls)
 
-    loadgpx = subparsers.add_parser("loadgpx", help="add entries from a gpx file")
-    loadgpx.add_argument("path", help="path to gpx file")
+    loadgpx = subparsers.add_parser("loadgpx", help="add entries from gpx files")
+    loadgpx.add_argument(
+        "paths", help="gpx files (also .gpx.gz), zip archives of them, directories with them or glob patterns", nargs="+"
+    )
+    loadgpx.add_argument("-j", "--jobs", help="number of processes that read files (default: one per CPU)", type=int)
+    loadgpx.add_argument(
+        "-u", "--update",
+        help="update rides of tracks that were imported before from another file instead of skipping them",
+        action="store_true",
+    )
+    loadgpx.add_argument(
+        "-p", "--parser",
+        help="gpxpy (default) or stream, which needs much less memory for long tracks",
+        choices=PARSERS,
+        default="gpxpy",
+    )
+    loadgpx.add_argument(
+        "--metrics-engine",
+        help=f"how the metrics of the tracks are computed (default: {DEFAULT_METRICS_ENGINE})",
+        choices=METRICS_ENGINES,
+        default=DEFAULT_METRICS_ENGINE,
+    )
     loadgpx.set_defaults(func=cli_loadgpx)
 
     ls = subparsers.add_parser("ls", help="show latest ride")
-    ls.add_argument("-n", help="number of entries to show", type=int, default=-1)
+    ls.add_argument("-n", help="number of entries to show (per page)", type=int, default=-1)
+    ls.add_argument("-p", "--page", help="show the n entries of this page", type=int, default=1)
+    ls.add_argument("-a", "--after", help="continue the list after the entry with this ID", type=int)
+    ls.add_argument("--pager", help="show the entries in a pager", action="store_true")
+    add_filter_arguments(ls)
     ls.set_defaults(func=cli_ls)
 
+    search = subparsers.add_parser("search", help="find rides by words in their comment, best matches first")
+    search.add_argument("text", help="words that the comment contains (or beginnings of words)", nargs="+")
+    search.add_argument("-n", help="number of entries to show", type=int, default=-1)
+    add_filter_arguments(search)
+    search.set_defaults(func=cli_search)
+
     show = subparsers.add_parser("show", help="show details of an entry")
     show.add_argument("id", help="ID of the entry", type=int)
     show.set_defaults(func=cli_show)
 
+    backfill = subparsers.add_parser("backfill", help="compute missing metrics and track points of rides with gpx data")
+    backfill.set_defaults(func=cli_backfill)
+
     stats = subparsers.add_parser("stats")
+    add_filter_arguments(stats)
     stats.set_defaults(func=cli_stats)
 
-    plot = subparsers.add_parser("plot")
+    report = subparsers.add_parser("report", help="show totals per week, month or year")
+    report.add_argument("-b", "--by", help="period to total (default: month)", choices=["week", "month", "year"], default="month")
+    report.add_argument("--compare", help="compare with the same period one year before", action="store_true")
+    add_filter_arguments(report)
+    report.set_defaults(func=cli_report)
+
+    rebuild = subparsers.add_parser("rebuild", help="check and recompute the daily totals used by stats")
+    rebuild.set_defaults(func=cli_rebuild)
+
+    export_ = subparsers.add_parser("export", help="write rides to a csv or ndjson file")
+    export_.add_argument("-o", "--output", help="file to write to (default: stdout)", type=Path)
+    export_.add_argument(
+        "--format", help="format of the rows (default: by the suffix of the output, else csv)", choices=export.FORMATS
+    )
+    export_.add_argument("--metrics", help="add the metrics of rides with gpx data", action="store_true")
+    export_.add_argument("--with-gpx", help="write the gpx files of the rides to this directory", type=Path, metavar="DIR")
+    add_filter_arguments(export_)
+    export_.set_defaults(func=cli_export)
+
+    plot = subparsers.add_parser("plot", help="show the distances per day as calendars, one per year")
+    plot.add_argument("-o", "--output", help="save the plot to this file (e.g. png or svg) instead of showing it", type=Path)
+    plot.add_argument("--no-cache", help="render all years again instead of reusing unchanged ones", action="store_true")
+    add_filter_arguments(plot)
     plot.set_defaults(func=cli_plot)
 
+    heatmap = subparsers.add_parser("heatmap", help="show how many rides passed through each place")
+    heatmap.add_argument("-o", "--output", help="save the heatmap to this file (e.g. png or svg) instead of showing it", type=Path)
+    heatmap.add_argument("--cell-size", help="size of the cells of the heatmap in meters (default: 50)", type=float, default=50)
+    add_filter_arguments(heatmap)
+    heatmap.set_defaults(func=cli_heatmap)
+
     args = parser.parse_args()
     return args
 
 
+def add_filter_arguments(parser: argparse.ArgumentParser):
+    """add the flags that select rides (ls, stats, plot, ...)"""
+    filters = parser.add_argument_group("filters")
+    filters.add_argument("--since", help="only rides on or after this date (YYYY-MM-DD)", type=date.fromisoformat)
+    filters.add_argument("--until", help="only rides on or before this date (YYYY-MM-DD)", type=date.fromisoformat)
+    filters.add_argument("--min-distance", help="only rides of at least this many km", type=float)
+    filters.add_argument("--max-distance", help="only rides of at most this many km", type=float)
+    filters.add_argument("--min-duration", help="only rides of at least this duration (hh:mm or hh:mm:ss)")
+    filters.add_argument("--max-duration", help="only rides of at most this duration (hh:mm or hh:mm:ss)")
+    filters.add_argument("--min-speed", help="only rides with an average speed of at least this many km/h", type=float)
+    filters.add_argument("--gpx", help="only rides with (--gpx) or without (--no-gpx) gpx data", action=argparse.BooleanOptionalAction)
+    filters.add_argument("--segments", help="only rides with this number of segments", type=int)
+
+
+def get_filter(args: argparse.Namespace) -> RideFilter | None:
+    """build the filter from the flags added by add_filter_arguments, None if no flag is set"""
+    filter = RideFilter(
+        since=args.since,
+        until=args.until,
+        min_distance=args.min_distance,
+        max_distance=args.max_distance,
+        min_duration=parse_duration(args.min_duration) if args.min_duration else None,
+        max_duration=parse_duration(args.max_duration) if args.max_duration else None,
+        min_speed=args.min_speed,
+        has_gpx=args.gpx,
+        segments=args.segments,
+    )
+    if all(value is None for value in vars(filter).values()):
+        return None
+    return filter
+
+
+def parse_duration(duration: str) -> timedelta:
+    """parse hh:mm or hh:mm:ss, exit if that fails"""
+    try:
+        # raises if the conversion to int fails or no case is matched
+        match duration.split(":"):
+            case [hours, minutes]:
+                return timedelta(hours=int(hours), minutes=int(minutes))
+            case [hours, minutes, seconds]:
+                return timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds))
+            case _:
+                raise ValueError()
+    except ValueError:
+        print(f"invalid duration (must be hh:mm or hh:mm:ss): {duration!r}")
+        sys.exit(1)
+
+
 def convert_common_flags(args: argparse.Namespace, auto_timestamp=True) -> dict:
     """
     takes an argparse Namespace and parses and converts flags that are common across multiple
@@ -171,6 +414,7 @@ def convert_common_flags(args: argparse.Namespace, auto_timestamp=True) -> dict:
             print(f"invalid float value for argument distance: {args.distance!r}")
             sys.exit(1)
     if hasattr(args, "timestamp") and args.timestamp:
+        import dateutil.parser
         try:
             parsed["timestamp"] = dateutil.parser.parse(args.timestamp)
         except dateutil.parser.ParserError:
@@ -179,18 +423,7 @@ def convert_common_flags(args: argparse.Namespace, auto_timestamp=True) -> dict:
     elif auto_timestamp:
         parsed["timestamp"] = datetime.now()
     if hasattr(args, "duration") and args.duration:
-        try:
-            # raises if the conversion to int fails or no case is matched
-            match args.duration.split(":"):
-                case [hours, minutes]:
-                    parsed["duration"] = timedelta(hours=int(hours), minutes=int(minutes))
-                case [hours, minutes, seconds]:
-                    parsed["duration"] = timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds))
-                case _:
-                    raise ValueError()
-        except ValueError:
-            print(f"invalid duration (must be hh:mm or hh:mm:ss): {args.duration!r}")
-            sys.exit(1)
+        parsed["duration"] = parse_duration(args.duration)
     if hasattr(args, "comment") and args.comment is not None:
         parsed["comment"] = args.comment
     if hasattr(args, "segments") and args.segments:
@@ -200,8 +433,7 @@ def convert_common_flags(args: argparse.Namespace, auto_timestamp=True) -> dict:
         if not gpxpath.exists():
             print(f"file not found: {args.gpx}")
             sys.exit(1)
-        with open(gpxpath) as f:
-            parsed["gpx"] = f.read()
+        parsed["gpx"] = read_gpx(gpxpath)
     return parsed
 
 
@@ -214,6 +446,9 @@ def main():
         config = get_config()
     db_path = get_db_path(config)
 
+    # settings from the config that commands need
+    args.simplify = get_simplification(config)
+    args.cache_path = get_cache_path(config)
     with closing(get_database(config)) as database:
         if not db_path.exists():
             database.migrate()
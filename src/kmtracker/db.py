@@ -1,20 +1,92 @@
+from __future__ import annotations
 import sqlite3
 from pathlib import Path
-from contextlib import closing
-from collections import Counter
-from datetime import datetime
+from contextlib import closing, contextmanager
+from collections import Counter, deque
+from copy import copy
+from datetime import date, datetime
 from datetime import timedelta
 from enum import Enum
-import gpxpy
 import glob
 import importlib
-from typing import Self
+from typing import Callable, Iterator, Self, TYPE_CHECKING
+from array import array
+import hashlib
+import io
+import json
+from itertools import islice
+import math
+import os
+import re
+import sys
+import zlib
+
+from kmtracker._migrations import SCHEMA_VERSION
+
+if TYPE_CHECKING:
+    import gpxpy.gpx
+    import zipfile
+
+
+def parse_gpx(raw: str) -> gpxpy.gpx.GPX:
+    # gpxpy is imported here because it is slow to import and most commands don't need it
+    import gpxpy
+    return gpxpy.parse(raw)
+
+
+def read_gpx(path: Path | zipfile.Path) -> str:
+    """
+    read the gpx file at path, which is gzip-compressed if its name ends with .gz
+    and may be a member of a zip archive. the contents are only decompressed in memory
+    """
+    with path.open("rb") as f:
+        if path.name.lower().endswith(".gz"):
+            import gzip
+            f = gzip.GzipFile(fileobj=f)
+        # decoded like open() in text mode, so that compressed files have the hash of their contents
+        with io.TextIOWrapper(f) as text:
+            return text.read()
+
+
+# connection settings that can be set in the config
+PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store", "busy_timeout")
+PROFILES = {
+    # sqlite's defaults
+    "default": {},
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -16000,  # 16 MB
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+    },
+}
+DEFAULT_PROFILE = "fast"
 
 
 class Database:
-    def __init__(self, path: str):
+    def __init__(self, path: str, pragmas: dict=None):
         self.connection = sqlite3.connect(path)
         self.connection.row_factory = sqlite3.Row
+        # sqlite doesn't enforce foreign keys (and their ON DELETE CASCADE) unless it is asked to
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self._transaction_depth = 0
+        for name, value in (pragmas or {}).items():
+            self.set_pragma(name, value)
+
+    def set_pragma(self, name: str, value: str | int):
+        if name not in PRAGMAS:
+            raise ValueError(f"unknown database setting: {name}")
+        if not re.fullmatch(r"-?\w+", str(value)):
+            raise ValueError(f"invalid value for database setting {name}: {value!r}")
+        with closing(self.connection.cursor()) as cursor:
+            cursor.execute(f"PRAGMA {name} = {value}").fetchall()
 
     def close(self):
         self.connection.close()
@@ -23,13 +95,58 @@ class Database:
         return self.connection.cursor()
 
     def commit(self):
-        self.connection.commit()
+        # inside of a transaction block, changes are committed at the end of the block
+        if not self._transaction_depth:
+            self.connection.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        group all changes made inside the block into a single transaction that is committed
+        at the end of the block or rolled back on an exception. nested blocks join the outer one
+        """
+        self._transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.connection.rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.connection.commit()
+
+    @contextmanager
+    def savepoint(self):
+        """
+        like `transaction`, but when the block raises an exception inside of another transaction block,
+        only the changes of this block are rolled back and the outer transaction goes on
+        """
+        with self.transaction():
+            # a savepoint outside of a transaction would start (and its release commit) one of its own
+            if not self.connection.in_transaction:
+                self.connection.execute("BEGIN")
+            name = f"block_{self._transaction_depth}"
+            self.connection.execute(f"SAVEPOINT {name}")
+            try:
+                yield
+            except BaseException:
+                self.connection.execute(f"ROLLBACK TO {name}")
+                self.connection.execute(f"RELEASE {name}")
+                raise
+            self.connection.execute(f"RELEASE {name}")
 
     def migrate(self):
         """
         migrate changes to the database schema to the database
         or create a new one
         """
+        # fast path: the schema is up to date
+        with closing(self.connection.cursor()) as cursor:
+            if cursor.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                return
         # look up which migrations are available
         migration_modules = sorted(
             Path(m).stem for m in
@@ -57,13 +174,19 @@ class Database:
                     f"INSERT INTO {Migrations.table} ({Migrations.columns.name}) VALUES (?)",
                     (module,)
                 )
+            cursor.execute(f"PRAGMA user_version = {len(migration_modules)}")
         self.commit()
 
 
 class Field:
-    def __init__(self, column_name: str, display_name: str=None):
+    """
+    a column of a table. deferred fields are not selected together with the other columns
+    but fetched from the database when they are accessed for the first time
+    """
+    def __init__(self, column_name: str, display_name: str=None, deferred: bool=False):
         self.name = column_name
         self.display_name = display_name or column_name
+        self.deferred = deferred
 
     @staticmethod
     def parse(value):
@@ -124,6 +247,56 @@ class FloatField(Field):
         return str(round(value, 1))
 
 
+class CompressedTextField(Field):
+    """text that is stored as a zlib-compressed blob"""
+    @staticmethod
+    def parse(value: bytes) -> str:
+        if value is not None:
+            return zlib.decompress(value).decode("utf-8")
+
+    @staticmethod
+    def serialize(value: str) -> bytes:
+        if value is not None:
+            return zlib.compress(value.encode("utf-8"), 9)
+
+    @staticmethod
+    def serialize_pretty(value: str) -> str:
+        if value is None:
+            return ""
+        return f"<{len(value)} characters>"
+
+
+class PackedArrayField(Field):
+    """
+    sequence of floats that is stored as packed little-endian doubles.
+    parses to a memoryview of the stored bytes, so the values are not copied
+    """
+    @staticmethod
+    def parse(value: bytes) -> memoryview:
+        if value is None:
+            return None
+        if sys.byteorder == "big":
+            values = array("d", value)
+            values.byteswap()
+            return memoryview(values)
+        return memoryview(value).cast("d")
+
+    @staticmethod
+    def serialize(value) -> bytes:
+        if value is None:
+            return None
+        values = array("d", value)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values.tobytes()
+
+    @staticmethod
+    def serialize_pretty(value) -> str:
+        if value is None:
+            return ""
+        return f"<{len(value)} values>"
+
+
 class ColumnEnum(Enum):
     """
     enumeration of fields
@@ -141,11 +314,45 @@ class ColumnEnum(Enum):
         return str(self.column_name)
 
 
-class Model:
+class _DeferredAttribute:
+    """
+    descriptor for deferred columns: the value is loaded from the database on first access
+    """
+    def __init__(self, column: ColumnEnum):
+        self.column = column
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.column.name not in instance._deferred:
+            instance._deferred[self.column.name] = instance._load_deferred(self.column)
+        return instance._deferred[self.column.name]
+
+    def __set__(self, instance, value):
+        instance._deferred[self.column.name] = value
+
+
+class ModelMeta(type):
+    """
+    adds the columns of a model that are not deferred to its `__slots__`,
+    so that instances don't need a `__dict__`
+    """
+    def __new__(mcs, name, bases, namespace):
+        slots = tuple(namespace.get("__slots__", ()))
+        for column in namespace.get("columns", ()):
+            if not getattr(column.value, "deferred", False) and column.name not in slots:
+                slots += (column.name,)
+        namespace["__slots__"] = slots
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class Model(metaclass=ModelMeta):
     """
     represents a table in the database. `columns` is an enumeration of `Field`s
     """
+    __slots__ = ("_db", "_deferred")
     table: str
+    _has_deferred = False
 
     class columns(ColumnEnum):
         ...
@@ -156,10 +363,17 @@ class Model:
         for column in cls.columns:
             if not isinstance(column.field, Field):
                 raise TypeError(f"members of columns must be of type Field: {cls.__name__}.columns.{column.name} is {type(column.field)}")
+            if column.field.deferred:
+                setattr(cls, column.name, _DeferredAttribute(column))
+        cls._has_deferred = any(column.field.deferred for column in cls.columns)
+        cls._row_factory = cls._compile_row_factory()
 
     def __init__(self, db: Database, **kwargs):
-        self._db = db
+        self._setup(db)
         for column in self.columns:
+            if column.field.deferred and column.name not in kwargs:
+                # will be loaded from the db on first access
+                continue
             setattr(
                 self,
                 column.name,
@@ -168,13 +382,51 @@ class Model:
         if kwargs:
             raise TypeError(f"{kwargs.keys()} are invalid keyword arguments for {self.__class__.__name__}")
 
+    def _setup(self, db: Database):
+        """initialize the state of a new object that does not belong to a column"""
+        self._db = db
+        # only needed if there are deferred columns
+        self._deferred = {} if self._has_deferred else None
+
     @classmethod
-    def from_row(cls, db: Database, row: sqlite3.Row):
-        attrs = {column.name: column.field.parse(row[column.column_name]) for column in cls.columns}
-        return cls(
-            db,
-            **attrs
-        )
+    def _compile_row_factory(cls):
+        """
+        generate the function that creates an object from a row of `select_all_query`.
+        it sets the attributes directly instead of looping over the columns for every row
+        """
+        namespace = {"cls": cls, "new": object.__new__}
+        lines = ["def from_row(db, row):", "    obj = new(cls)", "    obj._setup(db)"]
+        selected = [column for column in cls.columns if not column.field.deferred]
+        for i, column in enumerate(selected):
+            if type(column.field).parse is Field.parse:
+                # parse does nothing
+                lines.append(f"    obj.{column.name} = row[{i}]")
+            else:
+                namespace[f"parse_{column.name}"] = column.field.parse
+                lines.append(f"    obj.{column.name} = parse_{column.name}(row[{i}])")
+        lines.append("    return obj")
+        exec("\n".join(lines), namespace)
+        return namespace["from_row"]
+
+    @classmethod
+    def from_row(cls, db: Database, row: sqlite3.Row) -> Self:
+        """create an object from a row that has the columns in the order of `select_all_query`"""
+        return cls._row_factory(db, row)
+
+    def _is_loaded(self, column: ColumnEnum) -> bool:
+        return not column.field.deferred or column.name in self._deferred
+
+    def _load_deferred(self, column: ColumnEnum):
+        """fetch the value of a deferred column from the db"""
+        if self.pk is None:
+            return None
+        with closing(self._db.cursor()) as cursor:
+            row = cursor.execute(
+                f"SELECT {column} FROM {self.table} WHERE id = ?",
+                (self.pk,)
+            ).fetchone()
+        if row:
+            return column.field.parse(row[0])
 
     def serialize(self) -> dict:
         return {
@@ -183,9 +435,10 @@ class Model:
         }
 
     def serialize_pretty(self) -> dict:
+        # don't fetch deferred columns just for displaying them
         data = {
             column.name: column.field.serialize_pretty(getattr(self, column.name))
-            for column in self.columns
+            for column in self.columns if self._is_loaded(column)
         }
         return data
 
@@ -195,45 +448,97 @@ class Model:
         and adding a new row otherwise
         """
         if not self.pk:
-            # add a new row
-            attrs = {column.name: getattr(self, column.name) for column in self.columns}
-            attrs.pop("pk")
-            self.add_row(self._db, **attrs)
-            new = self.get_last_row(self._db) # get the row we just created
-            self.pk = new.pk
+            self.pk = self.add_row(self._db, **self._values())
         else:
-            # update existing row
-            setters = ", ".join(
-                f"{column.column_name} = ?"
-                for column in self.columns if column.column_name != "id"
+            self._update()
+
+    def _values(self) -> dict:
+        """values of all columns except the primary key"""
+        attrs = {column.name: getattr(self, column.name) for column in self.columns}
+        attrs.pop("pk")
+        return attrs
+
+    def _update(self):
+        """update the existing row; deferred columns that were never loaded are unchanged"""
+        columns = [
+            column for column in self.columns
+            if column.column_name != "id" and self._is_loaded(column)
+        ]
+        setters = ", ".join(f"{column.column_name} = ?" for column in columns)
+        values = [column.field.serialize(getattr(self, column.name)) for column in columns]
+        with closing(self._db.cursor()) as cursor:
+            cursor.execute(
+                f"UPDATE {self.table} SET {setters} WHERE id = ?",
+                (*values, self.pk)
             )
-            values = [
-                column.field.serialize(getattr(self, column.name))
-                for column in self.columns if column.column_name != "id"
-            ]
-            with closing(self._db.cursor()) as cursor:
-                cursor.execute(
-                    f"UPDATE {self.table} SET {setters} WHERE id = ?",
-                    (*values, self.pk)
-                )
-            self._db.commit()
+        self._db.commit()
+
+    @classmethod
+    def bulk_save(cls, db: Database, objects: list[Self]):
+        """
+        save all objects in a single transaction. new rows are inserted with `add_rows`
+        """
+        with db.transaction():
+            new = [obj for obj in objects if not obj.pk]
+            for obj in objects:
+                if obj.pk:
+                    obj._update()
+            ids = cls.add_rows(db, [obj._values() for obj in new])
+            for obj, id in zip(new, ids):
+                obj.pk = id
 
     @classmethod
     def select_all_query(cls) -> str:
-        return f"SELECT {', '.join(str(column) for column in cls.columns)} FROM {cls.table}"
+        """select all columns that are not deferred"""
+        selected = [str(column) for column in cls.columns if not column.field.deferred]
+        return f"SELECT {', '.join(selected)} FROM {cls.table}"
+
+    @classmethod
+    def insert_query(cls) -> str:
+        return (
+            f"INSERT INTO {cls.table} ({', '.join(str(col) for col in cls.columns)}) "
+            f"VALUES ({', '.join('?' for _ in range(len(cls.columns)))})"
+        )
 
     @classmethod
-    def add_row(cls, db: Database, **kwargs):
-        """insert a new row into the table. takes values for columns as keyword arguments"""
+    def _serialize_row(cls, values: dict) -> tuple:
+        return tuple(col.field.serialize(values.get(col.name)) for col in cls.columns)
+
+    @classmethod
+    def add_row(cls, db: Database, **kwargs) -> int:
+        """
+        insert a new row into the table. takes values for columns as keyword arguments
+        and returns the ID of the new row
+        """
         with closing(db.cursor()) as cursor:
-            cursor.execute(
-                f"""INSERT INTO {cls.table} (
-                    {', '.join(str(col) for col in cls.columns)}
-                ) VALUES ({', '.join('?' for _ in range(len(cls.columns)))})
-                """,
-                tuple(col.field.serialize(kwargs.get(col.name)) for col in cls.columns)
-            )
+            cursor.execute(cls.insert_query(), cls._serialize_row(kwargs))
+            id = cursor.lastrowid
         db.commit()
+        return id
+
+    @classmethod
+    def add_rows(cls, db: Database, rows: list[dict]) -> list[int]:
+        """
+        insert new rows into the table in a single transaction. takes a dict of values for columns
+        per row and returns the IDs of the new rows
+        """
+        with db.transaction(), closing(db.cursor()) as cursor:
+            return [
+                cursor.execute(f"{cls.insert_query()} RETURNING id", cls._serialize_row(row)).fetchone()[0]
+                for row in rows
+            ]
+
+    @classmethod
+    def iter_query(cls, db: Database, query: str, params: tuple=(), chunk_size: int=500) -> Iterator[Self]:
+        """
+        yield an object per row of query, which has to select the columns like `select_all_query`.
+        rows are fetched from the cursor in chunks of chunk_size
+        """
+        with closing(db.cursor()) as cursor:
+            cursor.execute(query, params)
+            while rows := cursor.fetchmany(chunk_size):
+                for row in rows:
+                    yield cls.from_row(db, row)
 
     @classmethod
     def get_last_row(cls, db: Database) -> Self:
@@ -258,6 +563,107 @@ class Model:
         return cls.from_row(db, row)
 
 
+def where(conditions: list[str]) -> str:
+    """combine SQL conditions into a WHERE clause"""
+    if not conditions:
+        return ""
+    return "WHERE " + " AND ".join(conditions)
+
+
+class RideFilter:
+    """
+    conditions on rides that compile to parameterized SQL conditions.
+    all conditions are optional, dates are inclusive and speeds are in km/h
+    """
+    def __init__(
+        self,
+        since: date=None,
+        until: date=None,
+        min_distance: float=None,
+        max_distance: float=None,
+        min_duration: timedelta=None,
+        max_duration: timedelta=None,
+        min_speed: float=None,
+        has_gpx: bool=None,
+        segments: int=None,
+    ):
+        self.since = since
+        self.until = until
+        self.min_distance = min_distance
+        self.max_distance = max_distance
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.min_speed = min_speed
+        self.has_gpx = has_gpx
+        self.segments = segments
+
+    def only_dates(self) -> bool:
+        """True if the filter has no conditions besides since and until"""
+        return all(
+            value is None for name, value in vars(self).items() if name not in ("since", "until")
+        )
+
+    @staticmethod
+    def year_before(day: date) -> date:
+        """the same day one year earlier (february 28 for february 29)"""
+        if (day.month, day.day) == (2, 29):
+            return day.replace(year=day.year - 1, day=28)
+        return day.replace(year=day.year - 1)
+
+    def shifted(self, shift: Callable[[date], date]) -> Self:
+        """return a copy of the filter with since and until moved by shift"""
+        shifted = copy(self)
+        if self.since is not None:
+            shifted.since = shift(self.since)
+        if self.until is not None:
+            shifted.until = shift(self.until)
+        return shifted
+
+    def conditions(self) -> tuple[list[str], list]:
+        """return the conditions on the rides table and their parameters"""
+        c = Ride.columns
+        conditions, params = [], []
+        # timestamps are ISO strings, so comparing them with dates uses the index on timestamp
+        if self.since is not None:
+            conditions.append(f"{c.timestamp} >= ?")
+            params.append(self.since.isoformat())
+        if self.until is not None:
+            conditions.append(f"{c.timestamp} < ?")
+            params.append((self.until + timedelta(days=1)).isoformat())
+        if self.min_distance is not None:
+            conditions.append(f"{c.distance} >= ?")
+            params.append(self.min_distance)
+        if self.max_distance is not None:
+            conditions.append(f"{c.distance} <= ?")
+            params.append(self.max_distance)
+        if self.min_duration is not None:
+            conditions.append(f"{c.duration} >= ?")
+            params.append(c.duration.field.serialize(self.min_duration))
+        if self.max_duration is not None:
+            conditions.append(f"{c.duration} <= ?")
+            params.append(c.duration.field.serialize(self.max_duration))
+        if self.min_speed is not None:
+            conditions.append(f"{c.distance} / {c.duration} * 3600 >= ?")
+            params.append(self.min_speed)
+        if self.has_gpx is not None:
+            conditions.append(f"{c.gpx_id} IS {'NOT NULL' if self.has_gpx else 'NULL'}")
+        if self.segments is not None:
+            conditions.append(f"{c.segments} = ?")
+            params.append(self.segments)
+        return conditions, params
+
+    def day_conditions(self) -> tuple[list[str], list]:
+        """return the conditions on since and until for the daily totals and their parameters"""
+        conditions, params = [], []
+        if self.since is not None:
+            conditions.append(f"{DailyTotal.columns.day} >= ?")
+            params.append(self.since.isoformat())
+        if self.until is not None:
+            conditions.append(f"{DailyTotal.columns.day} <= ?")
+            params.append(self.until.isoformat())
+        return conditions, params
+
+
 class Ride(Model):
     table = "rides"
 
@@ -268,135 +674,409 @@ class Ride(Model):
         duration = TimedeltaField("duration_s", display_name="Duration (hh:mm:ss)")
         comment = Field("comment", display_name="Comment")
         segments = Field("segments", display_name="Segments")
-        gpx = Field("gpx", display_name="GPX")
+        gpx_id = Field("gpx_id", display_name="GPX")
+
+    __slots__ = ("_gpx", "_replaced_gpx_id")
+
+    def __init__(self, db: Database, gpx: str=None, **kwargs):
+        super().__init__(db, **kwargs)
+        if gpx is not None:
+            self.gpx = gpx
+
+    def _setup(self, db: Database):
+        super()._setup(db)
+        self._gpx = None
+        self._replaced_gpx_id = None
+
+    @property
+    def gpx(self) -> str | None:
+        """the raw gpx data, loaded from the blob store on first access"""
+        if self._gpx is None and self.gpx_id is not None:
+            self._gpx = GpxBlob.get_row(self._db, self.gpx_id).data
+        return self._gpx
+
+    @gpx.setter
+    def gpx(self, raw: str | None):
+        # the blob is written and referenced in save(), the old one is deleted there if no
+        # other ride refers to it
+        if self.gpx_id is not None:
+            self._replaced_gpx_id = self.gpx_id
+        self._gpx = raw
+        self.gpx_id = None
 
     @property
     def has_gpx(self) -> bool:
-        return bool(self.gpx)
+        return self.gpx_id is not None or self._gpx is not None
 
     @property
     def speed(self) -> int:
         if self.distance and self.duration:
             return self.distance / self.duration.total_seconds() * 3600
 
+    def save(self, simplify: Simplification=None):
+        self.bulk_save(self._db, [self], simplify)
+
+    @classmethod
+    def bulk_save(cls, db: Database, rides: list[Self], simplify: Simplification=None):
+        """
+        save all rides in a single transaction, including gpx data that was assigned to them
+        (the points of their tracks are simplified with simplify)
+        """
+        with db.transaction():
+            new_gpx = [ride for ride in rides if ride._gpx is not None and ride.gpx_id is None]
+            for ride in new_gpx:
+                # the unique index rides_gpx_fingerprint would reject the ride with a less helpful message
+                existing = cls.get_by_fingerprint(db, ride.timestamp, ride.distance)
+                if existing and existing.pk != ride.pk:
+                    raise ValueError(
+                        f"the ride with ID {existing.pk} has the same start time and distance and was "
+                        "already imported from a gpx file"
+                    )
+                ride.gpx_id = GpxBlob.store(db, ride._gpx)
+            super().bulk_save(db, rides)
+            for ride in new_gpx:
+                ride.update_track_data(parse_gpx(ride._gpx), simplify)
+            for ride in rides:
+                if ride._replaced_gpx_id is not None:
+                    GpxBlob.delete_if_unused(db, ride._replaced_gpx_id)
+                    ride._replaced_gpx_id = None
+
+    def update_track_data(self, track: gpxpy.gpx.GPX | gpxpy.gpx.GPXTrack, simplify: Simplification=None):
+        """
+        compute and save the data that is derived from the ride's gpx track,
+        the points of the track are simplified with simplify
+        """
+        points = TrackPoints.compute(track)
+        RideMetrics.store(self._db, self.pk, RideMetrics.compute(track, points))
+        TrackPoints.store(self._db, self.pk, simplify.apply(points) if simplify else points)
+
+    def get_metrics(self) -> RideMetrics | None:
+        """
+        return the metrics of the ride's gpx data or None if it has none.
+        metrics that have not been computed yet are computed and saved
+        """
+        if not self.has_gpx:
+            return None
+        try:
+            return RideMetrics.get_by_ride(self._db, self.pk)
+        except KeyError:
+            return RideMetrics.update(self._db, self.pk, self.get_track(parse_gpx(self.gpx)))
+
+    def get_track_points(self) -> TrackPoints | None:
+        """
+        return the points of the ride's gpx track or None if it has none.
+        points that have not been extracted yet are extracted and saved
+        """
+        if not self.has_gpx:
+            return None
+        try:
+            return TrackPoints.get_by_ride(self._db, self.pk)
+        except KeyError:
+            return TrackPoints.update(self._db, self.pk, self.get_track(parse_gpx(self.gpx)))
+
+    def get_track(self, gpx: gpxpy.gpx.GPX) -> gpxpy.gpx.GPX | gpxpy.gpx.GPXTrack:
+        """
+        return the track of gpx that this ride was created from, or the whole gpx
+        if it cannot be identified
+        """
+        if len(gpx.tracks) > 1:
+            for track in gpx.tracks:
+                if track.get_time_bounds().start_time == self.timestamp:
+                    return track
+        return gpx
+
     def serialize_pretty(self):
         return super().serialize_pretty() | {
             "speed": FloatField.serialize_pretty(self.speed),
-            "gpx": "✅" if self.gpx else "-"
+            "gpx": "✅" if self.has_gpx else "-"
         }
 
+    @property
+    def sort_key(self) -> tuple[str, int]:
+        """position of the ride in the list of rides, which is sorted by (timestamp, id)"""
+        return (self.columns.timestamp.field.serialize(self.timestamp), self.pk)
+
     @classmethod
-    def get_latest_entries(cls, db: Database, n: int) -> list[Self]:
+    def get_sort_key_at(cls, db: Database, offset: int, filter: RideFilter=None) -> tuple[str, int] | None:
+        """return the sort key of the ride at offset in the list of rides matching filter, newest first"""
+        conditions, params = filter.conditions() if filter else ([], [])
+        with closing(db.cursor()) as cursor:
+            # without filter (or filtering only by date), this only reads the index on timestamp
+            row = cursor.execute(
+                f"SELECT {cls.columns.timestamp}, id FROM {cls.table} {where(conditions)} "
+                f"ORDER BY {cls.columns.timestamp} DESC, id DESC LIMIT 1 OFFSET ?",
+                (*params, offset)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    @classmethod
+    def iter_latest_entries(
+        cls, db: Database, n: int=-1, after: tuple[str, int]=None, filter: RideFilter=None
+    ) -> Iterator[Self]:
         """
-        return the latest n entries (by timestamp)
+        iterate over the latest n entries (by timestamp, all if n is negative) that match filter.
+        if `after` is the sort key of a ride, start with the ride that comes after it
         """
-        with closing(db.cursor()) as cursor:
-            rows = cursor.execute(
-                f"{cls.select_all_query()} ORDER BY {cls.columns.timestamp} DESC LIMIT ?",
-                (n,)
-            ).fetchall()
-        return [cls.from_row(db, row) for row in rows]
+        conditions, params = filter.conditions() if filter else ([], [])
+        if after:
+            conditions.append(f"({cls.columns.timestamp}, id) < (?, ?)")
+            params.extend(after)
+        return cls.iter_query(
+            db,
+            f"{cls.select_all_query()} {where(conditions)} ORDER BY {cls.columns.timestamp} DESC, id DESC LIMIT ?",
+            (*params, n),
+        )
 
     @classmethod
-    def get_total_distance(cls, db: Database) -> float:
+    def get_latest_entries(cls, db: Database, n: int, filter: RideFilter=None) -> list[Self]:
+        """
+        return the latest n entries (by timestamp) that match filter
+        """
+        return list(cls.iter_latest_entries(db, n, filter=filter))
+
+    @classmethod
+    def iter_export(
+        cls, db: Database, filter: RideFilter=None, metrics: bool=False, gpx_hash: bool=False, chunk_size: int=500
+    ) -> Iterator[dict]:
+        """
+        iterate over the rides that match filter by timestamp as dicts of their columns (by column name)
+        with the values as they are stored, i.e. as `Field.serialize` returns them. with metrics,
+        the columns of their `RideMetrics` are added (NULL for rides without gpx data), with gpx_hash
+        the hash of their gpx file. rows are fetched from the cursor in chunks of chunk_size
+        """
+        selected = [f"{cls.table}.{column}" for column in cls.columns]
+        joins = []
+        if metrics:
+            selected += [
+                f"{RideMetrics.table}.{column}" for column in RideMetrics.columns
+                if column not in (RideMetrics.columns.pk, RideMetrics.columns.ride_id)
+            ]
+            joins.append(
+                f"LEFT JOIN {RideMetrics.table} ON {RideMetrics.table}.{RideMetrics.columns.ride_id} = {cls.table}.id"
+            )
+        if gpx_hash:
+            selected.append(f"{GpxBlob.table}.{GpxBlob.columns.hash} AS gpx_hash")
+            joins.append(f"LEFT JOIN {GpxBlob.table} ON {GpxBlob.table}.id = {cls.table}.{cls.columns.gpx_id}")
+        conditions, params = filter.conditions() if filter else ([], [])
         with closing(db.cursor()) as cursor:
-            return cursor.execute(f"SELECT SUM({cls.columns.distance}) FROM {cls.table}").fetchone()[0]
+            cursor.execute(
+                f"SELECT {', '.join(selected)} FROM {cls.table} {' '.join(joins)} {where(conditions)} "
+                f"ORDER BY {cls.columns.timestamp}, {cls.table}.id",
+                params
+            )
+            names = [description[0] for description in cursor.description]
+            while rows := cursor.fetchmany(chunk_size):
+                for row in rows:
+                    yield dict(zip(names, row))
+
+    @staticmethod
+    def search_query(text: str) -> str:
+        """
+        turn text into an FTS5 query that matches comments containing all of its words
+        (or words starting with them). quotes keep FTS5 syntax like AND, OR or - from being interpreted
+        """
+        words = text.split()
+        if not words:
+            raise ValueError("nothing to search for")
+        return " ".join('"{}"*'.format(word.replace('"', '""')) for word in words)
+
+    @classmethod
+    def iter_search(cls, db: Database, text: str, n: int=-1, filter: RideFilter=None) -> Iterator[Self]:
+        """
+        iterate over the n rides (all if n is negative) matching filter whose comment matches text
+        (see `search_query`), best matches first
+        """
+        conditions, params = filter.conditions() if filter else ([], [])
+        return cls.iter_query(
+            db,
+            f"""
+                {cls.select_all_query()}
+                JOIN (SELECT rowid AS ride_id, rank FROM rides_fts WHERE rides_fts MATCH ?) AS matches
+                    ON id = matches.ride_id
+                {where(conditions)}
+                ORDER BY matches.rank, {cls.columns.timestamp} DESC LIMIT ?
+            """,
+            (cls.search_query(text), *params, n),
+        )
 
     @classmethod
-    def get_max_distance_entry(cls, db: Database) -> tuple[int, str]:
-        """get the maximum distance of a single ride with timestamp"""
+    def _query_daily(cls, db: Database, query: str, filter: RideFilter | None) -> sqlite3.Row:
+        """run query, which selects from `daily`, over the daily totals of the rides matching filter"""
+        daily, params = DailyTotal.daily_cte(filter)
         with closing(db.cursor()) as cursor:
-            return cursor.execute(
-                f"SELECT MAX({cls.columns.distance} / {cls.columns.segments}) AS {cls.columns.distance}, {cls.columns.timestamp} "
-                f"FROM {cls.table}"
-            ).fetchone()
+            return cursor.execute(f"WITH {daily} {query}", params).fetchone()
+
+    @classmethod
+    def get_total_distance(cls, db: Database, filter: RideFilter=None) -> float:
+        return cls._query_daily(db, f"SELECT SUM({DailyTotal.columns.distance}) FROM daily", filter)[0]
+
+    @classmethod
+    def get_max_distance_entry(cls, db: Database, filter: RideFilter=None) -> tuple[int, str]:
+        """get the maximum distance of a single ride with date"""
+        return cls._query_daily(
+            db, f"SELECT MAX({DailyTotal.columns.max_distance}), {DailyTotal.columns.day} FROM daily", filter
+        )
 
     @classmethod
-    def get_max_distance_by_day(cls, db: Database) -> tuple[int, str]:
+    def get_max_distance_by_day(cls, db: Database, filter: RideFilter=None) -> tuple[int, str]:
         """get the maximum distance covered on a day"""
-        with closing(db.cursor()) as cursor:
-            return cursor.execute(f"""
-                SELECT MAX(daily_distance), day
-                FROM (
-                    SELECT DATE({Ride.columns.timestamp}) as day, SUM({Ride.columns.distance}) as daily_distance
-                    FROM {Ride.table}
-                    GROUP BY day
-                )
-            """).fetchone()
+        return cls._query_daily(
+            db, f"SELECT MAX({DailyTotal.columns.distance}), {DailyTotal.columns.day} FROM daily", filter
+        )
 
     @classmethod
-    def get_max_speed_entry(cls, db: Database) -> tuple[int, str]:
-        """return the maximum speed with timestamp"""
-        with closing(db.cursor()) as cursor:
-            return cursor.execute(
-                f"SELECT MAX({cls.columns.distance} / {cls.columns.duration} * 3600) as speed, {cls.columns.timestamp} "
-                f"FROM {cls.table} WHERE {cls.columns.duration} IS NOT NULL"
-            ).fetchone()
+    def get_max_speed_entry(cls, db: Database, filter: RideFilter=None) -> tuple[int, str]:
+        """return the maximum speed with date"""
+        return cls._query_daily(
+            db, f"SELECT MAX({DailyTotal.columns.max_speed}), {DailyTotal.columns.day} FROM daily", filter
+        )
 
     @classmethod
-    def get_average_speed(cls, db: Database) -> float:
+    def get_average_speed(cls, db: Database, filter: RideFilter=None) -> float:
         """return the average speed of all entries with a duration in km/h"""
-        with closing(db.cursor()) as cursor:
-            s_km, t_s = cursor.execute(
-                f"SELECT SUM({cls.columns.distance}), SUM({cls.columns.duration}) "
-                F"FROM {cls.table} WHERE {cls.columns.duration} IS NOT NULL"
-            ).fetchone()
-        if t_s is None:
+        s_km, t_s = cls._query_daily(
+            db,
+            f"SELECT SUM({DailyTotal.columns.timed_distance}), SUM({DailyTotal.columns.duration}) FROM daily",
+            filter
+        )
+        if not t_s:
             raise ValueError("no entries in database")
         return s_km / (t_s / 3600)
 
     @classmethod
-    def get_total_rides(cls, db: Database) -> int:
-        with closing(db.cursor()) as cursor:
-            return cursor.execute(f"SELECT SUM({cls.columns.segments}) FROM {cls.table}").fetchone()[0]
+    def get_total_rides(cls, db: Database, filter: RideFilter=None) -> int:
+        return cls._query_daily(db, f"SELECT SUM({DailyTotal.columns.n_rides}) FROM daily", filter)[0]
 
     @classmethod
-    def get_timestamps(cls, db: Database) -> list[datetime]:
+    def _get_streaks(cls, db: Database, period: str, length: int, filter: RideFilter=None) -> Counter[date]:
+        """
+        get lengths of streaks of consecutive periods with rides mapped to the start of the last period
+        of the streaks. `period` is an SQL expression that maps `day` to the first day of its period,
+        `length` the number of days of a period
+        """
+        # consecutive periods have the same difference between their number and their rank
+        daily, params = DailyTotal.daily_cte(filter)
         with closing(db.cursor()) as cursor:
-            stamps = cursor.execute(
-                f"SELECT {cls.columns.timestamp} FROM {cls.table} ORDER BY {cls.columns.timestamp} DESC"
-            ).fetchall()
-        return [cls.columns.timestamp.field.parse(s) for s, in stamps]
+            rows = cursor.execute(f"""
+                WITH {daily}
+                SELECT MAX(period), COUNT(*) FROM (
+                    SELECT
+                        period,
+                        CAST(julianday(period) AS INTEGER) / {length} - ROW_NUMBER() OVER (ORDER BY period) AS island
+                    FROM (SELECT DISTINCT {period} AS period FROM daily)
+                )
+                GROUP BY island
+                HAVING COUNT(*) > 1
+                ORDER BY MAX(period) DESC
+            """, params).fetchall()
+        return Counter({date.fromisoformat(end): n for end, n in rows})
 
     @classmethod
-    def get_streaks(cls, db: Database) -> Counter[datetime]:
+    def get_streaks(cls, db: Database, filter: RideFilter=None) -> Counter[date]:
         """
         get lengths of streaks of consecutive ride-days mapped to the end-date of the streaks
         {end_date: length_of_streak}
         """
-        timestamps = cls.get_timestamps(db)
-        dates = []
-        for stamp in timestamps:
-            date = stamp.date()
-            if date not in dates:
-                # no duplicates
-                dates.append(date)
-        diffs = [(d1 - d2).days for d1, d2 in zip(dates, dates[1:])]
-        streaks = Counter()
-        on_streak = False
-        current_streak_date = None
-        for diff, date in zip(diffs + [0], dates):
-            if diff == 1:
-                if not on_streak:
-                    on_streak = True
-                    current_streak_date = date
-                streaks[current_streak_date] += 1
-            elif on_streak:
-                # count one more because the diff is one shorter than the # of days
-                streaks[current_streak_date] += 1
-                on_streak = False
-        return streaks
-
-    @classmethod
-    def get_summary(cls, db: Database) -> dict:
-        d_tot = cls.get_total_distance(db)
-        d_max, d_max_timestamp = cls.get_max_distance_entry(db)
-        s_max_day, s_max_day_date = cls.get_max_distance_by_day(db)
-        s_max, s_max_timestamp = cls.get_max_speed_entry(db)
-        s_avg = cls.get_average_speed(db)
-        n = cls.get_total_rides(db)
-        streaks = cls.get_streaks(db)
-        longest_streaks = streaks.most_common(1)
+        return cls._get_streaks(db, period=str(DailyTotal.columns.day), length=1, filter=filter)
+
+    @classmethod
+    def get_weekly_streaks(cls, db: Database, filter: RideFilter=None) -> Counter[date]:
+        """
+        get lengths of streaks of consecutive weeks with rides mapped to the monday of the last week
+        of the streaks {monday: length_of_streak}
+        """
+        return cls._get_streaks(db, period=DailyTotal.period_start("week"), length=7, filter=filter)
+
+    @classmethod
+    def get_report(cls, db: Database, by: str, filter: RideFilter=None, compare: bool=False) -> list[dict]:
+        """
+        return the totals per week, month or year (`by`) of the rides matching filter, oldest first.
+        with compare, add the distance and number of rides of the same period one year before
+        (52 weeks before for weeks)
+        """
+        c = DailyTotal.columns
+        periods = f"""
+            SELECT
+                {DailyTotal.period_start(by)} AS start,
+                SUM({c.distance}) AS distance,
+                TOTAL({c.duration}) AS duration,
+                TOTAL({c.timed_distance}) AS timed_distance,
+                SUM({c.n_rides}) AS n_rides,
+                MAX({c.max_distance}) AS longest
+            FROM {{}}
+            GROUP BY start
+        """
+        daily, params = DailyTotal.daily_cte(filter)
+        ctes = [daily, f"periods AS ({periods.format('daily')})"]
+        previous = "NULL, NULL"
+        join = ""
+        if compare:
+            back = (lambda day: day - timedelta(weeks=52)) if by == "week" else RideFilter.year_before
+            previous_daily, previous_params = DailyTotal.daily_cte(
+                filter.shifted(back) if filter else None, name="previous_daily"
+            )
+            ctes += [previous_daily, f"previous_periods AS ({periods.format('previous_daily')})"]
+            params += previous_params
+            previous = "previous.distance, previous.n_rides"
+            join = (
+                "LEFT JOIN previous_periods AS previous ON previous.start = "
+                f"DATE(period.start, '{'-364 days' if by == 'week' else '-1 year'}')"
+            )
+        with closing(db.cursor()) as cursor:
+            rows = cursor.execute(f"""
+                WITH {", ".join(ctes)}
+                SELECT
+                    period.start, period.distance, period.duration, period.timed_distance,
+                    period.n_rides, period.longest, {previous}
+                FROM periods AS period
+                {join}
+                ORDER BY period.start
+            """, params).fetchall()
+        return [
+            {
+                "start": date.fromisoformat(start),
+                "distance": distance,
+                "duration": timedelta(seconds=duration),
+                "n_rides": n_rides,
+                "speed": timed_distance / (duration / 3600) if duration else None,
+                "longest": longest,
+                "previous_distance": previous_distance,
+                "previous_n_rides": previous_n_rides,
+            }
+            for start, distance, duration, timed_distance, n_rides, longest, previous_distance, previous_n_rides
+            in rows
+        ]
+
+    @classmethod
+    def get_current_streak(cls, db: Database, day: date=None) -> int:
+        """
+        return the number of consecutive ride-days that end on day (default: today).
+        walks back from day along the daily totals, so it does not depend on the size of the history
+        """
+        day = day or datetime.today().date()
+        with closing(db.cursor()) as cursor:
+            return cursor.execute(f"""
+                WITH RECURSIVE streak(day) AS (
+                    SELECT {DailyTotal.columns.day} FROM {DailyTotal.table} WHERE {DailyTotal.columns.day} = ?
+                    UNION ALL
+                    SELECT totals.{DailyTotal.columns.day} FROM {DailyTotal.table} AS totals, streak
+                    WHERE totals.{DailyTotal.columns.day} = DATE(streak.day, '-1 day')
+                )
+                SELECT COUNT(*) FROM streak
+            """, (day.isoformat(),)).fetchone()[0]
+
+    @classmethod
+    def get_summary(cls, db: Database, filter: RideFilter=None) -> dict:
+        d_tot = cls.get_total_distance(db, filter)
+        if d_tot is None:
+            raise ValueError("no matching entries in database")
+        d_max, d_max_timestamp = cls.get_max_distance_entry(db, filter)
+        s_max_day, s_max_day_date = cls.get_max_distance_by_day(db, filter)
+        s_max, s_max_timestamp = cls.get_max_speed_entry(db, filter)
+        s_avg = cls.get_average_speed(db, filter)
+        n = cls.get_total_rides(db, filter)
+        longest_streaks = cls.get_streaks(db, filter).most_common(1)
+        longest_weekly_streaks = cls.get_weekly_streaks(db, filter).most_common(1)
         return {
             "distance_tot": round(d_tot, 2),
             "distance_max": round(d_max, 2),
@@ -408,32 +1088,887 @@ class Ride(Model):
             "speed_mean": round(s_avg, 1),
             "n_rides": n,
             "longest_streaks": longest_streaks,
+            "longest_weekly_streaks": longest_weekly_streaks,
+        }
+
+    @classmethod
+    def _missing_track_data_query(cls, selected: str) -> str:
+        return (
+            f"SELECT {selected} FROM {cls.table} "
+            f"LEFT JOIN {RideMetrics.table} ON {RideMetrics.table}.{RideMetrics.columns.ride_id} = {cls.table}.id "
+            f"LEFT JOIN {TrackPoints.table} ON {TrackPoints.table}.{TrackPoints.columns.ride_id} = {cls.table}.id "
+            f"WHERE {cls.columns.gpx_id} IS NOT NULL "
+            f"AND ({RideMetrics.table}.id IS NULL OR {TrackPoints.table}.id IS NULL "
+            # points that were stored before their segments were
+            f"OR ({cls.columns.segments} > 1 AND {TrackPoints.table}.{TrackPoints.columns.segment_sizes} IS NULL))"
+        )
+
+    @classmethod
+    def count_missing_track_data(cls, db: Database) -> int:
+        """
+        return the number of rides with gpx data but without metrics or track points
+        (or without the sizes of the segments of their points)
+        """
+        with closing(db.cursor()) as cursor:
+            return cursor.execute(cls._missing_track_data_query("COUNT(*)")).fetchone()[0]
+
+    @classmethod
+    def backfill_track_data(cls, db: Database, batch_size: int=20, simplify: Simplification=None) -> Iterator[int]:
+        """
+        compute metrics and track points (simplified with simplify) of all rides that have gpx data
+        but miss either of them, in batches of batch_size. yields the number of rides processed after every batch.
+        every batch is committed separately, so an interrupted backfill resumes where it stopped
+        """
+        selected = ", ".join(f"{cls.table}.{column}" for column in cls.columns)
+        while True:
+            with closing(db.cursor()) as cursor:
+                rows = cursor.execute(
+                    f"{cls._missing_track_data_query(selected)} ORDER BY {cls.columns.gpx_id} LIMIT ?",
+                    (batch_size,)
+                ).fetchall()
+            if not rows:
+                return
+            parsed = {}  # rides from multi-track files share their gpx
+            with db.transaction():
+                for row in rows:
+                    ride = cls.from_row(db, row)
+                    if ride.gpx_id not in parsed:
+                        parsed[ride.gpx_id] = parse_gpx(ride.gpx)
+                    ride.update_track_data(ride.get_track(parsed[ride.gpx_id]), simplify)
+            yield len(rows)
+
+    @classmethod
+    def from_gpx(
+        cls,
+        db: Database,
+        gpx_path: Path,
+        on_duplicate: str="skip",
+        parser: str="gpxpy",
+        simplify: Simplification=None,
+        engine: str=None,
+    ) -> list[Self]:
+        """
+        read and parse gpx_path and create new entries from its contents. files that were imported
+        before are not parsed again, tracks that were imported before from another file are skipped
+        or update their ride (on_duplicate="skip" or "update"). the stored track points are
+        simplified with simplify, the metrics are computed with engine (see `ParsedGpx.parse`).
+        returns the new and updated rides
+        """
+        raw = read_gpx(gpx_path)
+        if cls.is_imported(db, raw):
+            return []
+        return cls.from_parsed_gpx(db, ParsedGpx.parse(raw, parser, simplify, engine), on_duplicate)
+
+    @classmethod
+    def is_imported(cls, db: Database, raw: str) -> bool:
+        """
+        whether rides were created from or updated with the gpx file with the content raw. files
+        whose tracks were all skipped because they had been imported from other files don't count
+        """
+        blob = f"SELECT id FROM {GpxBlob.table} WHERE {GpxBlob.columns.hash} = ?"
+        query = f"SELECT 1 FROM {cls.table} WHERE {cls.columns.gpx_id} = ({blob})"
+        with closing(db.cursor()) as cursor:
+            return bool(cursor.execute(f"SELECT EXISTS ({query})", (GpxBlob.hash_of(raw),)).fetchone()[0])
+
+    @classmethod
+    def get_by_fingerprint(cls, db: Database, timestamp: datetime, distance: float) -> Self | None:
+        """
+        return the ride from a gpx file with the same start time and distance (rounded to 10 m),
+        if there is one. the unique index rides_gpx_fingerprint allows only one such ride, except for
+        copies that were imported before it existed (then the first one is returned)
+        """
+        c = cls.columns
+        with closing(db.cursor()) as cursor:
+            row = cursor.execute(
+                f"{cls.select_all_query()} WHERE {c.gpx_id} IS NOT NULL "
+                f"AND {c.timestamp} = ? AND ROUND({c.distance}, 2) = ROUND(?, 2) ORDER BY id LIMIT 1",
+                (c.timestamp.field.serialize(timestamp), distance)
+            ).fetchone()
+        return cls.from_row(db, row) if row else None
+
+    @classmethod
+    def from_parsed_gpx(cls, db: Database, parsed: ParsedGpx, on_duplicate: str="skip") -> list[Self]:
+        """
+        create new entries from the tracks of a gpx file that was read with `ParsedGpx.read`.
+        see `from_gpx` for on_duplicate. the file is only stored if a ride refers to it
+        """
+        if on_duplicate not in ("skip", "update"):
+            raise ValueError(f"on_duplicate must be 'skip' or 'update', not {on_duplicate!r}")
+        # checked before anything is written, so that importing other files can go on
+        if any(track["ride"]["timestamp"] is None for track in parsed.tracks):
+            raise ValueError("gpx file has a track without times")
+        with db.transaction():
+            try:
+                gpx_id = GpxBlob.get_by_hash(db, GpxBlob.hash_of(parsed.raw)).pk
+            except KeyError:
+                gpx_id = None
+            new, updated, replaced_gpx_ids = [], [], set()
+            # the fingerprints of the tracks of this file so far (see `get_by_fingerprint`),
+            # a file can contain the same track twice
+            fingerprints = set()
+            for track in parsed.tracks:
+                fingerprint = (track["ride"]["timestamp"], round(track["ride"]["distance"], 2))
+                if fingerprint in fingerprints:
+                    continue
+                fingerprints.add(fingerprint)
+                ride = cls.get_by_fingerprint(db, track["ride"]["timestamp"], track["ride"]["distance"])
+                if ride is None:
+                    new.append((cls(db=db, **track["ride"]), track))
+                elif on_duplicate == "update" and ride.gpx_id != gpx_id:
+                    replaced_gpx_ids.add(ride.gpx_id)
+                    for name, value in track["ride"].items():
+                        setattr(ride, name, value)
+                    updated.append((ride, track))
+            if not new and not updated:
+                return []
+            gpx_id = GpxBlob.store(db, parsed.raw)
+            for ride, _ in new + updated:
+                ride.gpx_id = gpx_id
+            cls.bulk_save(db, [ride for ride, _ in new + updated])
+            for replaced in replaced_gpx_ids:
+                GpxBlob.delete_if_unused(db, replaced)
+            RideMetrics.add_rows(db, [track["metrics"] | {"ride_id": ride.pk} for ride, track in new])
+            TrackPoints.add_rows(db, [track["points"] | {"ride_id": ride.pk} for ride, track in new])
+            for ride, track in updated:
+                RideMetrics.store(db, ride.pk, track["metrics"])
+                TrackPoints.store(db, ride.pk, track["points"])
+        return [ride for ride, _ in new + updated]
+
+    @classmethod
+    def import_gpx_files(
+        cls,
+        db: Database,
+        paths: list[Path | zipfile.Path],
+        jobs: int=None,
+        batch_size: int=50,
+        on_duplicate: str="skip",
+        parser: str="gpxpy",
+        simplify: Simplification=None,
+        engine: str=None,
+    ) -> Iterator[tuple[Path, list[Self] | Exception]]:
+        """
+        read paths in `jobs` worker processes (default: one per CPU) and create new entries from them
+        like `from_gpx`. yields every path with its new and updated rides, or with the exception that
+        reading or saving it raised, in the order of paths. files that were imported before are only hashed.
+        only this process writes to the database, in one transaction per batch_size files. the changes
+        of a file that can't be saved are rolled back without the rest of its batch
+        """
+        results = _read_gpx_files(
+            paths,
+            jobs or os.cpu_count() or 1,
+            skip=lambda raw: cls.is_imported(db, raw),
+            parser=parser,
+            simplify=simplify,
+            engine=engine,
+        )
+        while batch := list(islice(results, batch_size)):
+            saved = []
+            with db.transaction():
+                for path, parsed in batch:
+                    if parsed is None:
+                        parsed = []
+                    elif not isinstance(parsed, Exception):
+                        try:
+                            with db.savepoint():
+                                parsed = cls.from_parsed_gpx(db, parsed, on_duplicate)
+                        except (sqlite3.Error, ValueError) as e:
+                            parsed = e
+                    saved.append((path, parsed))
+            yield from saved
+
+
+def _read_gpx_files(
+    paths: list[Path | zipfile.Path],
+    jobs: int,
+    skip: Callable[[str], bool],
+    parser: str,
+    simplify: Simplification | None,
+    engine: str | None,
+) -> Iterator[tuple[Path, ParsedGpx | Exception | None]]:
+    """
+    read paths (see `read_gpx`) and parse them with `ParsedGpx.parse` in jobs processes, in order.
+    files for which skip(content) is true are not parsed and yield None
+    """
+    if jobs == 1 or len(paths) == 1:
+        for path in paths:
+            try:
+                raw = read_gpx(path)
+                yield path, None if skip(raw) else ParsedGpx.parse(raw, parser, simplify, engine)
+            except Exception as e:
+                yield path, e
+        return
+    # multiprocessing is only imported when it's needed, like gpxpy
+    from concurrent.futures import Future, ProcessPoolExecutor
+
+    def result(path: Path, pending: Future | Exception | None) -> tuple[Path, ParsedGpx | Exception | None]:
+        if isinstance(pending, Future):
+            try:
+                return path, pending.result()
+            except Exception as e:
+                return path, e
+        return path, pending
+
+    with ProcessPoolExecutor(jobs) as executor:
+        # only a few files per worker are parsed ahead, so that parsed files don't pile up
+        # in memory while the database is written
+        queue = deque()
+        for path in paths:
+            try:
+                raw = read_gpx(path)
+                queue.append((path, None if skip(raw) else executor.submit(_parse_gpx_in_worker, raw, parser, simplify, engine)))
+            except Exception as e:
+                queue.append((path, e))
+            if len(queue) > 2 * jobs:
+                yield result(*queue.popleft())
+        for path, pending in queue:
+            yield result(path, pending)
+
+
+def _parse_gpx_in_worker(raw: str, parser: str, simplify: Simplification | None, engine: str | None) -> ParsedGpx:
+    """`ParsedGpx.parse` for worker processes"""
+    try:
+        return ParsedGpx.parse(raw, parser, simplify, engine)
+    except Exception as e:
+        # exceptions are pickled to be sent back, which not all of gpxpy's exceptions survive
+        raise ValueError(str(e) or type(e).__name__) from None
+
+
+# the parsers that ParsedGpx can use
+PARSERS = ("gpxpy", "stream")
+# the ways `RideMetrics.compute` and `ParsedGpx.parse` can compute metrics: numpy (see `kmtracker.vectorized`)
+# or gpxpy's loops, which the numpy engine is checked against (loadgpx --metrics-engine)
+METRICS_ENGINES = ("numpy", "gpxpy")
+DEFAULT_METRICS_ENGINE = "numpy"
+
+
+class Simplification:
+    """
+    how the points of gpx tracks are simplified before they are stored: at most one point per interval
+    seconds is kept and of those only the points that are needed to stay within tolerance meters
+    of the track. 0 disables either. the metrics of rides are computed from all points
+    """
+    __slots__ = ("tolerance", "interval")
+
+    def __init__(self, tolerance: float=0, interval: float=0):
+        if tolerance < 0 or interval < 0:
+            raise ValueError("tolerance and interval of the simplification can't be negative")
+        self.tolerance = tolerance
+        self.interval = interval
+
+    def __bool__(self) -> bool:
+        return self.tolerance > 0 or self.interval > 0
+
+    def apply(self, points: dict) -> dict:
+        """
+        simplify points (see `TrackPoints.compute`). the result also has the number of recorded points
+        and how much the length and the elevation gain of the simplified track differ (relative)
+        """
+        import numpy
+        from kmtracker import vectorized
+        keep = vectorized.simplified(
+            points["lat"], points["lon"], points["ele"], points["time"], self.tolerance, self.interval
+        )
+        simplified = {
+            name: array("d", numpy.frombuffer(points[name], dtype="d")[keep].tobytes())
+            for name in ("lat", "lon", "ele", "time")
         }
+        if points.get("segment_sizes") is not None:
+            # the points that are kept of every segment
+            sizes = numpy.asarray(points["segment_sizes"], dtype=numpy.int64)
+            segment = numpy.repeat(numpy.arange(len(sizes)), sizes)
+            kept = numpy.bincount(segment[keep], minlength=len(sizes))
+            simplified["segment_sizes"] = array("d", kept.astype("d").tobytes())
+
+        def error(simplified_value: float, recorded_value: float) -> float:
+            return simplified_value / recorded_value - 1 if recorded_value else 0.
+
+        recorded_ele = numpy.frombuffer(points["ele"], dtype="d")
+        return simplified | {
+            "n_points": len(simplified["lat"]),
+            "n_recorded": points["n_points"],
+            "distance_error": error(
+                vectorized.path_length(simplified["lat"], simplified["lon"], simplified["ele"]),
+                vectorized.path_length(points["lat"], points["lon"], points["ele"]),
+            ),
+            "uphill_error": error(
+                vectorized.uphill_downhill(numpy.frombuffer(simplified["ele"], dtype="d"))[0],
+                vectorized.uphill_downhill(recorded_ele)[0],
+            ),
+        }
+
+
+class ParsedGpx:
+    """
+    the contents of a gpx file with everything that is computed from its tracks. parsing it
+    doesn't need the database, so it can run in worker processes (see `Ride.import_gpx_files`)
+    """
+    __slots__ = ("raw", "tracks")
+
+    def __init__(self, raw: str, tracks: list[dict]):
+        self.raw = raw
+        # per track a dict with the values of the ride, its metrics and its points
+        self.tracks = tracks
 
     @classmethod
-    def from_gpx(cls, db: Database, gpx_path: Path) -> list[Self]:
+    def read(
+        cls, gpx_path: Path | zipfile.Path, parser: str="gpxpy", simplify: Simplification=None, engine: str=None
+    ) -> Self:
+        return cls.parse(read_gpx(gpx_path), parser, simplify, engine)
+
+    @classmethod
+    def parse(cls, raw: str, parser: str="gpxpy", simplify: Simplification=None, engine: str=None) -> Self:
         """
-        read and parse gpx_path and create new entries from its contents
+        parse raw with one of PARSERS: gpxpy builds the whole document in memory,
+        stream (see `kmtracker.gpxstream`) computes the same values while reading it.
+        the metrics are computed with one of METRICS_ENGINES (default: `DEFAULT_METRICS_ENGINE`),
+        with gpxpy the stream parser computes them on the fly.
+        the points of the tracks are simplified with simplify after the metrics are computed
         """
-        with open(gpx_path) as f:
-            raw_gpx = f.read()
-            gpx = gpxpy.parse(raw_gpx)
-        new = []
+        engine = engine or DEFAULT_METRICS_ENGINE
+        if engine not in METRICS_ENGINES:
+            raise ValueError(f"unknown metrics engine: {engine!r}")
+        if parser == "gpxpy":
+            parsed = cls._parse_gpxpy(raw, engine)
+        elif parser == "stream":
+            parsed = cls._parse_stream(raw, engine)
+        else:
+            raise ValueError(f"unknown gpx parser: {parser!r}")
+        if simplify:
+            for track in parsed.tracks:
+                track["points"] = simplify.apply(track["points"])
+        return parsed
+
+    @classmethod
+    def _parse_gpxpy(cls, raw: str, engine: str) -> Self:
+        gpx = parse_gpx(raw)
+        tracks = []
         for track in gpx.tracks:
-            moving_data = track.get_moving_data()
-            time_bounds = track.get_time_bounds()
-            ride = cls(
-                db=db,
-                distance=moving_data.moving_distance / 1000,
-                timestamp=time_bounds.start_time,
-                duration=timedelta(seconds=moving_data.moving_time),
-                comment=track.name,
-                segments=len(track.segments),
-                gpx=raw_gpx,
+            points = TrackPoints.compute(track)
+            metrics = RideMetrics.compute(track, points, engine)
+            tracks.append({
+                "ride": {
+                    "distance": metrics["moving_distance"],
+                    "timestamp": track.get_time_bounds().start_time,
+                    "duration": metrics["moving_time"],
+                    "comment": track.name,
+                    "segments": len(track.segments),
+                },
+                "metrics": metrics,
+                "points": points,
+            })
+        return cls(raw, tracks)
+
+    @classmethod
+    def _parse_stream(cls, raw: str, engine: str) -> Self:
+        from kmtracker import gpxstream
+        vectorized = engine == "numpy"
+        if vectorized:
+            from kmtracker.vectorized import track_metrics
+        tracks = []
+        for track in gpxstream.read_tracks(gpxstream.StringSource(raw), metrics=not vectorized):
+            if vectorized:
+                values = track_metrics(track.lat, track.lon, track.ele, track.time, track.segment_sizes)
+            else:
+                values = {
+                    "moving_time": track.moving_time,
+                    "stopped_time": track.stopped_time,
+                    "moving_distance": track.moving_distance,
+                    "max_speed": track.max_speed,
+                    "uphill": track.uphill,
+                    "downhill": track.downhill,
+                    "bounds": track.bounds,
+                    "n_points": track.n_points,
+                }
+            metrics = RideMetrics.values(**values)
+            tracks.append({
+                "ride": {
+                    "distance": metrics["moving_distance"],
+                    "timestamp": track.start_time,
+                    "duration": metrics["moving_time"],
+                    "comment": track.name,
+                    "segments": track.n_segments,
+                },
+                "metrics": metrics,
+                "points": {
+                    "n_points": track.n_points, "lat": track.lat, "lon": track.lon, "ele": track.ele, "time": track.time,
+                    "segment_sizes": array("d", track.segment_sizes),
+                },
+            })
+        return cls(raw, tracks)
+
+
+class RideMetrics(Model):
+    """
+    metrics of a ride, computed once from its gpx data
+    """
+    table = "ride_metrics"
+
+    class columns(ColumnEnum):
+        pk = Field("id")
+        ride_id = Field("ride_id")
+        moving_time = TimedeltaField("moving_time_s", display_name="time in motion")
+        stopped_time = TimedeltaField("stopped_time_s", display_name="time at rest")
+        moving_distance = FloatField("moving_distance_km", display_name="distance in motion (km)")
+        max_speed = FloatField("max_speed_kmh", display_name="maximum speed (km/h)")
+        uphill = FloatField("uphill_m", display_name="uphill (m)")
+        downhill = FloatField("downhill_m", display_name="downhill (m)")
+        min_lat = FloatField("min_lat")
+        max_lat = FloatField("max_lat")
+        min_lon = FloatField("min_lon")
+        max_lon = FloatField("max_lon")
+        n_points = Field("n_points", display_name="points")
+
+    @property
+    def moving_speed(self) -> float | None:
+        if self.moving_distance and self.moving_time:
+            return self.moving_distance / self.moving_time.total_seconds() * 3600
+
+    @staticmethod
+    def values(
+        moving_time: float,
+        stopped_time: float,
+        moving_distance: float,
+        max_speed: float,
+        uphill: float,
+        downhill: float,
+        bounds: tuple[float, float, float, float] | None,
+        n_points: int,
+    ) -> dict:
+        """
+        the metrics as attributes from seconds, meters, meters per second
+        and bounds (min_lat, max_lat, min_lon, max_lon)
+        """
+        min_lat, max_lat, min_lon, max_lon = bounds or (None, None, None, None)
+        return {
+            "moving_time": timedelta(seconds=moving_time),
+            "stopped_time": timedelta(seconds=stopped_time),
+            "moving_distance": moving_distance / 1000,
+            "max_speed": max_speed * 3.6,
+            "uphill": uphill,
+            "downhill": downhill,
+            "min_lat": min_lat,
+            "max_lat": max_lat,
+            "min_lon": min_lon,
+            "max_lon": max_lon,
+            "n_points": n_points,
+        }
+
+    @classmethod
+    def compute(
+        cls,
+        gpx: gpxpy.gpx.GPX | gpxpy.gpx.GPXTrack,
+        points: dict=None,
+        engine: str=None,
+    ) -> dict:
+        """
+        compute the metrics of a whole gpx file or of a single track with one of METRICS_ENGINES
+        (default: `DEFAULT_METRICS_ENGINE`). the numpy engine computes them from points
+        (see `TrackPoints.compute`), which are extracted from gpx if they are not passed
+        """
+        engine = engine or DEFAULT_METRICS_ENGINE
+        if engine == "numpy":
+            from kmtracker import vectorized
+            points = points or TrackPoints.compute(gpx)
+            segments = gpx.segments if hasattr(gpx, "segments") else [s for t in gpx.tracks for s in t.segments]
+            return cls.values(**vectorized.track_metrics(
+                points["lat"], points["lon"], points["ele"], points["time"],
+                [len(segment.points) for segment in segments],
+            ))
+        if engine != "gpxpy":
+            raise ValueError(f"unknown metrics engine: {engine!r}")
+        moving_data = gpx.get_moving_data()
+        elevation = gpx.get_uphill_downhill()
+        bounds = gpx.get_bounds()
+        return cls.values(
+            moving_data.moving_time,
+            moving_data.stopped_time,
+            moving_data.moving_distance,
+            moving_data.max_speed,
+            elevation.uphill,
+            elevation.downhill,
+            (bounds.min_latitude, bounds.max_latitude, bounds.min_longitude, bounds.max_longitude) if bounds else None,
+            gpx.get_points_no(),
+        )
+
+    @classmethod
+    def get_by_ride(cls, db: Database, ride_id: int) -> Self:
+        with closing(db.cursor()) as cursor:
+            row = cursor.execute(
+                f"{cls.select_all_query()} WHERE {cls.columns.ride_id} = ?",
+                (ride_id,)
+            ).fetchone()
+        if not row:
+            raise KeyError(f"no metrics for ride with ID {ride_id}")
+        return cls.from_row(db, row)
+
+    @classmethod
+    def update(cls, db: Database, ride_id: int, gpx: gpxpy.gpx.GPX | gpxpy.gpx.GPXTrack) -> Self:
+        """compute the metrics of gpx and save them as the metrics of the ride with ride_id"""
+        return cls.store(db, ride_id, cls.compute(gpx))
+
+    @classmethod
+    def store(cls, db: Database, ride_id: int, values: dict) -> Self:
+        """save values (see `compute`) as the metrics of the ride with ride_id"""
+        try:
+            metrics = cls.get_by_ride(db, ride_id)
+        except KeyError:
+            metrics = cls(db, ride_id=ride_id)
+        for name, value in values.items():
+            setattr(metrics, name, value)
+        metrics.save()
+        return metrics
+
+
+class DailyTotal(Model):
+    """
+    rides aggregated by day. the table is kept up to date by triggers on the rides table
+    """
+    table = "daily_totals"
+
+    class columns(ColumnEnum):
+        day = Field("day", display_name="Date")
+        distance = FloatField("distance_km", display_name="Distance (km)")
+        timed_distance = FloatField("timed_distance_km", display_name="Distance with duration (km)")
+        duration = TimedeltaField("duration_s", display_name="Duration (hh:mm:ss)")
+        n_rides = Field("n_rides", display_name="Rides")
+        max_distance = FloatField("max_distance_km", display_name="Longest ride (km)")
+        max_speed = FloatField("max_speed_kmh", display_name="Fastest ride (km/h)")
+
+    @classmethod
+    def aggregate_query(cls, where: str="") -> str:
+        """aggregate the rides (matching the WHERE clause where) by day, in the order of columns"""
+        return f"""
+            SELECT
+                DATE({Ride.columns.timestamp}) AS {cls.columns.day},
+                SUM({Ride.columns.distance}) AS {cls.columns.distance},
+                TOTAL(CASE WHEN {Ride.columns.duration} IS NOT NULL THEN {Ride.columns.distance} END)
+                    AS {cls.columns.timed_distance},
+                TOTAL({Ride.columns.duration}) AS {cls.columns.duration},
+                COALESCE(SUM({Ride.columns.segments}), 0) AS {cls.columns.n_rides},
+                MAX({Ride.columns.distance} / {Ride.columns.segments}) AS {cls.columns.max_distance},
+                MAX({Ride.columns.distance} / {Ride.columns.duration} * 3600) AS {cls.columns.max_speed}
+            FROM {Ride.table}
+            {where}
+            GROUP BY DATE({Ride.columns.timestamp})
+        """
+
+    @classmethod
+    def daily_cte(cls, filter: RideFilter | None, name: str="daily") -> tuple[str, list]:
+        """
+        return a common table expression (for a WITH clause) that defines `name` as the daily totals
+        of the rides matching filter, and its parameters. filters on dates only read this table,
+        others aggregate the matching rides
+        """
+        if filter is None or filter.only_dates():
+            conditions, params = filter.day_conditions() if filter else ([], [])
+            return f"{name} AS (SELECT * FROM {cls.table} {where(conditions)})", params
+        conditions, params = filter.conditions()
+        return f"{name} AS ({cls.aggregate_query(where(conditions))})", params
+
+    @classmethod
+    def get_distances(cls, db: Database, filter: RideFilter=None) -> list[tuple[str, float]]:
+        """the total distance per day (as ISO date) of the rides that match filter, by day"""
+        cte, params = cls.daily_cte(filter)
+        with closing(db.cursor()) as cursor:
+            return [
+                tuple(row) for row in cursor.execute(
+                    f"WITH {cte} SELECT {cls.columns.day}, {cls.columns.distance} FROM daily ORDER BY {cls.columns.day}",
+                    params
+                )
+            ]
+
+    @classmethod
+    def period_start(cls, by: str) -> str:
+        """SQL expression that maps `day` to the first day of its week (a monday), month or year"""
+        day = cls.columns.day
+        match by:
+            case "week":
+                return f"DATE({day}, '-' || ((CAST(strftime('%w', {day}) AS INTEGER) + 6) % 7) || ' days')"
+            case "month":
+                return f"DATE({day}, 'start of month')"
+            case "year":
+                return f"DATE({day}, 'start of year')"
+        raise ValueError(f"unknown period: {by!r}")
+
+    @classmethod
+    def check(cls, db: Database) -> int:
+        """return the number of days for which the table does not match the rides"""
+        # sums may differ in the last digits depending on the order of summation
+        rounded = ", ".join(
+            f"ROUND({column}, 6)" if isinstance(column.field, (FloatField, TimedeltaField)) else str(column)
+            for column in cls.columns
+        )
+        names = ", ".join(str(column) for column in cls.columns)
+        with closing(db.cursor()) as cursor:
+            return cursor.execute(f"""
+                WITH expected({names}) AS ({cls.aggregate_query()})
+                SELECT COUNT(DISTINCT {cls.columns.day}) FROM (
+                    SELECT * FROM (SELECT {rounded} FROM expected EXCEPT SELECT {rounded} FROM {cls.table})
+                    UNION ALL
+                    SELECT * FROM (SELECT {rounded} FROM {cls.table} EXCEPT SELECT {rounded} FROM expected)
+                )
+            """).fetchone()[0]
+
+    @classmethod
+    def rebuild(cls, db: Database):
+        """recompute the whole table from the rides"""
+        with closing(db.cursor()) as cursor:
+            cursor.execute(f"DELETE FROM {cls.table}")
+            cursor.execute(f"INSERT INTO {cls.table} {cls.aggregate_query()}")
+        db.commit()
+
+
+class GpxBlob(Model):
+    """
+    raw gpx files, compressed and stored once per content hash (sha256 of the utf-8 encoded file)
+    """
+    table = "gpx_blobs"
+
+    class columns(ColumnEnum):
+        pk = Field("id")
+        hash = Field("hash")
+        data = CompressedTextField("data", deferred=True)
+
+    @staticmethod
+    def hash_of(raw: str) -> str:
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get_by_hash(cls, db: Database, hash: str) -> Self:
+        with closing(db.cursor()) as cursor:
+            row = cursor.execute(
+                f"{cls.select_all_query()} WHERE {cls.columns.hash} = ?",
+                (hash,)
+            ).fetchone()
+        if not row:
+            raise KeyError(f"no gpx file with hash {hash}")
+        return cls.from_row(db, row)
+
+    @classmethod
+    def store(cls, db: Database, raw: str) -> int:
+        """
+        add raw to the blob store unless an identical file is already stored.
+        returns the ID of the blob
+        """
+        hash = cls.hash_of(raw)
+        try:
+            return cls.get_by_hash(db, hash).pk
+        except KeyError:
+            blob = cls(db, hash=hash, data=raw)
+            blob.save()
+            return blob.pk
+
+    @classmethod
+    def delete_if_unused(cls, db: Database, id: int):
+        """delete the blob with id unless a ride refers to it"""
+        with closing(db.cursor()) as cursor:
+            cursor.execute(
+                f"DELETE FROM {cls.table} WHERE id = ? "
+                f"AND NOT EXISTS (SELECT 1 FROM {Ride.table} WHERE {Ride.columns.gpx_id} = ?)",
+                (id, id)
             )
-            ride.save()
-            new.append(ride)
-        return new
+        db.commit()
+
+
+class TrackPoints(Model):
+    """
+    the points of a ride's gpx track as packed arrays of doubles, one per coordinate.
+    missing elevations and times are NaN, times are seconds since the epoch.
+    tracks that were simplified (see `Simplification`) have the number of recorded points and
+    how much the length and elevation gain of the stored track differ from the recorded one
+    """
+    table = "track_points"
+
+    class columns(ColumnEnum):
+        pk = Field("id")
+        ride_id = Field("ride_id")
+        n_points = Field("n_points")
+        lat = PackedArrayField("lat")
+        lon = PackedArrayField("lon")
+        ele = PackedArrayField("ele")
+        time = PackedArrayField("time")
+        n_recorded = Field("n_recorded", display_name="recorded points")
+        distance_error = FloatField("distance_error", display_name="error of the distance")
+        uphill_error = FloatField("uphill_error", display_name="error of the uphill")
+        segment_sizes = PackedArrayField("segment_sizes")
+
+    @staticmethod
+    def compute(gpx: gpxpy.gpx.GPX | gpxpy.gpx.GPXTrack) -> dict:
+        """extract the points of a whole gpx file or of a single track and the number of points per segment"""
+        lat, lon, ele, time = array("d"), array("d"), array("d"), array("d")
+        segment_sizes = array("d")
+        segments = gpx.segments if hasattr(gpx, "segments") else [s for t in gpx.tracks for s in t.segments]
+        for segment in segments:
+            for point in segment.points:
+                lat.append(point.latitude)
+                lon.append(point.longitude)
+                ele.append(point.elevation if point.elevation is not None else math.nan)
+                time.append(point.time.timestamp() if point.time else math.nan)
+            segment_sizes.append(len(segment.points))
+        return {"n_points": len(lat), "lat": lat, "lon": lon, "ele": ele, "time": time, "segment_sizes": segment_sizes}
+
+    @classmethod
+    def get_by_ride(cls, db: Database, ride_id: int) -> Self:
+        with closing(db.cursor()) as cursor:
+            row = cursor.execute(
+                f"{cls.select_all_query()} WHERE {cls.columns.ride_id} = ?",
+                (ride_id,)
+            ).fetchone()
+        if not row:
+            raise KeyError(f"no track points for ride with ID {ride_id}")
+        return cls.from_row(db, row)
+
+    @classmethod
+    def update(cls, db: Database, ride_id: int, gpx: gpxpy.gpx.GPX | gpxpy.gpx.GPXTrack) -> Self:
+        """extract the points of gpx and save them as the track points of the ride with ride_id"""
+        return cls.store(db, ride_id, cls.compute(gpx))
+
+    @classmethod
+    def store(cls, db: Database, ride_id: int, values: dict) -> Self:
+        """
+        save values (see `compute` and `Simplification.apply`) as the track points of the ride with ride_id
+        """
+        try:
+            points = cls.get_by_ride(db, ride_id)
+        except KeyError:
+            points = cls(db, ride_id=ride_id)
+        # points that are not simplified replace simplified ones
+        values = {"n_recorded": None, "distance_error": None, "uphill_error": None, "segment_sizes": None} | values
+        for name, value in values.items():
+            setattr(points, name, value)
+        points.save()
+        return points
+
+    @property
+    def simplified(self) -> bool:
+        return self.n_recorded is not None
+
+    @classmethod
+    def get_simplification(cls, db: Database, ride_id: int) -> sqlite3.Row | None:
+        """
+        the number of stored and recorded points of the ride's track and the errors of its simplification
+        (NULL if it is not simplified), without loading the points. None if no points are stored
+        """
+        c = cls.columns
+        with closing(db.cursor()) as cursor:
+            return cursor.execute(
+                f"SELECT {c.n_points}, {c.n_recorded}, {c.distance_error}, {c.uphill_error} "
+                f"FROM {cls.table} WHERE {c.ride_id} = ?",
+                (ride_id,)
+            ).fetchone()
+
+    @classmethod
+    def summarize_simplification(cls, db: Database, ride_ids: list[int]) -> sqlite3.Row:
+        """
+        the number of stored and recorded points of the simplified tracks of the rides with ride_ids
+        and the largest errors of their length and elevation gain
+        """
+        c = cls.columns
+        with closing(db.cursor()) as cursor:
+            return cursor.execute(
+                f"SELECT COUNT(*) AS n_tracks, TOTAL({c.n_points}) AS n_points, TOTAL({c.n_recorded}) AS n_recorded, "
+                f"MAX(ABS({c.distance_error})) AS distance_error, MAX(ABS({c.uphill_error})) AS uphill_error "
+                f"FROM {cls.table} WHERE {c.n_recorded} IS NOT NULL "
+                f"AND {c.ride_id} IN (SELECT value FROM json_each(?))",
+                (json.dumps(ride_ids),)
+            ).fetchone()
+
+    def as_numpy(self) -> dict:
+        """return the coordinates as read-only numpy arrays that share memory with the stored blobs"""
+        import numpy
+        return {
+            name: numpy.frombuffer(getattr(self, name), dtype="d")
+            for name in ("lat", "lon", "ele", "time")
+        }
+
+
+class TrackGrid(Model):
+    """
+    the cells of a grid that the track of a ride passes through (see `vectorized.grid_cells`), for heatmaps.
+    the grids are computed from the track points when a heatmap needs them and kept until the points change,
+    so only new rides have to be binned. cell indexes are stored like floats (they are exact integers)
+    """
+    table = "track_grids"
+
+    class columns(ColumnEnum):
+        pk = Field("id")
+        ride_id = Field("ride_id")
+        cell_size = FloatField("cell_size")
+        lat_cells = PackedArrayField("lat_cells")
+        lon_cells = PackedArrayField("lon_cells")
+
+    @classmethod
+    def update_missing(cls, db: Database, cell_size: float, filter: RideFilter=None, chunk_size: int=100) -> int:
+        """
+        compute the grids with cell_size of the rides that match filter and have track points but no such grid.
+        returns the number of new grids
+        """
+        from kmtracker import vectorized
+        if cell_size <= 0:
+            raise ValueError("the cells of a heatmap need a positive size")
+        conditions, params = filter.conditions() if filter else ([], [])
+        with closing(db.cursor()) as cursor:
+            missing = [id for id, in cursor.execute(
+                f"SELECT {Ride.table}.id FROM {Ride.table} "
+                f"JOIN {TrackPoints.table} ON {TrackPoints.table}.{TrackPoints.columns.ride_id} = {Ride.table}.id "
+                f"LEFT JOIN {cls.table} ON {cls.table}.{cls.columns.ride_id} = {Ride.table}.id "
+                f"AND {cls.table}.{cls.columns.cell_size} = ? "
+                f"{where([f'{cls.table}.id IS NULL', *conditions])}",
+                (cell_size, *params)
+            )]
+        for start in range(0, len(missing), chunk_size):
+            with closing(db.cursor()) as cursor:
+                rows = cursor.execute(
+                    f"SELECT {TrackPoints.columns.ride_id}, {TrackPoints.columns.lat}, {TrackPoints.columns.lon}, "
+                    f"{TrackPoints.columns.segment_sizes} FROM {TrackPoints.table} "
+                    f"WHERE {TrackPoints.columns.ride_id} IN (SELECT value FROM json_each(?))",
+                    (json.dumps(missing[start:start + chunk_size]),)
+                ).fetchall()
+            grids = []
+            for ride_id, lat, lon, segment_sizes in rows:
+                lat_cells, lon_cells = vectorized.grid_cells(
+                    PackedArrayField.parse(lat), PackedArrayField.parse(lon), cell_size,
+                    PackedArrayField.parse(segment_sizes),
+                )
+                grids.append({
+                    "ride_id": ride_id, "cell_size": cell_size,
+                    "lat_cells": array("d", lat_cells.astype("d").tobytes()),
+                    "lon_cells": array("d", lon_cells.astype("d").tobytes()),
+                })
+            cls.add_rows(db, grids)
+        return len(missing)
+
+    @classmethod
+    def get_heatmap(cls, db: Database, cell_size: float, filter: RideFilter=None, chunk_size: int=500) -> tuple:
+        """
+        the number of rides matching filter that pass through each cell of the grid with cell_size,
+        as arrays of the latitude and longitude indexes of the cells and their counts. the grids of rides
+        that don't have one yet are computed first (see `update_missing`)
+        """
+        import numpy
+        from kmtracker import vectorized
+        cls.update_missing(db, cell_size, filter)
+        conditions, params = filter.conditions() if filter else ([], [])
+        lat_cells, lon_cells = [], []
+        with closing(db.cursor()) as cursor:
+            cursor.execute(
+                f"SELECT {cls.columns.lat_cells}, {cls.columns.lon_cells} FROM {cls.table} "
+                f"JOIN {Ride.table} ON {Ride.table}.id = {cls.table}.{cls.columns.ride_id} "
+                f"{where([f'{cls.table}.{cls.columns.cell_size} = ?', *conditions])}",
+                (cell_size, *params)
+            )
+            while rows := cursor.fetchmany(chunk_size):
+                for lat, lon in rows:
+                    lat_cells.append(numpy.frombuffer(PackedArrayField.parse(lat), dtype="d"))
+                    lon_cells.append(numpy.frombuffer(PackedArrayField.parse(lon), dtype="d"))
+        if not lat_cells:
+            empty = numpy.empty(0, dtype=numpy.int64)
+            return empty, empty, empty
+        return vectorized.unique_cells(
+            numpy.concatenate(lat_cells).astype(numpy.int64),
+            numpy.concatenate(lon_cells).astype(numpy.int64),
+            counts=True,
+        )
 
 
 class Alias(Model):
@@ -0,0 +1,73 @@
+from pathlib import Path
+from typing import Iterator, TextIO
+import csv
+import json
+
+from kmtracker.db import Database, GpxBlob, Ride, RideFilter
+
+
+FORMATS = ("csv", "ndjson")
+
+
+def guess_format(path: Path | None) -> str:
+    """the format of an output file by its suffix, csv if it can't be told"""
+    if path is not None and path.suffix.lower() in (".ndjson", ".jsonl", ".json"):
+        return "ndjson"
+    return "csv"
+
+
+def write_csv(rows: Iterator[dict], out: TextIO):
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(out, fieldnames=list(row))
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def write_ndjson(rows: Iterator[dict], out: TextIO):
+    for row in rows:
+        out.write(json.dumps(row, ensure_ascii=False))
+        out.write("\n")
+
+
+def with_gpx_files(db: Database, rows: Iterator[dict], directory: Path) -> Iterator[dict]:
+    """
+    write the gpx file of every row to directory while rows are passed on, with the name of the file
+    instead of the hash. files are named by the hash of their contents, so files that are already
+    there (from rides of the same file or from an earlier export) are not written again
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    for row in rows:
+        hash = row.pop("gpx_hash")
+        row["gpx_file"] = None
+        if hash is not None:
+            path = directory / f"{hash}.gpx"
+            if not path.exists():
+                path.write_text(GpxBlob.get_by_hash(db, hash).data)
+            row["gpx_file"] = path.name
+        yield row
+
+
+def export_rides(
+    db: Database,
+    out: TextIO,
+    format: str="csv",
+    filter: RideFilter=None,
+    metrics: bool=False,
+    gpx_directory: Path=None,
+):
+    """
+    write the rides that match filter to out, one row per ride, without holding more than a chunk of them
+    in memory. see `Ride.iter_export` for the columns. with gpx_directory, the gpx files of the rides are
+    written there and the rows refer to them
+    """
+    if format not in FORMATS:
+        raise ValueError(f"unknown export format: {format!r}")
+    rows = Ride.iter_export(db, filter, metrics=metrics, gpx_hash=gpx_directory is not None)
+    if gpx_directory is not None:
+        rows = with_gpx_files(db, rows, gpx_directory)
+    if format == "csv":
+        write_csv(rows, out)
+    else:
+        write_ndjson(rows, out)
@@ -0,0 +1,262 @@
+"""
+a gpx reader that computes the values kmtracker needs from the tracks of a gpx file while it is being
+parsed, instead of building gpxpy's object tree of the whole file first. elements are cleared as soon as
+they are read, so besides the compact arrays of track point coordinates its memory doesn't grow with
+the number of points.
+
+the computations follow gpxpy (which `parse_gpx` uses) so that both give the same results:
+distances, moving and stopped time, maximum speed and elevation gain are computed per segment like
+`GPXTrackSegment.get_moving_data` and `get_uphill_downhill` and summed up per track
+"""
+from __future__ import annotations
+from array import array
+from datetime import datetime
+import math
+from typing import BinaryIO, Iterator, TextIO
+from xml.etree.ElementTree import iterparse
+
+# the constants of gpxpy.geo and gpxpy.gpx
+EARTH_RADIUS = 6378.137 * 1000
+ONE_DEGREE = (2 * math.pi * EARTH_RADIUS) / 360
+STOPPED_SPEED_THRESHOLD = 1  # km/h
+IGNORE_TOP_SPEED_PERCENTILES = 0.05
+
+
+def distance(lat1: float, lon1: float, ele1: float | None, lat2: float, lon2: float, ele2: float | None) -> float:
+    """distance in meters like `gpxpy.geo.distance`: haversine for distant points, flat otherwise"""
+    if abs(lat1 - lat2) > .2 or abs(lon1 - lon2) > .2:
+        d_lon = math.radians(lon1 - lon2)
+        rad_lat1 = math.radians(lat1)
+        rad_lat2 = math.radians(lat2)
+        d_lat = rad_lat1 - rad_lat2
+        a = math.sin(d_lat / 2) ** 2 + math.sin(d_lon / 2) ** 2 * math.cos(rad_lat1) * math.cos(rad_lat2)
+        return EARTH_RADIUS * 2 * math.asin(math.sqrt(a))
+    coef = math.cos(math.radians(lat1))
+    x = lat1 - lat2
+    y = (lon1 - lon2) * coef
+    distance_2d = math.sqrt(x * x + y * y) * ONE_DEGREE
+    if ele1 is None or ele2 is None or ele1 == ele2:
+        return distance_2d
+    return math.sqrt(distance_2d ** 2 + (ele1 - ele2) ** 2)
+
+
+def max_speed(speeds: array, distances: array) -> float | None:
+    """
+    the maximum speed of a segment like `gpxpy.geo.calculate_max_speed`: steps with unusual distances
+    and the top 5% of the speeds are ignored because they are usually measurement errors
+    """
+    size = len(speeds)
+    if size < 2:
+        return None
+    average = sum(distances) / size
+    deviation = math.sqrt(sum((d - average) ** 2 for d in distances) / size)
+    filtered = sorted(s for s, d in zip(speeds, distances) if abs(d - average) <= deviation * 1.5)
+    if not filtered:
+        return None
+    index = int(len(filtered) * (1 - IGNORE_TOP_SPEED_PERCENTILES))
+    return filtered[index if index < len(filtered) else -1]
+
+
+def parse_time(text: str | None) -> datetime | None:
+    """parse the time of a point, None if it is missing or invalid (like gpxpy)"""
+    if not text:
+        return None
+    try:
+        return datetime.fromisoformat(text.strip())
+    except ValueError:
+        return None
+
+
+class StringSource:
+    """a file-like view of a string to read with `read_tracks`, which unlike io.StringIO doesn't copy it"""
+    __slots__ = ("string", "position")
+
+    def __init__(self, string: str):
+        self.string = string
+        self.position = 0
+
+    def read(self, size: int=-1) -> str:
+        end = len(self.string) if size < 0 else self.position + size
+        chunk = self.string[self.position:end]
+        self.position += len(chunk)
+        return chunk
+
+
+class Segment:
+    """accumulates the moving data and elevation gain of a track segment point by point"""
+    __slots__ = (
+        "previous", "moving_time", "stopped_time", "moving_distance", "speeds", "distances",
+        "elevations", "smoothed", "uphill", "downhill",
+    )
+
+    def __init__(self):
+        self.previous = None
+        self.moving_time = 0.
+        self.stopped_time = 0.
+        self.moving_distance = 0.
+        self.speeds = array("d")
+        self.distances = array("d")
+        # the last two elevations and the last smoothed elevation (see `add_elevation`)
+        self.elevations = []
+        self.smoothed = None
+        self.uphill = 0.
+        self.downhill = 0.
+
+    def add(self, lat: float, lon: float, ele: float | None, time: datetime | None):
+        previous = self.previous
+        self.previous = (lat, lon, ele, time)
+        if ele is not None:
+            self.add_elevation(ele)
+        if previous is None or time is None or previous[3] is None:
+            return
+        prev_lat, prev_lon, prev_ele, prev_time = previous
+        # gpxpy only uses elevations that are not 0 for the distance
+        if ele and prev_ele:
+            d = distance(lat, lon, ele, prev_lat, prev_lon, prev_ele)
+        else:
+            d = distance(lat, lon, None, prev_lat, prev_lon, None)
+        seconds = (time - prev_time).total_seconds()
+        if seconds > 0 and d:
+            if (d / 1000) / (seconds / 3600) <= STOPPED_SPEED_THRESHOLD:
+                self.stopped_time += seconds
+            else:
+                self.moving_time += seconds
+                self.moving_distance += d
+            if self.moving_time:
+                self.speeds.append(d / seconds)
+                self.distances.append(d)
+
+    def add_elevation(self, ele: float):
+        """
+        elevations are smoothed with their neighbours (.3, .4, .3) before they are compared,
+        so an elevation is smoothed once the next one is known
+        """
+        self.elevations.append(ele)
+        if len(self.elevations) == 1:
+            self.climb(ele)
+        elif len(self.elevations) == 3:
+            before, current, after = self.elevations
+            self.climb(before * .3 + current * .4 + after * .3)
+            del self.elevations[0]
+
+    def climb(self, smoothed: float):
+        if self.smoothed is not None:
+            d = smoothed - self.smoothed
+            if d > 0:
+                self.uphill += d
+            else:
+                self.downhill -= d
+        self.smoothed = smoothed
+
+    def finish(self):
+        """the last elevation is not smoothed"""
+        if len(self.elevations) == 2:
+            self.climb(self.elevations[-1])
+        self.elevations = []
+
+
+class Track:
+    """the values of a track of a gpx file"""
+    __slots__ = (
+        "name", "segment_sizes", "start_time", "moving_time", "stopped_time", "moving_distance",
+        "max_speed", "uphill", "downhill", "lat", "lon", "ele", "time",
+    )
+
+    def __init__(self):
+        self.name = None
+        # the number of points of each segment
+        self.segment_sizes = []
+        self.start_time = None
+        self.moving_time = 0.
+        self.stopped_time = 0.
+        self.moving_distance = 0.  # m
+        self.max_speed = 0.  # m/s
+        self.uphill = 0.
+        self.downhill = 0.
+        # the points like `kmtracker.db.TrackPoints`
+        self.lat, self.lon, self.ele, self.time = array("d"), array("d"), array("d"), array("d")
+
+    @property
+    def n_segments(self) -> int:
+        return len(self.segment_sizes)
+
+    @property
+    def n_points(self) -> int:
+        return len(self.lat)
+
+    @property
+    def bounds(self) -> tuple[float, float, float, float] | None:
+        """min_lat, max_lat, min_lon, max_lon, None if the track has no points"""
+        if not self.lat:
+            return None
+        return min(self.lat), max(self.lat), min(self.lon), max(self.lon)
+
+    def add_segment(self, segment: Segment):
+        segment.finish()
+        self.moving_time += segment.moving_time
+        self.stopped_time += segment.stopped_time
+        self.moving_distance += segment.moving_distance
+        self.uphill += segment.uphill
+        self.downhill += segment.downhill
+        speed = max_speed(segment.speeds, segment.distances)
+        if speed is not None and speed > self.max_speed:
+            self.max_speed = speed
+
+
+def read_tracks(source: str | BinaryIO | TextIO, metrics: bool=True) -> Iterator[Track]:
+    """
+    read the tracks of the gpx file at the path or in the file object (or `StringSource`) source, one by one.
+    without metrics, only the points of the tracks are read (to compute the metrics from them,
+    see `kmtracker.vectorized`). raises `xml.etree.ElementTree.ParseError` if the file isn't valid XML
+    """
+    root = track = segment = None
+    track_element = segment_element = None
+    depth = track_depth = segment_start = 0
+    for event, element in iterparse(source, events=("start", "end")):
+        # ignore the namespace (gpx 1.0 or 1.1)
+        tag = element.tag.rpartition("}")[2]
+        if event == "start":
+            depth += 1
+            if depth == 1:
+                root = element
+            elif tag == "trk":
+                track, track_element, track_depth = Track(), element, depth
+            elif tag == "trkseg" and track is not None:
+                segment, segment_element, segment_start = Segment(), element, len(track.lat)
+            continue
+        if track is not None:
+            if tag == "trkpt" and segment is not None:
+                lat, lon = float(element.get("lat")), float(element.get("lon"))
+                ele = time = None
+                for child in element:
+                    child_tag = child.tag.rpartition("}")[2]
+                    if child_tag == "ele" and child.text:
+                        ele = float(child.text)
+                    elif child_tag == "time":
+                        time = parse_time(child.text)
+                if metrics:
+                    segment.add(lat, lon, ele, time)
+                track.lat.append(lat)
+                track.lon.append(lon)
+                track.ele.append(ele if ele is not None else math.nan)
+                track.time.append(time.timestamp() if time else math.nan)
+                if track.start_time is None and time:
+                    track.start_time = time
+                # the point is read, drop it from the tree
+                segment_element.clear()
+            elif tag == "trkseg" and segment is not None:
+                track.segment_sizes.append(len(track.lat) - segment_start)
+                if metrics:
+                    track.add_segment(segment)
+                segment = None
+                track_element.clear()
+            elif tag == "name" and depth == track_depth + 1:
+                # the name of the track, not of one of its points
+                track.name = element.text
+            elif tag == "trk":
+                yield track
+                track = None
+        # drop everything in the file that has been read (tracks, routes, waypoints, metadata)
+        if depth == 2:
+            root.clear()
+        depth -= 1
@@ -1,49 +1,233 @@
 from collections import Counter
+from pathlib import Path
+import hashlib
+import io
+import json
+import math
+import time
+
 import dayplot
-import matplotlib.pyplot as plt
-
-from kmtracker.db import Database, Ride
-
-
-def prepare_data(db: Database) -> Counter:
-    rides = Ride.get_latest_entries(db, -1)
-    kms = Counter()
-    for ride in rides:
-        kms[ride.timestamp.date().isoformat()] += ride.distance
-    return kms
-
-
-def create_plot(rides: Counter):
-    mindate = min(rides.keys())
-    maxdate = max(rides.keys())
-    # years = list(range(mindate.year, maxdate.year+1))
-    years = list(range(int(mindate[:4]), int(maxdate[:4])+1))
-    nyears = len(years)
-
-    fig, axs = plt.subplots(nrows=nyears, figsize=(15, nyears*3))
-    if nyears == 1:
-        axs = [axs]
-
-    for i, year in enumerate(years):
-        start = f"{year}-01-01"
-        # start = start if start > mindate else mindate
-        end = f"{year}-12-31"
-        # end = end if end < maxdate else maxdate
-        dayplot.calendar(
-            dates=rides.keys(),
-            values=rides.values(),
-            start_date=start,
-            end_date=end,
-            week_starts_on="Monday",
-            ax=axs[i],
-        )
-        axs[i].text(s=str(year), x=-4, y=3.5, size=30, rotation=90, color="#aaa", va="center")
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
+
+from kmtracker.db import Database, DailyTotal, RideFilter, TrackGrid
+
+
+# formats of `save_plot` whose years are rendered one by one and cached
+CACHED_FORMATS = ("png", "svg")
+# increase when the plots change, so that cached years are rendered again
+RENDER_VERSION = 1
+# size of the calendar of a year in inches and resolution of the pngs
+YEAR_SIZE = (15, 3)
+DPI = 100
+# cached years that weren't used for this many seconds are deleted
+CACHE_MAX_AGE = 30 * 24 * 3600
+# the longer side of heatmaps in inches and their largest number of cells per side
+HEATMAP_SIZE = 12
+HEATMAP_MAX_CELLS = 2000
+
+
+def prepare_data(db: Database, filter: RideFilter=None) -> Counter:
+    return Counter(dict(DailyTotal.get_distances(db, filter)))
+
+
+def color_scale(rides: Counter) -> tuple[float, float]:
+    """vmin and vmax of the colors like dayplot computes them, but for all years"""
+    return min(rides.values()), max(rides.values()) or 1
+
+
+def get_years(rides: Counter) -> list[int]:
+    return list(range(int(min(rides.keys())[:4]), int(max(rides.keys())[:4]) + 1))
+
+
+def draw_year(ax: Axes, year: int, rides: Counter, scale: tuple[float, float]):
+    vmin, vmax = scale
+    dayplot.calendar(
+        dates=rides.keys(),
+        values=rides.values(),
+        start_date=f"{year}-01-01",
+        end_date=f"{year}-12-31",
+        week_starts_on="Monday",
+        vmin=vmin,
+        vmax=vmax,
+        ax=ax,
+    )
+    ax.text(s=str(year), x=-4, y=3.5, size=30, rotation=90, color="#aaa", va="center")
+
+
+def create_plot(rides: Counter, fig: Figure=None) -> Figure:
+    """draw the calendars of all years into fig (a new figure if it is None)"""
+    years = get_years(rides)
+    scale = color_scale(rides)
+    fig = fig or Figure()
+    fig.set_size_inches(YEAR_SIZE[0], YEAR_SIZE[1] * len(years))
+    axs = fig.subplots(nrows=len(years), squeeze=False)[:, 0]
+    for ax, year in zip(axs, years):
+        draw_year(ax, year, rides, scale)
+    fig.tight_layout()
+    return fig
+
 
+def render_year(year: int, rides: Counter, format: str, cache_path: Path=None) -> bytes:
+    """
+    render the calendar of year as a file of format. with cache_path, the rendered file is kept in
+    this directory under the version of the data it shows (the distances of the year and the color scale),
+    so that it is only rendered again when they change
+    """
+    scale = color_scale(rides)
+    days = sorted((day, km) for day, km in rides.items() if day.startswith(f"{year}-"))
+    version = hashlib.sha256(json.dumps([RENDER_VERSION, year, scale, days]).encode()).hexdigest()
+    cached = cache_path / f"{year}-{version[:32]}.{format}" if cache_path else None
+    if cached and cached.exists():
+        cached.touch()
+        return cached.read_bytes()
+    fig = Figure(figsize=YEAR_SIZE)
+    draw_year(fig.subplots(), year, rides, scale)
+    fig.tight_layout()
+    out = io.BytesIO()
+    fig.savefig(out, format=format, dpi=DPI)
+    if cached:
+        cache_path.mkdir(parents=True, exist_ok=True)
+        cached.write_bytes(out.getvalue())
+    return out.getvalue()
+
+
+def stack_pngs(images: list[bytes], path: Path):
+    import matplotlib.image
+    import numpy
+    pixels = [matplotlib.image.imread(io.BytesIO(image), format="png") for image in images]
+    matplotlib.image.imsave(path, numpy.concatenate(pixels), format="png", dpi=DPI)
+
+
+def stack_svgs(images: list[bytes], path: Path):
+    """put the svg images below each other as nested svg elements"""
+    from xml.etree import ElementTree
+    namespace = "http://www.w3.org/2000/svg"
+    ElementTree.register_namespace("", namespace)
+    ElementTree.register_namespace("xlink", "http://www.w3.org/1999/xlink")
+    roots = [ElementTree.fromstring(image) for image in images]
+    # matplotlib's svgs are measured in pt, like their viewBox
+    width = float(roots[0].get("width").removesuffix("pt"))
+    stacked = ElementTree.Element(f"{{{namespace}}}svg", version="1.1")
+    y = 0.
+    for root in roots:
+        height = float(root.get("height").removesuffix("pt"))
+        root.set("y", str(y))
+        root.set("width", str(width))
+        root.set("height", str(height))
+        stacked.append(root)
+        y += height
+    stacked.set("width", f"{width}pt")
+    stacked.set("height", f"{y}pt")
+    stacked.set("viewBox", f"0 0 {width} {y}")
+    ElementTree.ElementTree(stacked).write(path, encoding="utf-8", xml_declaration=True)
+
+
+def clean_cache(cache_path: Path):
+    """delete cached years that weren't used for CACHE_MAX_AGE"""
+    if not cache_path.is_dir():
+        return
+    for cached in cache_path.iterdir():
+        if cached.suffix[1:] in CACHED_FORMATS and cached.stat().st_mtime < time.time() - CACHE_MAX_AGE:
+            cached.unlink()
+
+
+def save_plot(db: Database, path: Path, filter: RideFilter=None, cache_path: Path=None):
+    """
+    save the plot to path without showing it, in the format of its suffix. png and svg plots
+    are put together from the calendars of the years, which are cached in cache_path
+    """
+    rides = prepare_data(db, filter)
+    if not rides:
+        raise ValueError("no matching entries in database")
+    format = path.suffix[1:].lower()
+    if format not in CACHED_FORMATS:
+        create_plot(rides).savefig(path, dpi=DPI)
+        return
+    images = [render_year(year, rides, format, cache_path) for year in get_years(rides)]
+    if format == "png":
+        stack_pngs(images, path)
+    else:
+        stack_svgs(images, path)
+    if cache_path:
+        clean_cache(cache_path)
 
+
+def show_plot(db: Database, filter: RideFilter=None):
+    # pyplot is only needed to show the plot in a window
+    import matplotlib.pyplot as plt
+    rides = prepare_data(db, filter)
+    if not rides:
+        raise ValueError("no matching entries in database")
+    create_plot(rides, plt.figure())
+    plt.show()
+
+
+def rasterize(lat_cells, lon_cells, counts, cell_size: float) -> tuple:
+    """
+    put the counts of the cells of a heatmap into an image (rows from south to north) and return it
+    with its extent (lon_min, lon_max, lat_min, lat_max). if there are more than `HEATMAP_MAX_CELLS`
+    cells per side, neighbouring cells are combined into one pixel that shows the largest of their counts
+    """
+    import numpy
+    from kmtracker.gpxstream import ONE_DEGREE
+    lat_min, lon_min = lat_cells.min(), lon_cells.min()
+    factor = math.ceil(max(lat_cells.max() - lat_min + 1, lon_cells.max() - lon_min + 1) / HEATMAP_MAX_CELLS)
+    rows, cols = (lat_cells - lat_min) // factor, (lon_cells - lon_min) // factor
+    image = numpy.zeros((rows.max() + 1, cols.max() + 1))
+    numpy.maximum.at(image, (rows, cols), counts)
+    degrees = cell_size / ONE_DEGREE
+    extent = (
+        lon_min * degrees, (lon_min + image.shape[1] * factor) * degrees,
+        lat_min * degrees, (lat_min + image.shape[0] * factor) * degrees,
+    )
+    return image, extent
+
+
+def create_heatmap(db: Database, cell_size: float, filter: RideFilter=None, fig: Figure=None) -> Figure:
+    """draw how many of the rides that match filter pass through each cell of size cell_size (in meters)"""
+    import numpy
+    from matplotlib.colors import LogNorm
+    lat_cells, lon_cells, counts = TrackGrid.get_heatmap(db, cell_size, filter)
+    if not len(counts):
+        raise ValueError("no matching entries with track points in database (see kmtracker backfill)")
+    image, extent = rasterize(lat_cells, lon_cells, counts, cell_size)
+    # degrees of longitude are shorter than degrees of latitude away from the equator
+    aspect = 1 / math.cos(math.radians((extent[2] + extent[3]) / 2))
+    width, height = extent[1] - extent[0], (extent[3] - extent[2]) * aspect
+    fig = fig or Figure()
+    fig.set_size_inches(*(
+        (HEATMAP_SIZE, max(HEATMAP_SIZE * height / width, 2)) if width >= height
+        else (max(HEATMAP_SIZE * width / height, 2) + 1.5, HEATMAP_SIZE)
+    ))
+    ax = fig.subplots()
+    # the lowest color of plasma (blue) stands out from the black background
+    ax.set_facecolor("black")
+    shown = ax.imshow(
+        numpy.ma.masked_equal(image, 0),
+        norm=LogNorm(vmin=1, vmax=max(image.max(), 2)),
+        cmap="plasma",
+        extent=extent,
+        origin="lower",
+        interpolation="nearest",
+        aspect=aspect,
+    )
+    colorbar = fig.colorbar(shown, ax=ax, label="rides", shrink=.8)
+    # counts instead of powers of ten
+    colorbar.ax.yaxis.set_major_formatter("{x:g}")
+    colorbar.ax.yaxis.set_minor_formatter("{x:g}")
+    ax.set_xlabel("longitude")
+    ax.set_ylabel("latitude")
     fig.tight_layout()
     return fig
 
 
-def show_plot(db: Database):
-    create_plot(prepare_data(db))
+def save_heatmap(db: Database, path: Path, cell_size: float, filter: RideFilter=None):
+    """save the heatmap (see `create_heatmap`) to path without showing it, in the format of its suffix"""
+    create_heatmap(db, cell_size, filter).savefig(path, dpi=DPI * 1.5)
+
+
+def show_heatmap(db: Database, cell_size: float, filter: RideFilter=None):
+    import matplotlib.pyplot as plt
+    create_heatmap(db, cell_size, filter, plt.figure())
     plt.show()
@@ -1,10 +1,18 @@
 from rich.console import Console
 from rich.table import Table
-from datetime import timedelta
-import gpxpy
+from rich.text import Text
+from contextlib import contextmanager
+from datetime import date, timedelta
+from itertools import chain, islice
+from pathlib import Path
+import os
+import shlex
+import subprocess
+import sys
 from functools import wraps
+from typing import Iterable
 
-from kmtracker.db import Ride, Alias
+from kmtracker.db import Ride, Alias, RideMetrics
 from kmtracker import db
 
 
@@ -33,34 +41,93 @@ def print_aliases(rows: list[Alias]):
     console.print(table)
 
 
+RIDE_COLUMNS = {
+    "pk": Ride.columns.pk.field.display_name,
+    "timestamp": Ride.columns.timestamp.field.display_name,
+    "distance": Ride.columns.distance.field.display_name,
+    "duration": Ride.columns.duration.field.display_name,
+    "speed": "Avg. speed (km/h)",
+    "comment": Ride.columns.comment.field.display_name,
+    "segments": Ride.columns.segments.field.display_name,
+    "gpx": Ride.columns.gpx_id.field.display_name,
+}
+
+
 def print_rides(rows: list[Ride]):
     if not rows:
         print("Nothing to show.")
         return
     table = Table()
-    table.add_column(Ride.columns.pk.field.display_name)
-    table.add_column(Ride.columns.timestamp.field.display_name)
-    table.add_column(Ride.columns.distance.field.display_name)
-    table.add_column(Ride.columns.duration.field.display_name)
-    table.add_column("Avg. speed (km/h)")
-    table.add_column(Ride.columns.comment.field.display_name)
-    table.add_column(Ride.columns.segments.field.display_name)
-    table.add_column(Ride.columns.gpx.field.display_name)
+    for header in RIDE_COLUMNS.values():
+        table.add_column(header)
     for row in rows:
         pretty = row.serialize_pretty()
-        table.add_row(
-            pretty["pk"],
-            pretty["timestamp"],
-            pretty["distance"],
-            pretty["duration"],
-            pretty["speed"],
-            pretty["comment"],
-            pretty["segments"],
-            pretty["gpx"],
-        )
+        table.add_row(*(pretty[key] for key in RIDE_COLUMNS))
     console.print(table)
 
 
+def print_rides_streaming(rows: Iterable[Ride], chunk_size: int=100):
+    """
+    print rides without keeping all of them in memory. up to chunk_size rides are printed
+    like `print_rides`, more are printed as a sequence of tables of chunk_size rows
+    with the column widths of the first chunk
+    """
+    rows = iter(rows)
+    chunk = list(islice(rows, chunk_size + 1))
+    if len(chunk) <= chunk_size:
+        print_rides(chunk)
+        return
+    first = [row.serialize_pretty() for row in chunk[:chunk_size]]
+    # headers may wrap, cells of the first chunk fit into the column
+    widths = {
+        key: max(*(len(word) for word in header.split()), *(len(pretty[key]) for pretty in first))
+        for key, header in RIDE_COLUMNS.items()
+    }
+    # shrink the comments to fit the table into the console (each column is padded by 3 characters)
+    others = sum(width + 3 for key, width in widths.items() if key != "comment")
+    widths["comment"] = max(min(widths["comment"], console.width - others - 2), 8)
+    pending = first
+    rest = chain(chunk[chunk_size:], rows)
+    show_header = True
+    while pending:
+        table = Table(show_edge=False, show_header=show_header)
+        for key, header in RIDE_COLUMNS.items():
+            table.add_column(header, width=widths[key])
+        for pretty in pending:
+            table.add_row(*(pretty[key] for key in RIDE_COLUMNS))
+        console.print(table)
+        show_header = False
+        pending = [row.serialize_pretty() for row in islice(rest, chunk_size)]
+
+
+@contextmanager
+def pager():
+    """
+    page everything that is printed inside the block with $PAGER (default: less -R).
+    unlike rich's pager, the output is passed on while it is printed instead of being collected first
+    """
+    global console
+    terminal = console
+    process = subprocess.Popen(
+        shlex.split(os.environ.get("PAGER", "less -R")),
+        stdin=subprocess.PIPE,
+        encoding="utf-8",
+    )
+    console = Console(file=process.stdin, force_terminal=terminal.is_terminal, width=terminal.width)
+    try:
+        yield
+    except BrokenPipeError:
+        # the pager was closed before everything was printed
+        pass
+    finally:
+        console = terminal
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+
+
 def print_summary(summary: dict):
     streaks = summary["longest_streaks"]
     if not streaks:
@@ -68,39 +135,136 @@ def print_summary(summary: dict):
     else:
         n = streaks[0][1]
         streaks_text = f"{n} days (until {str(streaks[0][0])})"
+    weekly_streaks = summary["longest_weekly_streaks"]
+    if not weekly_streaks:
+        weekly_streaks_text = "-"
+    else:
+        n = weekly_streaks[0][1]
+        weekly_streaks_text = f"{n} weeks (until the week of {str(weekly_streaks[0][0])})"
     console.print(f"total distance           : [bold green]{summary['distance_tot']} km[/bold green] ({summary['n_rides']} rides)")
     console.print(f"longest ride             : {summary['distance_max']} km (on {summary['distance_max_date']})")
     console.print(f"maximum distance on a day: {summary['max_day_distance']} km (on {summary['max_day_date']})")
     console.print(f"average speed            : {summary['speed_mean']} km/h")
     console.print(f"fastest ride             : {summary['speed_max']} km/h (on {summary['speed_max_date']})")
     console.print(f"longest streaks          : {streaks_text}")
+    console.print(f"longest weekly streaks   : {weekly_streaks_text}")
 
 
-def print_entry(ride: Ride):
+def period_label(start: date, by: str) -> str:
+    match by:
+        case "week":
+            year, week, _ = start.isocalendar()
+            return f"{year}-W{week:02}"
+        case "month":
+            return start.strftime("%Y-%m")
+    return str(start.year)
+
+
+def print_report(rows: list[dict], by: str, compare: bool=False):
+    if not rows:
+        print("Nothing to show.")
+        return
+    headers = [by.capitalize(), "Distance (km)", "Duration", "Rides", "km/h", "Longest (km)"]
+    if compare:
+        headers += ["Prev. year (km, rides)", "Change"]
+    cells = []
+    for row in rows:
+        row_cells = [
+            period_label(row["start"], by),
+            str(round(row["distance"], 1)),
+            db.TimedeltaField.serialize_pretty(row["duration"]) if row["duration"] else "",
+            str(row["n_rides"]),
+            str(round(row["speed"], 1)) if row["speed"] else "",
+            str(round(row["longest"], 1)) if row["longest"] is not None else "",
+        ]
+        if compare:
+            previous = row["previous_distance"]
+            if previous:
+                change = (row["distance"] / previous - 1) * 100
+                color = "green" if change >= 0 else "red"
+                change_text = f"[{color}]{change:+.0f}%[/{color}]"
+            else:
+                change_text = "-"
+            row_cells += [
+                f"{round(previous, 1)} ({row['previous_n_rides']})" if previous is not None else "-",
+                change_text,
+            ]
+        cells.append(row_cells)
+    table = Table()
+    # headers may wrap, the numbers may not
+    for i, header in enumerate(headers):
+        width = max(len(Text.from_markup(row_cells[i])) for row_cells in cells)
+        table.add_column(header, justify="left" if i == 0 else "right", min_width=width)
+    for row_cells in cells:
+        table.add_row(*row_cells)
+    console.print(table)
+
+
+def print_simplification(summary):
+    if not summary["n_recorded"]:
+        return
+    console.print(
+        f"stored {summary['n_points']:.0f} of {summary['n_recorded']:.0f} track points "
+        f"({summary['n_points'] / summary['n_recorded']:.0%}), length within {summary['distance_error']:.1%} "
+        f"and uphill within {summary['uphill_error']:.1%} of the recorded tracks"
+    )
+
+
+def print_streak(n: int):
+    if n > 1:
+        console.print(f"🚴[bold green]You're on a streak![/bold green] {n} days in a row")
+
+
+def print_entry(ride: Ride, metrics: RideMetrics | None, simplification=None):
+    # simplification is a row of `TrackPoints.get_simplification`
     print_rides([ride])
-    gpx_data = ride.gpx
-    if gpx_data:
-        gpx = gpxpy.parse(gpx_data)
-        moving_data = gpx.get_moving_data()
-        elevation = gpx.get_uphill_downhill()
-        console.print(f"time in motion         : {db.TimedeltaField.serialize_pretty(timedelta(seconds=moving_data.moving_time))}")
-        console.print(f"time at rest           : {db.TimedeltaField.serialize_pretty(timedelta(seconds=moving_data.stopped_time))}")
-        console.print(f"average speed in motion: {round(moving_data.moving_distance / moving_data.moving_time * 3.6, 1)} km/h")
-        console.print(f"maximum speed          : {round(moving_data.max_speed * 3.6, 1)} km/h")
-        console.print(f"uphill                 : {round(elevation.uphill, 0)} m")
-        console.print(f"downhill               : {round(elevation.downhill, 0)} m")
+    if metrics:
+        moving_speed = metrics.moving_speed
+        console.print(f"time in motion         : {db.TimedeltaField.serialize_pretty(metrics.moving_time or timedelta())}")
+        console.print(f"time at rest           : {db.TimedeltaField.serialize_pretty(metrics.stopped_time or timedelta())}")
+        console.print(f"average speed in motion: {round(moving_speed, 1) if moving_speed else '-'} km/h")
+        console.print(f"maximum speed          : {round(metrics.max_speed, 1)} km/h")
+        console.print(f"uphill                 : {round(metrics.uphill, 0)} m")
+        console.print(f"downhill               : {round(metrics.downhill, 0)} m")
+    elif ride.has_gpx:
+        console.print("metrics                : not computed yet, run `kmtracker backfill`")
+    if simplification and simplification["n_recorded"] is not None:
+        console.print(
+            f"stored track points    : {simplification['n_points']} of {simplification['n_recorded']} "
+            f"(length {simplification['distance_error']:+.1%}, uphill {simplification['uphill_error']:+.1%})"
+        )
+
+
+ERROR = "[bold red]error[/bold red]:"
+
+
+def error_message(e: Exception) -> str:
+    if isinstance(e, PermissionError):
+        return "permission denied"
+    # gpxpy is only imported by commands that read gpx files
+    if "gpxpy.gpx" in sys.modules and isinstance(e, sys.modules["gpxpy.gpx"].GPXXMLSyntaxException):
+        return "could not parse gpx file"
+    return str(e)
+
+
+def print_file_error(path: Path, e: Exception):
+    console.print(f"{ERROR} {path}: {error_message(e)}", highlight=False)
+
+
+@contextmanager
+def progress(total: int, description: str):
+    """show a progress bar while the block runs. yields a function that advances it by one step"""
+    from rich.progress import Progress
+    with Progress(console=console, transient=True) as bar:
+        task = bar.add_task(description, total=total)
+        yield lambda: bar.advance(task)
 
 
 def pretty_errors(f):
-    error = "[bold red]error[/bold red]:"
     @wraps(f)
     def _f(*args, **kwargs):
         try:
             return f(*args, **kwargs)
-        except PermissionError:
-            console.print(f"{error} permission denied")
-        except gpxpy.gpx.GPXXMLSyntaxException:
-            console.print(f"{error} could not parse gpx file")
         except Exception as e:
-            console.print(f"{error} {e}")
+            console.print(f"{ERROR} {error_message(e)}")
     return _f
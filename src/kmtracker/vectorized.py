@@ -0,0 +1,249 @@
+"""
+the metrics of a gpx track computed with numpy from the arrays of its points (see `kmtracker.db.TrackPoints`)
+instead of gpxpy's loops over point objects.
+
+the computations follow gpxpy's `get_moving_data`, `get_uphill_downhill` and `get_bounds` step by step
+(like `kmtracker.gpxstream`), so the results are the same up to rounding:
+
+- times are differences of seconds since the epoch as doubles instead of datetimes, which are exact
+  to about a microsecond
+- sums are computed in a different order and numpy's trigonometric functions may differ from python's
+  in the last digit
+
+in practice moving time, stopped time, moving distance and elevation gain agree to a relative
+tolerance of 1e-9 and the maximum speed is the same speed (it is picked from the speeds, not summed).
+a step whose speed is exactly at the stopped threshold of 1 km/h, or whose distance is exactly at
+the limit of the distances that are ignored for the maximum speed, may be classified differently.
+
+tracks are also simplified here before their points are stored (see `simplified`), and binned
+into the grids of heatmaps (see `grid_cells`)
+"""
+from __future__ import annotations
+from typing import Sequence
+
+import numpy as np
+
+from kmtracker.gpxstream import EARTH_RADIUS, ONE_DEGREE, STOPPED_SPEED_THRESHOLD, IGNORE_TOP_SPEED_PERCENTILES
+
+# steps between points that are longer than this (in meters) are gaps in the recording, not a straight ride
+MAX_GRID_STEP = 2000
+
+
+def distances(lat: np.ndarray, lon: np.ndarray, ele: np.ndarray) -> np.ndarray:
+    """
+    the distances in meters between consecutive points like `gpxstream.distance`: haversine for distant
+    points, flat otherwise. gpxpy only uses elevations that are not 0 (missing elevations are NaN)
+    """
+    lat1, lat2 = lat[1:], lat[:-1]
+    lon1, lon2 = lon[1:], lon[:-1]
+    ele1, ele2 = ele[1:], ele[:-1]
+    coef = np.cos(np.radians(lat1))
+    x = lat1 - lat2
+    y = (lon1 - lon2) * coef
+    distance_2d = np.sqrt(x * x + y * y) * ONE_DEGREE
+    with np.errstate(invalid="ignore"):
+        use_3d = (ele1 != 0) & (ele2 != 0) & (ele1 != ele2) & ~np.isnan(ele1) & ~np.isnan(ele2)
+    distance = np.where(use_3d, np.sqrt(distance_2d ** 2 + (ele1 - ele2) ** 2), distance_2d)
+    distant = (np.abs(lat1 - lat2) > .2) | (np.abs(lon1 - lon2) > .2)
+    if distant.any():
+        rad_lat1 = np.radians(lat1[distant])
+        rad_lat2 = np.radians(lat2[distant])
+        d_lat = rad_lat1 - rad_lat2
+        d_lon = np.radians(lon1[distant] - lon2[distant])
+        a = np.sin(d_lat / 2) ** 2 + np.sin(d_lon / 2) ** 2 * np.cos(rad_lat1) * np.cos(rad_lat2)
+        distance[distant] = EARTH_RADIUS * 2 * np.arcsin(np.sqrt(a))
+    return distance
+
+
+def max_speed(speeds: np.ndarray, distances: np.ndarray) -> float | None:
+    """like `gpxstream.max_speed`: ignore steps with unusual distances and the top 5% of the speeds"""
+    size = len(speeds)
+    if size < 2:
+        return None
+    average = distances.sum() / size
+    deviation = np.sqrt(((distances - average) ** 2).sum() / size)
+    filtered = speeds[np.abs(distances - average) <= deviation * 1.5]
+    if not len(filtered):
+        return None
+    index = min(int(len(filtered) * (1 - IGNORE_TOP_SPEED_PERCENTILES)), len(filtered) - 1)
+    return float(np.partition(filtered, index)[index])
+
+
+def uphill_downhill(ele: np.ndarray) -> tuple[float, float]:
+    """
+    the elevation gain and loss of a segment. missing elevations are skipped, the others are smoothed
+    with their neighbours (.3, .4, .3) except for the first and the last
+    """
+    ele = ele[~np.isnan(ele)]
+    if len(ele) < 2:
+        return 0., 0.
+    smoothed = ele.copy()
+    smoothed[1:-1] = ele[:-2] * .3 + ele[1:-1] * .4 + ele[2:] * .3
+    d = np.diff(smoothed)
+    return float(d[d > 0].sum()), float(-d[d <= 0].sum())
+
+
+def segment_metrics(lat: np.ndarray, lon: np.ndarray, ele: np.ndarray, time: np.ndarray) -> dict:
+    """the moving data and elevation gain of a single segment"""
+    d = distances(lat, lon, ele)
+    seconds = time[1:] - time[:-1]
+    # steps without times are NaN and skipped like steps without movement
+    with np.errstate(invalid="ignore", divide="ignore"):
+        counted = (seconds > 0) & (d != 0)
+        speed_kmh = (d / 1000) / (seconds / 3600)
+        stopped = counted & (speed_kmh <= STOPPED_SPEED_THRESHOLD)
+    moving = counted & ~stopped
+    # gpxpy only collects the speeds from the first moving step on
+    moving_steps = np.flatnonzero(moving)
+    if len(moving_steps):
+        counted[:moving_steps[0]] = False
+    else:
+        counted[:] = False
+    uphill, downhill = uphill_downhill(ele)
+    return {
+        "moving_time": float(seconds[moving].sum()),
+        "stopped_time": float(seconds[stopped].sum()),
+        "moving_distance": float(d[moving].sum()),
+        "max_speed": max_speed(d[counted] / seconds[counted], d[counted]),
+        "uphill": uphill,
+        "downhill": downhill,
+    }
+
+
+def track_metrics(lat, lon, ele, time, segment_sizes: Sequence[int]) -> dict:
+    """
+    compute the metrics of a track from the arrays (or buffers) of the coordinates of its points,
+    which are split into segments of segment_sizes points. times are seconds since the epoch, missing
+    elevations and times are NaN. returns the arguments of `kmtracker.db.RideMetrics.values`
+    """
+    lat, lon, ele, time = (np.frombuffer(values, dtype="d") for values in (lat, lon, ele, time))
+    result = {
+        "moving_time": 0., "stopped_time": 0., "moving_distance": 0., "max_speed": 0.,
+        "uphill": 0., "downhill": 0.,
+    }
+    start = 0
+    for size in segment_sizes:
+        end = start + size
+        segment = segment_metrics(lat[start:end], lon[start:end], ele[start:end], time[start:end])
+        start = end
+        speed = segment.pop("max_speed")
+        if speed is not None and speed > result["max_speed"]:
+            result["max_speed"] = speed
+        for name, value in segment.items():
+            result[name] += value
+    if len(lat):
+        result["bounds"] = (float(lat.min()), float(lat.max()), float(lon.min()), float(lon.max()))
+    else:
+        result["bounds"] = None
+    result["n_points"] = len(lat)
+    return result
+
+
+def simplified(lat, lon, ele, time, tolerance: float=0, interval: float=0) -> np.ndarray:
+    """
+    select the points of a track to keep when it is simplified: first at most one point per interval
+    seconds, then the points that are needed to stay within tolerance meters of the remaining points
+    (Ramer-Douglas-Peucker, elevation counts like a third coordinate). the first and the last point
+    are always kept. returns a boolean mask of the points
+    """
+    lat, lon, ele, time = (np.frombuffer(values, dtype="d") for values in (lat, lon, ele, time))
+    keep = np.ones(len(lat), dtype=bool)
+    if len(lat) < 3:
+        return keep
+    if interval > 0:
+        # points without time are kept, the windows start at the first point
+        window = np.floor((time - time[0]) / interval)
+        keep[1:] = ~(window[1:] == window[:-1])
+        keep[-1] = True
+    if tolerance > 0:
+        indexes = np.flatnonzero(keep)
+        keep[:] = False
+        keep[indexes[_douglas_peucker(lat[indexes], lon[indexes], ele[indexes], tolerance)]] = True
+    return keep
+
+
+def _douglas_peucker(lat: np.ndarray, lon: np.ndarray, ele: np.ndarray, tolerance: float) -> np.ndarray:
+    # meters on a plane that touches the earth in the middle of the track
+    y = lat * ONE_DEGREE
+    x = lon * ONE_DEGREE * np.cos(np.radians((lat.min() + lat.max()) / 2))
+    z = np.nan_to_num(ele, nan=np.nanmean(ele) if not np.isnan(ele).all() else 0)
+    points = np.stack([x, y, z], axis=1)
+    keep = np.zeros(len(lat), dtype=bool)
+    keep[0] = keep[-1] = True
+    # the ranges between kept points that may need another point, all ranges of a level at once
+    starts, ends = np.array([0]), np.array([len(lat) - 1])
+    while len(starts):
+        sizes = ends - starts - 1
+        starts, ends, sizes = starts[sizes > 0], ends[sizes > 0], sizes[sizes > 0]
+        if not len(starts):
+            break
+        offsets = np.cumsum(sizes) - sizes
+        ranges = np.repeat(np.arange(len(starts)), sizes)
+        inner = starts[ranges] + 1 + np.arange(sizes.sum()) - offsets[ranges]
+        # the distance of the points in between to the line from start to end
+        start, d = points[starts], points[ends] - points[starts]
+        length = (d * d).sum(axis=1)
+        p = points[inner] - start[ranges]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.clip((p * d[ranges]).sum(axis=1) / length[ranges], 0, 1)
+        t[length[ranges] == 0] = 0
+        distance = np.sqrt(((p - t[:, None] * d[ranges]) ** 2).sum(axis=1))
+        # split the ranges at their farthest point if it is too far
+        farthest = np.maximum.reduceat(distance, offsets)
+        candidates = np.flatnonzero(distance == farthest[ranges])
+        split_ranges, first = np.unique(ranges[candidates], return_index=True)
+        split = inner[candidates[first]]
+        too_far = farthest[split_ranges] > tolerance
+        split, split_ranges = split[too_far], split_ranges[too_far]
+        keep[split] = True
+        starts = np.concatenate([starts[split_ranges], split])
+        ends = np.concatenate([split, ends[split_ranges]])
+    return keep
+
+
+def path_length(lat, lon, ele) -> float:
+    """the length of the path through all points in meters"""
+    lat, lon, ele = (np.frombuffer(values, dtype="d") for values in (lat, lon, ele))
+    return float(distances(lat, lon, ele).sum())
+
+
+def grid_cells(lat, lon, cell_size: float, segment_sizes: Sequence[int]=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    the cells of a grid that a track passes through, each cell once. the cells are cell_size meters
+    of latitude high and as many degrees of longitude wide (so they are narrower away from the equator),
+    a cell is given by the indexes of its latitude and longitude: cell i spans i * size to (i + 1) * size.
+    the track is interpolated between its points so that simplified or sparsely recorded tracks
+    have no holes, except for steps longer than `MAX_GRID_STEP` and from one of the segments of
+    segment_sizes points to the next (without segment_sizes the track is a single segment)
+    """
+    lat, lon = (np.frombuffer(values, dtype="d") for values in (lat, lon))
+    if not len(lat):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # at least two samples per cell along every step
+    d = distances(lat, lon, np.zeros(len(lat)))
+    n = np.where(d > MAX_GRID_STEP, 1, np.maximum(np.ceil(d / (cell_size / 2)), 1)).astype(np.int64)
+    if segment_sizes is not None:
+        # the steps from the last point of a segment to the first one of the next
+        gaps = np.cumsum(np.asarray(segment_sizes, dtype=np.int64))[:-1] - 1
+        n[gaps[(gaps >= 0) & (gaps < len(n))]] = 1
+    steps = np.repeat(np.arange(len(n)), n)
+    fraction = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / n[steps]
+    lat = np.append(lat[steps] + fraction * (lat[steps + 1] - lat[steps]), lat[-1])
+    lon = np.append(lon[steps] + fraction * (lon[steps + 1] - lon[steps]), lon[-1])
+    size = cell_size / ONE_DEGREE
+    return unique_cells(np.floor(lat / size).astype(np.int64), np.floor(lon / size).astype(np.int64))
+
+
+def unique_cells(
+    lat_cells: np.ndarray, lon_cells: np.ndarray, counts: bool=False
+) -> tuple[np.ndarray, ...]:
+    """
+    the distinct cells of lat_cells and lon_cells (see `grid_cells`), optionally with how often they occur.
+    each cell is packed into a single integer, which is a lot faster to sort than pairs of indexes
+    """
+    keys = lat_cells * 2 ** 32 + (lon_cells + 2 ** 31)
+    if counts:
+        keys, n = np.unique(keys, return_counts=True)
+        return keys // 2 ** 32, keys % 2 ** 32 - 2 ** 31, n
+    keys = np.unique(keys)
+    return keys // 2 ** 32, keys % 2 ** 32 - 2 ** 31
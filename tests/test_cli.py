@@ -1,5 +1,12 @@
+from contextlib import ExitStack, closing
+import gzip
+import json
 import pytest
+import os
 import subprocess
+import sys
+import zipfile
+from pathlib import Path
 from datetime import datetime, timedelta
 
 from kmtracker import db
@@ -94,3 +101,218 @@ def test_add_with_alias(setup):
     assert ride.distance == 12.3
     assert ride.duration == timedelta(minutes=35)
     assert ride.comment == "test"
+
+
+def test_show(setup):
+    _db, command = setup
+    ride, _ = db.Ride.from_gpx(_db, Path(__file__).parent / "data" / "two_tracks.gpx")
+    output = subprocess.check_output(
+        command + ["show", str(ride.pk)]
+    ).decode("utf-8")
+    assert "time in motion         : 00:09:35" in output
+    assert "uphill                 : 67.0 m" in output
+
+
+@pytest.mark.parametrize("parser", ["gpxpy", "stream"])
+def test_loadgpx_metrics_engine(setup, parser):
+    _db, command = setup
+    subprocess.check_output(command + [
+        "loadgpx", "--parser", parser, "--metrics-engine", "gpxpy", str(Path(__file__).parent / "data" / "two_tracks.gpx")
+    ])
+    output = subprocess.check_output(command + ["show", "1"]).decode("utf-8")
+    assert "time in motion         : 00:09:35" in output
+    assert "uphill                 : 67.0 m" in output
+
+
+def imported_modules(command: list[str]) -> set[str]:
+    """run kmtracker with -X importtime and return the names of all modules it imported"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "kmtracker"] + command[1:],
+        capture_output=True, check=True,
+    )
+    return {
+        line.rsplit("|", 1)[1].strip()
+        for line in result.stderr.decode("utf-8").splitlines()
+        if line.startswith("import time:")
+    }
+
+
+@pytest.mark.parametrize("args", [["add", "12", "-t", "2025-08-01"], ["ls"]])
+def test_no_heavy_imports(setup, args):
+    _db, command = setup
+    modules = imported_modules(command + args)
+    assert "kmtracker.cli" in modules
+    for heavy in ["matplotlib", "dayplot", "gpxpy"]:
+        assert heavy not in modules
+
+
+def test_ls_pages(setup):
+    _db, command = setup
+    db.Ride.bulk_save(_db, [
+        db.Ride(_db, timestamp=datetime(2025, 1, 1) + timedelta(days=i), distance=i, segments=1)
+        for i in range(1, 251)
+    ])
+    output = subprocess.check_output(command + ["ls", "-n", "10", "--page", "3"]).decode("utf-8")
+    ids = [int(line.split()[1]) for line in output.splitlines() if line.startswith("│")]
+    assert ids == list(range(230, 220, -1))
+    output = subprocess.check_output(command + ["ls", "-n", "2", "--after", "5"]).decode("utf-8")
+    assert [int(line.split()[1]) for line in output.splitlines() if line.startswith("│")] == [4, 3]
+    # more rides than fit into one table are streamed, with the header only once
+    output = subprocess.check_output(command + ["ls", "--pager"], env=os.environ | {"PAGER": "cat"}).decode("utf-8")
+    assert output.count("Distance") == 1
+    assert " 250 " in output and " 1 " in output
+
+
+def test_filters(setup):
+    _db, command = setup
+    db.Ride.bulk_save(_db, [
+        db.Ride(_db, timestamp=datetime(2025, 8, day), distance=day, duration=timedelta(hours=1), segments=1)
+        for day in range(1, 11)
+    ])
+    output = subprocess.check_output(
+        command + ["ls", "--since", "2025-08-03", "--until", "2025-08-08", "--min-distance", "5"]
+    ).decode("utf-8")
+    assert [int(line.split()[1]) for line in output.splitlines() if line.startswith("│")] == [8, 7, 6, 5]
+    output = subprocess.check_output(command + ["stats", "--min-speed", "9", "--no-gpx"]).decode("utf-8")
+    assert "19.0 km (2 rides)" in output
+
+
+def test_report(setup):
+    _db, command = setup
+    db.Ride.bulk_save(_db, [
+        db.Ride(_db, timestamp=datetime(2024, 3, 4), distance=10, duration=timedelta(minutes=30), segments=1),
+        db.Ride(_db, timestamp=datetime(2025, 3, 5), distance=12, duration=timedelta(minutes=40), segments=1),
+    ])
+    output = subprocess.check_output(command + ["report", "--by", "week", "--compare"]).decode("utf-8")
+    assert "2025-W10" in output
+    assert "10.0 (1)" in output and "+20%" in output
+    # rides without segments have no longest distance
+    db.Ride(_db, timestamp=datetime(2025, 6, 2), distance=7, segments=None).save()
+    output = subprocess.check_output(command + ["report", "--by", "week", "--compare"]).decode("utf-8")
+    assert "2025-W23" in output
+
+
+def test_loadgpx_many(setup, tmp_path):
+    _db, command = setup
+    gpx = (Path(__file__).parent / "data" / "two_tracks.gpx").read_text()
+    (tmp_path / "tracks" / "2024").mkdir(parents=True)
+    (tmp_path / "tracks" / "a.gpx").write_text(gpx)
+    (tmp_path / "tracks" / "2024" / "b.gpx").write_text(gpx.replace("2025-08-10", "2024-08-10"))
+    (tmp_path / "tracks" / "notes.txt").write_text("not a track")
+    (tmp_path / "broken.gpx").write_text("<gpx")
+    output = subprocess.check_output(
+        command + ["loadgpx", "--jobs", "2", str(tmp_path / "tracks"), str(tmp_path / "*.gpx")]
+    ).decode("utf-8")
+    assert "broken.gpx" in output
+    assert "added 4 rides from 2 files, 1 failed" in output
+    assert len(db.Ride.get_latest_entries(_db, -1)) == 4
+    # importing the same files again adds nothing
+    output = subprocess.check_output(command + ["loadgpx", str(tmp_path / "tracks")]).decode("utf-8")
+    assert "added 0 rides from 2 files" in output
+    assert len(db.Ride.get_latest_entries(_db, -1)) == 4
+
+
+def test_loadgpx_simplified(setup):
+    _db, command = setup
+    with open(command[2], "a") as f:
+        f.write("[gpx]\nsimplify_tolerance = 10\n")
+    output = subprocess.check_output(
+        command + ["loadgpx", str(Path(__file__).parent / "data" / "two_tracks.gpx")]
+    ).decode("utf-8")
+    assert "of 220 track points" in output
+    ride = db.Ride.get_last_row(_db)
+    assert ride.get_track_points().n_points < ride.get_metrics().n_points
+    output = subprocess.check_output(command + ["show", str(ride.pk)]).decode("utf-8")
+    assert f"stored track points    : {ride.get_track_points().n_points} of 100" in output
+    # show doesn't extract the points of rides that have none stored
+    with closing(_db.cursor()) as cursor:
+        cursor.execute("DELETE FROM track_points")
+    _db.commit()
+    output = subprocess.check_output(command + ["show", str(ride.pk)]).decode("utf-8")
+    assert "stored track points" not in output
+    assert db.TrackPoints.get_simplification(_db, ride.pk) is None
+    # neither does it compute missing metrics
+    with closing(_db.cursor()) as cursor:
+        cursor.execute("DELETE FROM ride_metrics")
+    _db.commit()
+    output = subprocess.check_output(command + ["show", str(ride.pk)]).decode("utf-8")
+    assert "time in motion" not in output
+    assert "run `kmtracker backfill`" in output
+    with pytest.raises(KeyError):
+        db.RideMetrics.get_by_ride(_db, ride.pk)
+
+
+def test_loadgpx_archive(setup, tmp_path):
+    _db, command = setup
+    gpx = (Path(__file__).parent / "data" / "two_tracks.gpx").read_text()
+    with zipfile.ZipFile(tmp_path / "export.zip", "w") as archive:
+        archive.writestr("activities/a.gpx", gpx)
+        archive.writestr("activities/b.gpx.gz", gzip.compress(gpx.replace("2025-08-10", "2024-08-10").encode()))
+        archive.writestr("activities/broken.gpx.gz", b"not gzip")
+        archive.writestr("activities/notes.txt", "not a track")
+    (tmp_path / "c.gpx.gz").write_bytes(gzip.compress(gpx.replace("2025-08-10", "2023-08-10").encode()))
+    output = subprocess.check_output(
+        command + ["loadgpx", str(tmp_path / "export.zip"), str(tmp_path / "c.gpx.gz")]
+    ).decode("utf-8")
+    assert "Not a gzipped file" in output
+    assert "added 6 rides from 3 files, 1 failed" in output
+    # a file that was imported from an archive is the same file when it is extracted
+    (tmp_path / "a.gpx").write_text(gpx)
+    output = subprocess.check_output(command + ["loadgpx", str(tmp_path / "a.gpx")]).decode("utf-8")
+    assert "added 0 rides from 1 files" in output
+
+
+def test_find_gpx_files_closes_archives(tmp_path):
+    from kmtracker.cli import find_gpx_files
+    with zipfile.ZipFile(tmp_path / "export.zip", "w") as archive:
+        archive.writestr("a.gpx", "<gpx></gpx>")
+    with ExitStack() as archives:
+        [path] = find_gpx_files([str(tmp_path / "export.zip")], archives)
+        assert db.read_gpx(path) == "<gpx></gpx>"
+    assert path.root.fp is None
+
+
+def test_export(setup, tmp_path):
+    _db, command = setup
+    db.Ride.from_gpx(_db, Path(__file__).parent / "data" / "two_tracks.gpx")
+    db.Ride(_db, distance=12, timestamp=datetime(2025, 8, 11), comment='to "work", and back', segments=1).save()
+    output = subprocess.check_output(command + ["export", "--metrics", "--no-gpx"]).decode("utf-8")
+    assert output.splitlines()[0].startswith("id,distance_km,timestamp,")
+    assert output.splitlines()[1].endswith('"to ""work"", and back",1,,,,,,,,,,,,')
+    subprocess.check_call(command + ["export", "-o", str(tmp_path / "rides.ndjson"), "--with-gpx", str(tmp_path / "gpx")])
+    rows = [json.loads(line) for line in (tmp_path / "rides.ndjson").read_text().splitlines()]
+    assert len(rows) == 3
+    assert rows[0]["gpx_file"] == rows[1]["gpx_file"]
+    assert rows[2]["gpx_file"] is None
+    assert (tmp_path / "gpx" / rows[0]["gpx_file"]).read_text() == (Path(__file__).parent / "data" / "two_tracks.gpx").read_text()
+
+
+def test_plot_output(setup, tmp_path):
+    _db, command = setup
+    with open(tmp_path / "test.conf", "a") as f:
+        f.write(f"[cache]\npath = {tmp_path}/cache\n")
+    db.Ride(_db, distance=12, timestamp=datetime(2024, 8, 11), segments=1).save()
+    db.Ride(_db, distance=30, timestamp=datetime(2025, 8, 12), segments=1).save()
+    subprocess.check_call(command + ["plot", "-o", str(tmp_path / "plot.png")])
+    assert (tmp_path / "plot.png").read_bytes().startswith(b"\x89PNG")
+    cached = {path: path.stat().st_mtime_ns for path in (tmp_path / "cache" / "plots").iterdir()}
+    assert len(cached) == 2
+    # only the year that changed is rendered again (the color scale stays the same)
+    db.Ride(_db, distance=20, timestamp=datetime(2025, 8, 13), segments=1).save()
+    subprocess.check_call(command + ["plot", "-o", str(tmp_path / "plot.svg")])
+    subprocess.check_call(command + ["plot", "-o", str(tmp_path / "plot.png")])
+    assert "<svg" in (tmp_path / "plot.svg").read_text()
+    pngs = {path for path in (tmp_path / "cache" / "plots").iterdir() if path.suffix == ".png"}
+    assert len(pngs) == 3
+    assert [path.name[:4] for path in pngs - set(cached)] == ["2025"]
+
+
+def test_heatmap(setup, tmp_path):
+    _db, command = setup
+    db.Ride.from_gpx(_db, Path(__file__).parent / "data" / "two_tracks.gpx")
+    subprocess.check_call(command + ["heatmap", "-o", str(tmp_path / "heatmap.png"), "--cell-size", "20"])
+    assert (tmp_path / "heatmap.png").read_bytes().startswith(b"\x89PNG")
+    assert db.TrackGrid.update_missing(_db, 20) == 0
+    result = subprocess.run(command + ["heatmap", "-o", str(tmp_path / "none.png"), "--no-gpx"], capture_output=True)
+    assert "no matching entries" in result.stdout.decode("utf-8")
+    assert not (tmp_path / "none.png").exists()
@@ -1,8 +1,16 @@
-from datetime import datetime, timedelta
+from array import array
+from configparser import ConfigParser
+from contextlib import closing, contextmanager
+from datetime import date, datetime, timedelta, timezone
+import importlib
+import math
+from pathlib import Path
 import pytest
+import re
 import sqlite3
 
-from kmtracker import db
+from kmtracker import db, get_pragmas, gpxstream
+from kmtracker._migrations import SCHEMA_VERSION
 
 
 @pytest.fixture
@@ -60,4 +68,630 @@ def test_total_distance(database):
 def test_alias_unique(database):
     db.Alias(database, name="test", distance=12).save()
     with pytest.raises(sqlite3.IntegrityError):
-        db.Alias(database, name="test", distance=34).save()
\ No newline at end of file
+        db.Alias(database, name="test", distance=34).save()
+
+
+def test_deferred_gpx(database):
+    db.Ride(database, timestamp=datetime.now(), distance=12, gpx="<gpx></gpx>").save()
+    db.Ride(database, timestamp=datetime.now(), distance=3.4).save()
+    with_gpx, without_gpx = sorted(db.Ride.get_latest_entries(database, -1), key=lambda r: r.pk)
+    assert with_gpx._gpx is None
+    assert with_gpx.has_gpx
+    assert not without_gpx.has_gpx
+    assert with_gpx.serialize_pretty()["gpx"] == "✅"
+    # the payload is fetched on access
+    assert with_gpx.gpx == "<gpx></gpx>"
+    assert without_gpx.gpx is None
+
+
+def test_update_keeps_deferred(database):
+    db.GpxBlob(database, hash="abc", data="<gpx></gpx>").save()
+    blob = db.GpxBlob.get_by_hash(database, "abc")
+    blob.hash = "def"
+    blob.save()
+    assert "data" not in blob._deferred
+    assert db.GpxBlob.get_last_row(database).data == "<gpx></gpx>"
+
+
+def test_gpx_blobs_deduplicated(database):
+    for distance in (12, 3.4):
+        db.Ride(database, timestamp=datetime.now(), distance=distance, gpx="<gpx></gpx>").save()
+    ride1, ride2 = db.Ride.get_latest_entries(database, -1)
+    assert ride1.gpx_id == ride2.gpx_id
+    with closing(database.cursor()) as cursor:
+        assert cursor.execute("SELECT COUNT(*) FROM gpx_blobs").fetchone()[0] == 1
+    assert ride1.gpx == ride2.gpx == "<gpx></gpx>"
+
+
+def test_replaced_gpx_blob_deleted(database):
+    ride = db.Ride(database, timestamp=datetime.now(), distance=12, gpx="<gpx></gpx>")
+    ride.save()
+    shared = db.Ride(database, timestamp=datetime.now(), distance=3.4, gpx="<gpx></gpx>")
+    shared.save()
+    for raw in ('<gpx version="1.1"></gpx>', '<gpx version="1.0"></gpx>'):
+        ride.gpx = raw
+        ride.save()
+    with closing(database.cursor()) as cursor:
+        # the first blob is still used by the other ride, the second one is gone
+        assert cursor.execute("SELECT COUNT(*) FROM gpx_blobs").fetchone()[0] == 2
+    assert db.Ride.get_row(database, ride.pk).gpx == '<gpx version="1.0"></gpx>'
+    assert db.Ride.get_row(database, shared.pk).gpx == "<gpx></gpx>"
+
+
+def test_migrate_gpx_blobs():
+    _db = db.Database(":memory:")
+    with closing(_db.cursor()) as cursor:
+        for module in ["m00_add_migrations_table", "m01_add_rides_table", "m02_change_duration_to_int", "m03_add_gpx_column"]:
+            importlib.import_module(f"kmtracker._migrations.{module}").run(cursor)
+            cursor.execute("INSERT INTO _migrations (name) VALUES (?)", (module,))
+        cursor.executemany(
+            "INSERT INTO rides (distance_km, timestamp, gpx) VALUES (?, ?, ?)",
+            [(1, "2025-01-01", "<gpx>a</gpx>"), (2, "2025-01-01", "<gpx>a</gpx>"), (3, "2025-01-02", None)]
+        )
+    _db.migrate()
+    ride1, ride2, ride3 = sorted(db.Ride.get_latest_entries(_db, -1), key=lambda r: r.pk)
+    assert ride1.gpx_id == ride2.gpx_id
+    assert ride1.gpx == "<gpx>a</gpx>"
+    assert ride3.gpx is None
+    _db.close()
+
+
+GPX_PATH = Path(__file__).parent / "data" / "two_tracks.gpx"
+
+
+def test_from_gpx_metrics(database):
+    lake, home = db.Ride.from_gpx(database, GPX_PATH)
+    assert lake.gpx_id == home.gpx_id
+    metrics = lake.get_metrics()
+    assert metrics.ride_id == lake.pk
+    assert metrics.moving_time == timedelta(seconds=575)
+    assert metrics.n_points == 120
+    assert round(metrics.moving_distance, 3) == round(lake.distance, 3)
+    assert db.RideMetrics.get_by_ride(database, home.pk).n_points == 100
+
+
+def test_backfill_metrics(database):
+    lake, home = db.Ride.from_gpx(database, GPX_PATH)
+    with closing(database.cursor()) as cursor:
+        cursor.execute("DELETE FROM ride_metrics")
+    database.commit()
+    assert db.Ride.count_missing_track_data(database) == 2
+    assert sum(db.Ride.backfill_track_data(database, batch_size=1)) == 2
+    assert db.Ride.count_missing_track_data(database) == 0
+    # each ride gets the metrics of its own track
+    assert db.RideMetrics.get_by_ride(database, lake.pk).n_points == 120
+    assert db.RideMetrics.get_by_ride(database, home.pk).n_points == 100
+
+
+def test_track_points(database):
+    lake, _ = db.Ride.from_gpx(database, GPX_PATH)
+    points = db.Ride.get_row(database, lake.pk).get_track_points()
+    assert points.n_points == len(points.lat) == len(points.time) == 120
+    assert points.lat[0] == 52.5
+    assert points.time[0] == datetime(2025, 8, 10, 9, tzinfo=timezone.utc).timestamp()
+    arrays = points.as_numpy()
+    assert arrays["lon"][0] == 13.4
+    assert arrays["ele"].shape == (120,)
+
+
+def test_daily_totals(database):
+    db.Ride(database, timestamp=datetime(2025, 8, 11, 10), distance=12, duration=timedelta(minutes=30), segments=1).save()
+    db.Ride(database, timestamp=datetime(2025, 8, 11, 18), distance=40, segments=2).save()
+    ride = db.Ride(database, timestamp=datetime(2025, 8, 12, 10), distance=20, duration=timedelta(hours=1), segments=1)
+    ride.save()
+    assert tuple(db.Ride.get_max_distance_by_day(database)) == (52, "2025-08-11")
+    assert tuple(db.Ride.get_max_distance_entry(database)) == (20, "2025-08-11")
+    assert tuple(db.Ride.get_max_speed_entry(database)) == (24, "2025-08-11")
+    assert db.Ride.get_total_rides(database) == 4
+    # moving a ride to another day updates both days
+    ride.timestamp = datetime(2025, 8, 11, 20)
+    ride.save()
+    assert tuple(db.Ride.get_max_distance_by_day(database)) == (72, "2025-08-11")
+    assert db.Ride.get_average_speed(database) == 32 / 1.5
+    assert db.DailyTotal.check(database) == 0
+
+
+def test_daily_distances(database):
+    db.Ride(database, timestamp=datetime(2025, 8, 12, 10), distance=20, segments=1).save()
+    db.Ride(database, timestamp=datetime(2025, 8, 11, 10), distance=12, segments=1).save()
+    db.Ride(database, timestamp=datetime(2025, 8, 11, 18), distance=40, segments=2).save()
+    assert db.DailyTotal.get_distances(database) == [("2025-08-11", 52), ("2025-08-12", 20)]
+    assert db.DailyTotal.get_distances(database, db.RideFilter(segments=1)) == [("2025-08-11", 12), ("2025-08-12", 20)]
+
+
+def test_daily_totals_rebuild(database):
+    db.Ride(database, timestamp=datetime(2025, 8, 11, 10), distance=12).save()
+    with closing(database.cursor()) as cursor:
+        cursor.execute("UPDATE daily_totals SET distance_km = 1")
+    assert db.DailyTotal.check(database) == 1
+    db.DailyTotal.rebuild(database)
+    assert db.DailyTotal.check(database) == 0
+    assert db.Ride.get_total_distance(database) == 12
+
+
+def test_streaks(database):
+    days = [
+        datetime(2025, 8, 1), datetime(2025, 8, 2), datetime(2025, 8, 2, 18), datetime(2025, 8, 3),
+        datetime(2025, 8, 10), datetime(2025, 8, 20), datetime(2025, 8, 21),
+    ]
+    for day in days:
+        db.Ride(database, timestamp=day, distance=10, segments=1).save()
+    assert db.Ride.get_streaks(database) == {date(2025, 8, 21): 2, date(2025, 8, 3): 3}
+    assert db.Ride.get_streaks(database).most_common(1) == [(date(2025, 8, 3), 3)]
+    # weeks starting on 2025-07-28, 2025-08-04, 2025-08-18
+    assert db.Ride.get_weekly_streaks(database) == {date(2025, 8, 4): 2}
+    assert db.Ride.get_current_streak(database, date(2025, 8, 3)) == 3
+    assert db.Ride.get_current_streak(database, date(2025, 8, 21)) == 2
+    assert db.Ride.get_current_streak(database, date(2025, 8, 22)) == 0
+
+
+@contextmanager
+def recorded_queries(database):
+    """record the sql (with bound parameters) of every statement executed on database"""
+    queries = []
+    database.connection.set_trace_callback(queries.append)
+    try:
+        yield queries
+    finally:
+        database.connection.set_trace_callback(None)
+
+
+def full_scans(database, query: str) -> list[str]:
+    """
+    return the steps of the query plan of query that scan a table of the models without an index.
+    the daily totals are meant to be aggregated as a whole, so they are not checked
+    """
+    tables = "|".join(model.table for model in [db.Ride, db.Alias, db.GpxBlob, db.RideMetrics, db.TrackPoints])
+    with closing(database.cursor()) as cursor:
+        plan = cursor.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+    return [step for *_, step in plan if re.fullmatch(f"SCAN ({tables})( AS \\w+)?", step)]
+
+
+def test_query_plans(database):
+    with recorded_queries(database) as queries:
+        db.Ride(database, timestamp=datetime(2025, 8, 9), distance=3, segments=1).save()
+        lake, _ = db.Ride.from_gpx(database, GPX_PATH)
+        lake.comment = "lake"
+        lake.save()
+        db.Alias(database, name="test", distance=1).save()
+        db.Alias.get_by_name(database, "test")
+        db.Alias.get_all(database)
+        db.Ride.get_latest_entries(database, 5)
+        db.Ride.get_summary(database)
+        db.Ride.get_current_streak(database, date(2025, 8, 10))
+        db.Ride.count_missing_track_data(database)
+        list(db.Ride.backfill_track_data(database))
+        db.Ride.get_row(database, lake.pk).get_metrics()
+        db.Ride.get_row(database, lake.pk).get_track_points()
+        db.GpxBlob.get_row(database, lake.gpx_id).data
+    queries = [q for q in queries if not q.startswith(("--", "BEGIN", "COMMIT"))]
+    assert queries
+    for query in queries:
+        assert not full_scans(database, query), query
+
+
+def test_daily_totals_trigger_uses_index(database):
+    # the statement that the triggers run to recompute a day
+    query = db.DailyTotal.aggregate_query("WHERE DATE(timestamp) = DATE('2025-08-10')")
+    with closing(database.cursor()) as cursor:
+        plan = [step for *_, step in cursor.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()]
+    assert any("USING INDEX rides_day" in step for step in plan), plan
+
+
+def test_bulk_save(database):
+    existing = db.Ride(database, timestamp=datetime(2025, 8, 1), distance=1, segments=1)
+    existing.save()
+    existing.distance = 2
+    rides = [
+        db.Ride(database, timestamp=datetime(2025, 8, day), distance=day, segments=1)
+        for day in range(2, 12)
+    ]
+    with recorded_queries(database) as queries:
+        db.Ride.bulk_save(database, [existing] + rides)
+    assert [ride.pk for ride in rides] == list(range(existing.pk + 1, existing.pk + 11))
+    assert db.Ride.get_row(database, rides[3].pk).distance == 5
+    assert db.Ride.get_row(database, existing.pk).distance == 2
+    assert queries.count("COMMIT") == 1
+
+
+def test_transaction_rollback(database):
+    with pytest.raises(sqlite3.IntegrityError):
+        with database.transaction():
+            db.Alias(database, name="first", distance=1).save()
+            db.Alias(database, name="second", distance=2).save()
+            db.Alias(database, name="first", distance=3).save()
+    assert db.Alias.get_all(database) == []
+
+
+def test_pragmas(tmp_path):
+    config = ConfigParser()
+    config["db"] = {"path": str(tmp_path / "test.sqlite3"), "profile": "fast", "synchronous": "FULL"}
+    pragmas = get_pragmas(config)
+    assert pragmas["journal_mode"] == "WAL"
+    assert pragmas["synchronous"] == "FULL"
+    _db = db.Database(tmp_path / "test.sqlite3", pragmas)
+    try:
+        with closing(_db.cursor()) as cursor:
+            assert cursor.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            assert cursor.execute("PRAGMA synchronous").fetchone()[0] == 2
+            assert cursor.execute("PRAGMA cache_size").fetchone()[0] == -16000
+    finally:
+        _db.close()
+    with pytest.raises(ValueError):
+        db.Database(":memory:", {"synchronous": "OFF; DROP TABLE rides"})
+
+
+def test_schema_version():
+    migrations = list((Path(db.__file__).parent / "_migrations").glob("m*.py"))
+    assert len(migrations) == SCHEMA_VERSION
+
+
+def test_migrate_fast_path(database):
+    with closing(database.cursor()) as cursor:
+        assert cursor.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    with recorded_queries(database) as queries:
+        database.migrate()
+    assert queries == ["PRAGMA user_version"]
+
+
+def test_delete_ride_cascades(database):
+    lake, home = db.Ride.from_gpx(database, GPX_PATH)
+    db.TrackGrid.update_missing(database, 50)
+    with closing(database.cursor()) as cursor:
+        cursor.execute("DELETE FROM rides WHERE id = ?", (lake.pk,))
+        for table in ("ride_metrics", "track_points", "track_grids"):
+            assert [id for id, in cursor.execute(f"SELECT ride_id FROM {table}")] == [home.pk]
+
+
+def test_slots(database):
+    db.Ride(database, timestamp=datetime(2025, 8, 1), distance=1, segments=1, gpx="<gpx></gpx>").save()
+    ride = db.Ride.get_last_row(database)
+    assert not hasattr(ride, "__dict__")
+    assert "distance" in db.Ride.__slots__
+    # deferred columns are loaded through a descriptor instead of a slot
+    assert "data" not in db.GpxBlob.__slots__
+    assert db.GpxBlob.get_row(database, ride.gpx_id).data == "<gpx></gpx>"
+
+
+def test_keyset_pagination(database):
+    # two rides at the same time are ordered by ID
+    timestamps = [datetime(2025, 8, day) for day in range(1, 8)] + [datetime(2025, 8, 3)]
+    db.Ride.bulk_save(database, [db.Ride(database, timestamp=t, distance=1, segments=1) for t in timestamps])
+    everything = [ride.pk for ride in db.Ride.iter_latest_entries(database)]
+    assert everything == [7, 6, 5, 4, 8, 3, 2, 1]
+    page = [ride.pk for ride in db.Ride.iter_latest_entries(database, 3, after=db.Ride.get_row(database, 4).sort_key)]
+    assert page == [8, 3, 2]
+    assert db.Ride.get_sort_key_at(database, 3) == db.Ride.get_row(database, 4).sort_key
+    assert db.Ride.get_sort_key_at(database, 8) is None
+
+
+def test_ride_filter(database):
+    rides = [
+        db.Ride(database, timestamp=datetime(2025, 8, 1, 8), distance=10, duration=timedelta(minutes=30), segments=1),
+        db.Ride(database, timestamp=datetime(2025, 8, 1, 18), distance=30, duration=timedelta(hours=2), segments=2),
+        db.Ride(database, timestamp=datetime(2025, 8, 2, 9), distance=5, segments=1),
+        db.Ride(database, timestamp=datetime(2025, 8, 3, 9), distance=20, duration=timedelta(hours=1), segments=1),
+    ]
+    db.Ride.bulk_save(database, rides)
+
+    august_2 = db.RideFilter(since=date(2025, 8, 2), until=date(2025, 8, 2))
+    assert [ride.pk for ride in db.Ride.iter_latest_entries(database, filter=august_2)] == [3]
+    fast = db.RideFilter(min_speed=18)
+    assert [ride.pk for ride in db.Ride.iter_latest_entries(database, filter=fast)] == [4, 1]
+    single = db.RideFilter(segments=1, max_distance=15)
+    assert [ride.pk for ride in db.Ride.get_latest_entries(database, 10, filter=single)] == [3, 1]
+    assert db.Ride.get_sort_key_at(database, 1, single) == rides[0].sort_key
+
+    # date filters read the daily totals, others aggregate the matching rides
+    since = db.RideFilter(since=date(2025, 8, 2))
+    assert db.Ride.get_total_distance(database, since) == 25
+    assert db.Ride.get_total_rides(database, since) == 2
+    long = db.RideFilter(min_duration=timedelta(minutes=45))
+    assert db.Ride.get_total_distance(database, long) == 50
+    assert db.Ride.get_average_speed(database, long) == pytest.approx(50 / 3)
+    assert tuple(db.Ride.get_max_distance_entry(database, long)) == (20, "2025-08-03")
+    assert db.Ride.get_streaks(database, db.RideFilter(has_gpx=False)) == {date(2025, 8, 3): 3}
+    assert db.Ride.get_streaks(database, fast) == {}
+    with pytest.raises(ValueError):
+        db.Ride.get_summary(database, db.RideFilter(min_distance=100))
+    # all conditions are parameterized and the filtered rides are found via the index on timestamp
+    with recorded_queries(database) as queries:
+        list(db.Ride.iter_latest_entries(database, filter=august_2))
+    assert not full_scans(database, queries[-1])
+
+
+def test_search(database):
+    comments = ["to the lake", "work", "Lake Constance, around the whole lake", "back from the lakeside café", None]
+    db.Ride.bulk_save(database, [
+        db.Ride(database, timestamp=datetime(2025, 8, i + 1), distance=10, comment=comment, segments=1)
+        for i, comment in enumerate(comments)
+    ])
+    # ranked by relevance, words match case-insensitively and by prefix
+    assert [ride.pk for ride in db.Ride.iter_search(database, "lake")] == [3, 1, 4]
+    assert [ride.pk for ride in db.Ride.iter_search(database, "cafe")] == [4]
+    assert [ride.pk for ride in db.Ride.iter_search(database, 'the "lake" OR')] == []
+    assert [ride.pk for ride in db.Ride.iter_search(database, "lake", filter=db.RideFilter(since=date(2025, 8, 2)))] == [3, 4]
+    # the index follows changes of the comments
+    ride = db.Ride.get_row(database, 2)
+    ride.comment = "lake"
+    ride.save()
+    with closing(database.cursor()) as cursor:
+        cursor.execute("DELETE FROM rides WHERE id = 1")
+    assert {ride.pk for ride in db.Ride.iter_search(database, "lake")} == {2, 3, 4}
+    assert [ride.pk for ride in db.Ride.iter_search(database, "work")] == []
+    with closing(database.cursor()) as cursor:
+        cursor.execute("INSERT INTO rides_fts (rides_fts) VALUES ('integrity-check')")
+
+
+def test_report(database):
+    db.Ride.bulk_save(database, [
+        db.Ride(database, timestamp=datetime(2024, 8, 5), distance=10, duration=timedelta(hours=1), segments=1),
+        db.Ride(database, timestamp=datetime(2025, 8, 4), distance=20, duration=timedelta(hours=1), segments=1),
+        db.Ride(database, timestamp=datetime(2025, 8, 10), distance=40, segments=2),
+        db.Ride(database, timestamp=datetime(2025, 9, 1), distance=5, duration=timedelta(minutes=15), segments=1),
+    ])
+    months = db.Ride.get_report(database, "month")
+    assert [row["start"] for row in months] == [date(2024, 8, 1), date(2025, 8, 1), date(2025, 9, 1)]
+    august = months[1]
+    assert (august["distance"], august["n_rides"], august["longest"]) == (60, 3, 20)
+    assert august["duration"] == timedelta(hours=1)
+    # rides without a duration don't count towards the average speed
+    assert august["speed"] == 20
+    assert august["previous_distance"] is None
+
+    weeks = db.Ride.get_report(database, "week", compare=True)
+    assert [row["start"] for row in weeks] == [date(2024, 8, 5), date(2025, 8, 4), date(2025, 9, 1)]
+    assert [(row["previous_distance"], row["previous_n_rides"]) for row in weeks] == [
+        (None, None), (10, 1), (None, None)
+    ]
+    # the comparison covers the same dates one year before
+    years = db.Ride.get_report(database, "year", db.RideFilter(since=date(2025, 8, 6)), compare=True)
+    assert [(row["start"], row["distance"], row["previous_distance"]) for row in years] == [
+        (date(2025, 1, 1), 45, None)
+    ]
+    years = db.Ride.get_report(database, "year", db.RideFilter(min_distance=10), compare=True)
+    assert [(row["distance"], row["previous_distance"]) for row in years] == [(10, None), (60, 10)]
+
+
+def test_import_gpx_files(database, tmp_path):
+    raw = GPX_PATH.read_text()
+    paths = []
+    for day in range(11, 15):
+        paths.append(tmp_path / f"{day}.gpx")
+        paths[-1].write_text(raw.replace("2025-08-10", f"2025-08-{day}"))
+    paths.insert(2, tmp_path / "broken.gpx")
+    paths[2].write_text("<gpx><trk>")
+    results = list(db.Ride.import_gpx_files(database, paths, jobs=2, batch_size=2))
+    # in the order of paths, with the error of the broken file
+    assert [path for path, _ in results] == paths
+    assert isinstance(results[2][1], ValueError)
+    rides = [ride for _, result in results if not isinstance(result, Exception) for ride in result]
+    assert [ride.timestamp.day for ride in rides] == [11, 11, 12, 12, 13, 13, 14, 14]
+    # the same as reading the files one by one
+    lake, home = db.Ride.from_gpx(database, GPX_PATH)
+    assert (rides[0].distance, rides[0].duration, rides[0].comment) == (lake.distance, lake.duration, lake.comment)
+    metrics = rides[1].get_metrics()
+    assert metrics.ride_id == rides[1].pk
+    assert metrics.moving_time == home.get_metrics().moving_time
+    assert bytes(rides[1].get_track_points().lat) == bytes(home.get_track_points().lat)
+    assert db.Ride.count_missing_track_data(database) == 0
+
+
+def test_import_gpx_files_error_on_save(database, tmp_path, monkeypatch):
+    paths = [tmp_path / "11.gpx", tmp_path / "12.gpx"]
+    for day, path in enumerate(paths, 11):
+        path.write_text(GPX_PATH.read_text().replace("2025-08-10", f"2025-08-{day}"))
+    add_rows = db.TrackPoints.add_rows
+
+    def fail_once(database, rows):
+        monkeypatch.setattr(db.TrackPoints, "add_rows", add_rows)
+        raise sqlite3.IntegrityError("broken")
+
+    monkeypatch.setattr(db.TrackPoints, "add_rows", fail_once)
+    (_, failed), (_, saved) = db.Ride.import_gpx_files(database, paths, jobs=1)
+    # only the changes of the failed file are rolled back
+    assert isinstance(failed, sqlite3.IntegrityError)
+    assert len(saved) == 2
+    assert [ride.timestamp.day for ride in db.Ride.iter_query(database, db.Ride.select_all_query())] == [12, 12]
+    with closing(database.cursor()) as cursor:
+        assert cursor.execute("SELECT COUNT(*) FROM gpx_blobs").fetchone()[0] == 1
+
+
+def test_import_gpx_idempotent(database, tmp_path, monkeypatch):
+    lake, home = db.Ride.from_gpx(database, GPX_PATH)
+    # a file that was imported before is recognized by its hash, without parsing it
+    with monkeypatch.context() as m:
+        m.setattr(db.ParsedGpx, "parse", None)
+        assert db.Ride.from_gpx(database, GPX_PATH) == []
+    # the same tracks from another file are recognized by their start and distance
+    renamed = tmp_path / "renamed.gpx"
+    renamed.write_text(GPX_PATH.read_text().replace("to the lake", "to the beach"))
+    assert db.Ride.from_gpx(database, renamed) == []
+    assert db.Ride.get_total_rides(database) == 2
+    with closing(database.cursor()) as cursor:
+        # no ride refers to the file, so it is not stored
+        assert cursor.execute("SELECT COUNT(*) FROM gpx_blobs").fetchone()[0] == 1
+    updated = db.Ride.from_gpx(database, renamed, on_duplicate="update")
+    assert [ride.pk for ride in updated] == [lake.pk, home.pk]
+    assert db.Ride.get_row(database, lake.pk).comment == "to the beach"
+    assert db.Ride.get_row(database, lake.pk).gpx_id != lake.gpx_id
+    assert db.RideMetrics.get_by_ride(database, lake.pk).n_points == 120
+    with closing(database.cursor()) as cursor:
+        # the replaced file is not kept
+        assert cursor.execute("SELECT COUNT(*) FROM gpx_blobs").fetchone()[0] == 1
+        assert cursor.execute("SELECT COUNT(*) FROM ride_metrics").fetchone()[0] == 2
+    assert db.Ride.get_total_rides(database) == 2
+
+
+def test_import_track_twice_in_file(database, tmp_path):
+    raw = GPX_PATH.read_text()
+    track = raw[raw.index("<trk>"):raw.index("</trk>") + len("</trk>")]
+    twice = tmp_path / "twice.gpx"
+    twice.write_text(raw.replace(track, track + track, 1))
+    # the second copy is skipped like a track that was imported before
+    (_, rides), (_, skipped) = db.Ride.import_gpx_files(database, [twice, GPX_PATH], jobs=1)
+    assert len(rides) == 2
+    assert skipped == []
+    renamed = tmp_path / "renamed.gpx"
+    renamed.write_text(twice.read_text().replace("to the lake", "to the beach"))
+    [(_, updated)] = db.Ride.import_gpx_files(database, [renamed], jobs=1, on_duplicate="update")
+    assert [ride.pk for ride in updated] == [ride.pk for ride in rides]
+    assert db.Ride.get_total_rides(database) == 2
+
+
+def test_add_gpx_already_imported(database):
+    lake, _ = db.Ride.from_gpx(database, GPX_PATH)
+    ride = db.Ride(database, timestamp=lake.timestamp, distance=lake.distance, gpx=GPX_PATH.read_text())
+    with pytest.raises(ValueError, match=f"ride with ID {lake.pk} "):
+        ride.save()
+    assert db.Ride.get_total_rides(database) == 2
+    # a ride can get new gpx data of its own track
+    lake.gpx = GPX_PATH.read_text().replace("to the lake", "to the beach")
+    lake.save()
+
+
+def test_migrate_gpx_fingerprint():
+    _db = db.Database(":memory:")
+    with closing(_db.cursor()) as cursor:
+        for path in sorted(Path(db.__file__).parent.glob("_migrations/m*.py"))[:11]:
+            module = path.stem
+            importlib.import_module(f"kmtracker._migrations.{module}").run(cursor)
+            cursor.execute("INSERT INTO _migrations (name) VALUES (?)", (module,))
+        cursor.execute("INSERT INTO gpx_blobs (hash, data) VALUES ('abc', x'00')")
+        cursor.executemany(
+            "INSERT INTO rides (distance_km, timestamp, segments, gpx_id) VALUES (?, ?, 1, ?)",
+            [(10.001, "2025-01-01T00:00:00", 1), (10.0, "2025-01-01T00:00:00", 1), (10, "2025-01-01T00:00:00", None), (12, "2025-01-01T00:00:00", 1)]
+        )
+        cursor.execute("INSERT INTO ride_metrics (ride_id) VALUES (2)")
+    _db.migrate()
+    # rides that were imported twice are kept, the first one is found by its fingerprint
+    assert sorted(ride.pk for ride in db.Ride.get_latest_entries(_db, -1)) == [1, 2, 3, 4]
+    assert db.Ride.get_by_fingerprint(_db, datetime(2025, 1, 1), 10).pk == 1
+    with closing(_db.cursor()) as cursor:
+        assert cursor.execute("SELECT COUNT(*) FROM ride_metrics").fetchone()[0] == 1
+        with pytest.raises(sqlite3.IntegrityError):
+            cursor.execute("INSERT INTO rides (distance_km, timestamp, gpx_id) VALUES (12.004, '2025-01-01T00:00:00', 1)")
+        with pytest.raises(sqlite3.IntegrityError):
+            cursor.execute("INSERT INTO rides (distance_km, timestamp, gpx_id) VALUES (10, '2025-01-01T00:00:00', 1)")
+    _db.close()
+
+
+@pytest.mark.parametrize("engine", db.METRICS_ENGINES)
+@pytest.mark.parametrize("parser", db.PARSERS)
+@pytest.mark.parametrize("path", sorted(GPX_PATH.parent.glob("*.gpx")), ids=lambda path: path.name)
+def test_parsers(path, parser, engine):
+    # all parsers and metrics engines compute what gpxpy computes
+    expected = db.ParsedGpx.read(path, "gpxpy", engine="gpxpy").tracks
+    parsed = db.ParsedGpx.read(path, parser, engine=engine).tracks
+    assert len(parsed) == len(expected)
+    for track, expected_track in zip(parsed, expected):
+        ride, expected_ride = dict(track["ride"]), dict(expected_track["ride"])
+        assert ride.pop("timestamp") == expected_ride.pop("timestamp")
+        assert ride == pytest.approx(expected_ride, rel=1e-9)
+        assert track["metrics"] == pytest.approx(expected_track["metrics"], rel=1e-9)
+        for name in ("lat", "lon", "ele", "time", "segment_sizes"):
+            assert bytes(track["points"][name]) == bytes(expected_track["points"][name])
+
+
+def test_metrics_of_whole_file():
+    gpx = db.parse_gpx(GPX_PATH.read_text())
+    assert db.RideMetrics.compute(gpx, engine="numpy") == pytest.approx(db.RideMetrics.compute(gpx, engine="gpxpy"), rel=1e-9)
+    with pytest.raises(ValueError):
+        db.RideMetrics.compute(gpx, engine="fortran")
+    with pytest.raises(ValueError):
+        db.ParsedGpx.parse(GPX_PATH.read_text(), "stream", engine="fortran")
+
+
+def test_simplification():
+    # a straight line of 101 points, one per second, with a detour of 20 m in the middle
+    lat = array("d", (48 + i * 1e-4 for i in range(101)))
+    lon = array("d", [9.] * 101)
+    lon[50] += 20 / (gpxstream.ONE_DEGREE * math.cos(math.radians(lat[50])))
+    ele = array("d", [math.nan] * 101)
+    time = array("d", (1.7e9 + i for i in range(101)))
+    points = {"n_points": 101, "lat": lat, "lon": lon, "ele": ele, "time": time}
+    simplified = db.Simplification(tolerance=5).apply(points)
+    assert list(simplified["lat"]) == [lat[0], lat[49], lat[50], lat[51], lat[100]]
+    assert simplified["n_recorded"] == 101
+    assert simplified["distance_error"] == pytest.approx(0)
+    assert len(db.Simplification(tolerance=50).apply(points)["lat"]) == 2
+    assert len(db.Simplification(interval=10).apply(points)["lat"]) == 11
+    assert not db.Simplification()
+
+
+def test_from_gpx_simplified(database):
+    lake, home = db.Ride.from_gpx(database, GPX_PATH, simplify=db.Simplification(tolerance=10))
+    points = lake.get_track_points()
+    assert points.simplified
+    assert points.n_recorded == 120 > points.n_points == len(points.lat)
+    assert abs(points.distance_error) < .05
+    # the metrics are computed from all points
+    assert lake.get_metrics().n_points == 120
+    summary = db.TrackPoints.summarize_simplification(database, [lake.pk, home.pk])
+    assert summary["n_tracks"] == 2
+    assert summary["n_recorded"] == 220
+
+
+def test_heatmap(database):
+    lake, home = db.Ride.from_gpx(database, GPX_PATH)
+    lat_cells, lon_cells, counts = db.TrackGrid.get_heatmap(database, 50)
+    assert len(lat_cells) == len(lon_cells) == len(counts) > 0
+    assert counts.max() <= 2
+    # only new rides and rides with new points are binned
+    assert db.TrackGrid.update_missing(database, 50) == 0
+    assert db.TrackGrid.update_missing(database, 100) == 2
+    # 1 km north in a single step, like a simplified track, passes through all cells in between
+    lat = array("d", [48., 48. + 1000 / gpxstream.ONE_DEGREE])
+    db.TrackPoints.store(database, lake.pk, {
+        "n_points": 2, "lat": lat, "lon": array("d", [9., 9.]),
+        "ele": array("d", [math.nan] * 2), "time": array("d", [0., 200.]),
+    })
+    assert db.TrackGrid.update_missing(database, 50) == 1
+    lat_cells, lon_cells, counts = db.TrackGrid.get_heatmap(database, 50, db.RideFilter(min_distance=lake.distance))
+    first, last = (math.floor(value * gpxstream.ONE_DEGREE / 50) for value in lat)
+    assert list(lat_cells) == list(range(first, last + 1))
+    assert set(lon_cells) == {math.floor(9 * gpxstream.ONE_DEGREE / 50)}
+    assert set(counts) == {1}
+    # but not from the end of a segment to the start of the next one
+    db.TrackPoints.store(database, lake.pk, {
+        "n_points": 2, "lat": lat, "lon": array("d", [9., 9.]),
+        "ele": array("d", [math.nan] * 2), "time": array("d", [0., 200.]), "segment_sizes": array("d", [1, 1]),
+    })
+    lat_cells, _, _ = db.TrackGrid.get_heatmap(database, 50, db.RideFilter(min_distance=lake.distance))
+    assert list(lat_cells) == [first, last]
+    with pytest.raises(ValueError):
+        db.TrackGrid.get_heatmap(database, 0)
+
+
+def test_segment_sizes(database):
+    path = GPX_PATH.parent / "gpx10_segments.gpx"
+    [ride] = db.Ride.from_gpx(database, path, simplify=db.Simplification(interval=60))
+    points = db.TrackPoints.get_by_ride(database, ride.pk)
+    assert len(points.segment_sizes) == ride.segments > 1
+    assert sum(points.segment_sizes) == points.n_points
+    # points that were stored without their segments are extracted again by backfill
+    with closing(database.cursor()) as cursor:
+        cursor.execute("UPDATE track_points SET segment_sizes = NULL")
+    assert db.Ride.count_missing_track_data(database) == 1
+    assert list(db.Ride.backfill_track_data(database)) == [1]
+    assert db.TrackPoints.get_by_ride(database, ride.pk).segment_sizes is not None
+
+
+def test_import_track_without_times(database):
+    # the file fails, the other files of the batch are imported
+    no_times, two_tracks = db.Ride.import_gpx_files(database, [GPX_PATH.parent / "no_times.gpx", GPX_PATH], jobs=1)
+    assert isinstance(no_times[1], ValueError)
+    assert len(two_tracks[1]) == 2
+    assert len(db.Ride.get_latest_entries(database, -1)) == 2
+
+
+def test_iter_export(database):
+    lake, home = db.Ride.from_gpx(database, GPX_PATH)
+    db.Ride(database, distance=12, timestamp=datetime(2025, 8, 11), duration=timedelta(minutes=30)).save()
+    rows = list(db.Ride.iter_export(database, metrics=True, chunk_size=1))
+    assert [row["id"] for row in rows] == [lake.pk, home.pk, 3]
+    assert rows[0]["moving_time_s"] == 575
+    assert rows[2]["duration_s"] == 1800 and rows[2]["n_points"] is None
+    rows = list(db.Ride.iter_export(database, db.RideFilter(has_gpx=True), gpx_hash=True))
+    assert {row["gpx_hash"] for row in rows} == {db.GpxBlob.hash_of(GPX_PATH.read_text())}
+    assert "moving_time_s" not in rows[0]